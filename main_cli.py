@@ -1,19 +1,17 @@
 # main_cli.py
 import sys
+import logging
 import argparse
 from pathlib import Path
 from src.detector import detect_and_crop
 from src.preprocess import preprocess_image
 from src.classifier import predict_anemia
+from src.batch_runner import collect_image_paths, run_batch
+from src.models import registry
 
-def main():
-    # Parse command line arguments
-    parser = argparse.ArgumentParser(description="Anemia Detection CLI")
-    parser.add_argument("image_path", help="Path to the input eye image")
-    args = parser.parse_args()
+def run_single(image_path):
+    image_path = Path(image_path)
 
-    image_path = Path(args.image_path)
-    
     if not image_path.exists():
         print(f"Error: File not found at {image_path}")
         return
@@ -42,5 +40,72 @@ def main():
     print(f"CONFIDENCE: {confidence * 100:.2f}%")
     print("="*30 + "\n")
 
+def run_many(args):
+    try:
+        paths = collect_image_paths(args.input_dir, args.glob, args.manifest)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}")
+        return
+
+    if not paths:
+        print("No images found to process.")
+        return
+
+    # Load the models while the first files are decoding
+    registry.load_all_in_background()
+
+    print(f"\n--- Screening {len(paths)} images -> {args.output} ---")
+    summary = run_batch(
+        paths,
+        args.output,
+        batch_size=args.batch_size,
+        workers=args.workers,
+        resume=not args.no_resume,
+        save_boxed=args.save_boxed,
+    )
+
+    # Report throughput and where the time went
+    print("\n" + "="*30)
+    print(f"Processed: {summary['processed']} ({summary['ok']} ok, {summary['errors']} errors)")
+    if summary["skipped"]:
+        print(f"Skipped (already in output): {summary['skipped']}")
+    print(f"Wall time: {summary['seconds']:.2f}s")
+    print(f"Throughput: {summary['images_per_sec']:.2f} images/sec")
+    print("Per-stage time (summed across workers):")
+    for stage, seconds in summary["stage_seconds"].items():
+        print(f"  {stage:<11} {seconds:8.2f}s")
+    for name, status in registry.status().items():
+        if status["load_seconds"] is not None:
+            print(f"Model load ({name}): {status['load_seconds']:.2f}s")
+    print("="*30 + "\n")
+
+def main():
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description="Anemia Detection CLI")
+    parser.add_argument("image_path", nargs="?", help="Path to the input eye image")
+
+    # Batch mode: screen a whole folder or a list of files
+    batch = parser.add_argument_group("batch mode")
+    batch.add_argument("--input-dir", help="Folder of images to screen")
+    batch.add_argument("--glob", default="*", help="Pattern for files inside --input-dir (e.g. '**/*.jpg')")
+    batch.add_argument("--manifest", help="Text file with one image path per line, or a CSV with a 'path' column")
+    batch.add_argument("--output", default="results.csv", help="Results file (.csv or .jsonl)")
+    batch.add_argument("--batch-size", type=int, default=16, help="Images per model call")
+    batch.add_argument("--workers", type=int, default=4, help="Threads for decoding and preprocessing")
+    batch.add_argument("--no-resume", action="store_true", help="Reprocess files already screened successfully (failed files are always retried)")
+    batch.add_argument("--save-boxed", action="store_true", help="Also write boxed detection images")
+    args = parser.parse_args()
+
+    # Model loading and warnings go through logging now
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    if args.input_dir or args.manifest:
+        run_many(args)
+    elif args.image_path:
+        run_single(args.image_path)
+    else:
+        parser.print_usage()
+        sys.exit(2)
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,137 @@
+# src/admission.py
+"""
+Admission control and request deadlines.
+Under overload it is better to turn requests away quickly than to queue
+them until clients give up: by then the server has spent CPU on answers
+nobody reads. The API admits a limited number of requests at a time, lets
+a bounded number wait, and rejects the rest with 503 + Retry-After.
+Each request also carries a deadline; work that hasn't started by then
+(a queued stage, an item waiting for its model batch) is dropped.
+"""
+
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+from src.config import MAX_IN_FLIGHT, MAX_QUEUE, DEGRADE_QUEUE_DEPTH
+from src.metrics import metrics, QUEUE_DEPTH
+
+logger = logging.getLogger(__name__)
+
+ADMISSION = metrics.counter(
+    "anemo_admission",
+    "Requests by admission outcome (admitted, shed, expired, degraded)",
+    ["outcome"],
+)
+IN_FLIGHT = metrics.gauge("anemo_in_flight_requests", "Requests currently being processed")
+
+
+class Overloaded(RuntimeError):
+    """The server (or one of its queues) is full; try again later."""
+
+
+class DeadlineExceeded(TimeoutError):
+    """The request's deadline passed before its work could start."""
+
+
+def check_deadline(deadline, step):
+    """Raise DeadlineExceeded if the loop-time deadline has passed."""
+    if deadline is not None and asyncio.get_event_loop().time() >= deadline:
+        ADMISSION.inc(outcome="expired")
+        raise DeadlineExceeded(f"Deadline passed before {step}")
+
+
+async def _acquire(semaphore, deadline, step):
+    # Wait for the semaphore, but no longer than the deadline allows
+    check_deadline(deadline, step)
+    if not semaphore.locked():
+        # Free slot: take it right away. wait_for would run the acquire as a
+        # separate task, letting other requests slip past the locked() check
+        await semaphore.acquire()
+        return
+
+    timeout = None
+    if deadline is not None:
+        timeout = deadline - asyncio.get_event_loop().time()
+    try:
+        await asyncio.wait_for(semaphore.acquire(), timeout)
+    except asyncio.TimeoutError:
+        ADMISSION.inc(outcome="expired")
+        raise DeadlineExceeded(f"Deadline passed while waiting for {step}")
+
+
+class AdmissionController:
+    """
+    Lets max_in_flight requests run at once and up to max_queue more wait
+    for a slot. Anything beyond that is rejected right away with Overloaded.
+    A max_in_flight of 0 admits everything.
+    """
+
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT, max_queue=MAX_QUEUE, degrade_depth=DEGRADE_QUEUE_DEPTH):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max(0, max_queue)
+        self.degrade_depth = degrade_depth
+        self.in_flight = 0
+        self.waiting = 0
+        self._slots = asyncio.Semaphore(max_in_flight) if max_in_flight > 0 else None
+        QUEUE_DEPTH.set_function(lambda: self.waiting, queue="admission")
+        IN_FLIGHT.set_function(lambda: self.in_flight)
+
+    def should_degrade(self, extra_depth=0):
+        """
+        True when the queue is deep enough that optional work (Grad-CAM)
+        should be skipped. extra_depth adds other queues, e.g. a batcher's.
+        """
+        return self.degrade_depth > 0 and self.waiting + extra_depth >= self.degrade_depth
+
+    @asynccontextmanager
+    async def admit(self, deadline=None):
+        """
+        Hold a processing slot for the duration of the block.
+        Raises Overloaded if too many requests are already waiting, or
+        DeadlineExceeded if the deadline passes while waiting.
+        """
+        if self._slots is not None:
+            if self._slots.locked() and self.waiting >= self.max_queue:
+                ADMISSION.inc(outcome="shed")
+                raise Overloaded("Too many requests waiting")
+
+            self.waiting += 1
+            try:
+                await _acquire(self._slots, deadline, "processing")
+            finally:
+                self.waiting -= 1
+
+        ADMISSION.inc(outcome="admitted")
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            if self._slots is not None:
+                self._slots.release()
+
+
+class StageLimits:
+    """
+    Caps how many requests run each named stage at once, e.g.
+    {"decode": 4, "preprocess": 4}. Stages without a positive limit run
+    freely (after a deadline check).
+    """
+
+    def __init__(self, limits=None):
+        self._semaphores = {stage: asyncio.Semaphore(n) for stage, n in (limits or {}).items() if n > 0}
+
+    @asynccontextmanager
+    async def slot(self, stage, deadline=None):
+        semaphore = self._semaphores.get(stage)
+        if semaphore is None:
+            check_deadline(deadline, stage)
+            yield
+            return
+
+        await _acquire(semaphore, deadline, stage)
+        try:
+            yield
+        finally:
+            semaphore.release()
@@ -1,18 +1,45 @@
 # api.py
-import shutil
+import asyncio
+import hashlib
+import json
+import time
 import uuid
 import logging
+import re
+import shutil
 from pathlib import Path
-from fastapi import FastAPI, UploadFile, File, HTTPException, Query
+from typing import List, Optional
+from fastapi import FastAPI, UploadFile, File, HTTPException, Query, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, StreamingResponse, FileResponse
 from fastapi.staticfiles import StaticFiles
 
-from src.config import UPLOAD_DIR, STATIC_DIR, RESULTS_DIR
-from src.pipeline import run_pipeline
+from src.config import (
+    STATIC_DIR, PREPROCESS_ENGINE,
+    CACHE_MAX_ENTRIES, CACHE_DIR, CACHE_DISK_MAX_BYTES, LOG_REQUESTS,
+    INFERENCE_WORKERS, STREAM_MAX_FRAMES, GRADCAM_METHOD,
+    RETRY_AFTER_SECONDS, REQUEST_TIMEOUT_SECONDS, DECODE_CONCURRENCY, PREPROCESS_CONCURRENCY,
+    SHADOW_MODEL_PATH, CASCADE, TTA, TTA_VARIANTS, TTA_BAND_LOW, TTA_BAND_HIGH,
+    EMBEDDINGS, EMBEDDING_LAYER, SIMILAR_MAX_K,
+)
+from src.pipeline import run_pipeline_async, create_batchers, serving_versions, MIXED_VERSION
+from src.models import registry
+from src.cache import ResultCache, make_cache_key
+from src.artifacts import ArtifactRenderer
+from src.results_store import results_store
+from src.metrics import metrics, REQUEST_SECONDS, PeakTracker, stage_timer
+from src.workers import InferencePool
+from src.streaming import StreamSession
+from src.admission import AdmissionController, StageLimits, Overloaded, DeadlineExceeded, ADMISSION
+from src.jobs import JobStore, JobRunner, collect_inputs, result_lines
+from src.shadow import ShadowRunner
+from src.quality import QualityRejected
+from src.similar import SimilarIndex
 
 # Log security events
 logger = logging.getLogger(__name__)
+# One line per request with its step timings (see LOG_REQUESTS)
+request_logger = logging.getLogger("anemo.requests")
 
 # Upload file size and type limits
 MAX_UPLOAD_SIZE = 5 * 1024 * 1024  # 5MB
@@ -29,6 +56,117 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Shared YOLO / classifier batchers, created once the event loop is running
+batchers = {}
+
+# Bounds how many /predict requests run and wait at once, and how many
+# decode/preprocess at once
+admission = AdmissionController()
+stage_limits = StageLimits({"decode": DECODE_CONCURRENCY, "preprocess": PREPROCESS_CONCURRENCY})
+
+# Worker processes that own the models (only with ANEMO_INFERENCE_WORKERS > 0)
+inference_pool = InferencePool(INFERENCE_WORKERS) if INFERENCE_WORKERS > 0 else None
+
+# Optional second classifier compared against the live one on sampled traffic
+shadow_runner = ShadowRunner(SHADOW_MODEL_PATH) if SHADOW_MODEL_PATH else None
+
+@app.on_event("startup")
+async def start_model_loading():
+    # Load and warm the models in the background so the server answers right away.
+    # Changed model files are then swapped in without a restart (workers
+    # watch their own copies)
+    if inference_pool is not None:
+        inference_pool.start()
+    else:
+        registry.load_all_in_background()
+        registry.start_watcher()
+    if shadow_runner is not None:
+        shadow_runner.start()
+
+@app.on_event("shutdown")
+async def stop_model_watcher():
+    registry.stop_watcher()
+    if shadow_runner is not None:
+        shadow_runner.stop()
+
+@app.on_event("startup")
+async def start_batchers():
+    batchers.update(create_batchers(pool=inference_pool))
+    for batcher in batchers.values():
+        await batcher.start()
+
+# Bulk jobs: stored in SQLite and run in the background through the same
+# batchers. The database is only opened at startup, so importing this module
+# doesn't create it
+job_store = JobStore()
+job_runner = JobRunner(job_store, batchers, stage_limits)
+
+@app.on_event("startup")
+async def resume_jobs():
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(None, job_store.open)
+    # Expire old jobs now and then every sweep interval
+    await loop.run_in_executor(None, job_store.start_sweeper)
+    job_runner.resume()
+
+@app.on_event("shutdown")
+async def stop_jobs():
+    # Before the batchers stop, so interrupted images stay pending and the
+    # job resumes on the next start
+    await job_runner.stop()
+    job_store.close()
+
+@app.on_event("shutdown")
+async def stop_batchers():
+    for batcher in batchers.values():
+        await batcher.stop()
+    batchers.clear()
+
+@app.on_event("shutdown")
+async def stop_inference_pool():
+    if inference_pool is not None:
+        await asyncio.get_event_loop().run_in_executor(None, inference_pool.stop)
+
+# Answers repeated uploads of the same photo without rerunning the models
+result_cache = ResultCache(CACHE_MAX_ENTRIES, CACHE_DIR, CACHE_DISK_MAX_BYTES)
+
+# Renders boxed/heatmap images after the response has gone out
+artifact_renderer = ArtifactRenderer()
+
+@app.on_event("shutdown")
+async def stop_artifact_renderer():
+    artifact_renderer.shutdown(wait=True)
+
+# Embeddings of screened cases, for /similar (only with ANEMO_EMBEDDINGS)
+similar_index = SimilarIndex() if EMBEDDINGS else None
+
+@app.on_event("shutdown")
+async def close_similar_index():
+    if similar_index is not None:
+        similar_index.close()
+
+# Cache and results-store stats, read when /metrics is scraped
+CACHE_STATS = metrics.gauge("anemo_cache", "Result cache counters and sizes", ["stat"])
+for _stat in ("memory_hits", "disk_hits", "misses", "memory_entries", "disk_entries", "disk_bytes", "hit_rate"):
+    CACHE_STATS.set_function(lambda stat=_stat: result_cache.snapshot()[stat], stat=_stat)
+
+RESULTS_STATS = metrics.gauge("anemo_results", "Result image store counters and sizes", ["stat"])
+for _stat in ("files", "bytes", "expired_files", "evicted_files", "last_sweep_seconds"):
+    RESULTS_STATS.set_function(lambda stat=_stat: results_store.snapshot()[stat], stat=_stat)
+
+# Expire old result images and keep the folder under its quota
+@app.on_event("startup")
+async def start_results_sweeper():
+    await asyncio.get_event_loop().run_in_executor(None, results_store.start_sweeper)
+
+@app.on_event("shutdown")
+async def stop_results_sweeper():
+    results_store.stop_sweeper()
+
+def static_url(path):
+    """Turn a file under STATIC_DIR into its /static URL."""
+    return "/static/" + Path(path).resolve().relative_to(STATIC_DIR).as_posix()
+
 # Mount static files
 app.mount("/static", StaticFiles(directory=str(STATIC_DIR)), name="static")
 
@@ -39,18 +177,176 @@ def root():
         return index_path.read_text()
     return "<h1>Upload index.html to static folder</h1>"
 
+@app.get("/ready")
+def ready():
+    """
+    Readiness check: 200 once every model is loaded and warmed, 503 before.
+    Includes per-model load and warm-up times (per worker process when
+    running an inference pool).
+    """
+    if inference_pool is not None:
+        body = {"ready": inference_pool.is_ready(), "workers": inference_pool.status()}
+    else:
+        body = {"ready": registry.is_ready(), "models": registry.status()}
+    if not body["ready"]:
+        return JSONResponse(status_code=503, content=body)
+    return body
+
+@app.get("/models")
+def models_status():
+    """
+    Loaded model versions, hot-swap counts and errors, plus how the shadow
+    model compares with the live one (when ANEMO_SHADOW_MODEL_PATH is set).
+    """
+    shadow = shadow_runner.summary() if shadow_runner is not None else None
+    if inference_pool is not None:
+        return {
+            "workers": {name: worker["models"] for name, worker in inference_pool.status().items()},
+            "shadow": shadow,
+        }
+    return {"models": registry.status(), "shadow": shadow}
+
+@app.post("/models/{name}/reload")
+async def reload_model(name: str):
+    """
+    Load the model's file again, warm it and swap it in, without dropping
+    requests. Use after replacing a file when the watcher is off.
+    """
+    if inference_pool is not None:
+        raise HTTPException(status_code=409, detail="Worker processes reload their own models when the files change")
+    if name not in registry.names():
+        raise HTTPException(status_code=404, detail="Unknown model")
+    try:
+        version = await asyncio.get_event_loop().run_in_executor(None, registry.reload, name)
+    except Exception:
+        raise HTTPException(status_code=500, detail="Reload failed; the previous version is still serving")
+    return {"model": name, "version": version}
+
+@app.get("/metrics")
+def metrics_endpoint():
+    """Latency histograms, batch sizes, queue depths and cache stats in Prometheus text format."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/cache/stats")
+def cache_stats():
+    """Hit/miss counters and sizes for the result cache."""
+    return result_cache.snapshot()
+
+@app.get("/results/stats")
+def results_stats():
+    """Bytes and files stored in static/results, plus expiry/eviction counters."""
+    return results_store.snapshot()
+
+@app.get("/artifacts/{request_id}")
+def artifact_status(request_id: str):
+    """
+    Rendering status of a request's result images. "ready" turns true once
+    nothing is pending; each artifact is "pending", "ready" or "failed".
+    """
+    status = artifact_renderer.status(request_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Unknown request id")
+
+    artifacts = {
+        kind: {"status": info["status"], "url": static_url(info["path"])}
+        for kind, info in status.items()
+    }
+    return {
+        "ready": all(info["status"] != "pending" for info in artifacts.values()),
+        "artifacts": artifacts,
+    }
+
+@app.get("/similar/{request_id}")
+def similar_cases(request_id: str, k: int = Query(10, ge=1, le=SIMILAR_MAX_K)):
+    """
+    The k earlier cases whose classifier embeddings are closest to this
+    request's (cosine similarity, same classifier version only), for
+    reviewing a prediction against cases like it.
+    """
+    if similar_index is None:
+        raise HTTPException(status_code=404, detail="Similar-case search is not enabled")
+    case, neighbours = similar_index.similar(request_id, k)
+    if case is None:
+        raise HTTPException(status_code=404, detail="Unknown request id")
+
+    def describe(row):
+        described = {
+            "request_id": row["request_id"],
+            "label": row["label"],
+            "confidence": row["confidence"],
+            "created": row["created"],
+        }
+        # Result images are swept after a while; the case itself stays
+        image_path = row["image_path"]
+        if image_path and Path(image_path).exists():
+            described["boxed_image_url"] = static_url(image_path)
+        if "similarity" in row:
+            described["similarity"] = row["similarity"]
+        return described
+
+    return {
+        "case": describe(case),
+        "model_version": case["version"],
+        "similar": [describe(row) for row in neighbours],
+    }
+
 @app.post("/predict")
-async def predict(file: UploadFile = File(...), explain: bool = Query(False)):
+async def predict(file: UploadFile = File(...), explain: bool = Query(False),
+                  timeout_ms: Optional[int] = Query(None, gt=0)):
     """
     Predict anemia from uploaded image.
     
     Query Parameters:
         explain (bool): If true, generate Grad-CAM heatmap (default: false)
+        timeout_ms (int): Give up on work not started after this long
+            (default and maximum: ANEMO_REQUEST_TIMEOUT_SECONDS)
     
     Response includes heatmap_url only if explain=true and generation succeeds.
+    When the server is busy, Grad-CAM is skipped and "degraded" is true;
+    when it is overloaded, the request gets a 503 with Retry-After.
     """
-    print(f"[API] Received POST /predict with explain={explain} (type: {type(explain).__name__})")
-    
+    start = time.perf_counter()
+    info = {"request_id": "-", "cache": "-", "timings": {}, "memory": PeakTracker()}
+    status = 500
+    deadline = request_deadline(timeout_ms)
+
+    try:
+        response = await handle_predict(file, explain, info, deadline)
+        status = 200
+        return response
+    except HTTPException as e:
+        status = e.status_code
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        REQUEST_SECONDS.observe(elapsed, endpoint="/predict", status=str(status))
+        if LOG_REQUESTS:
+            steps = " ".join(f"{step}={seconds * 1000:.1f}ms" for step, seconds in info["timings"].items())
+            request_logger.info(
+                f"request_id={info['request_id']} status={status} cache={info['cache']} "
+                f"total={elapsed * 1000:.1f}ms {steps} mem={info['memory'].peak / 2 ** 20:.1f}MB"
+            )
+
+def request_deadline(timeout_ms=None):
+    """
+    Event loop time after which a request's unstarted work is dropped:
+    ANEMO_REQUEST_TIMEOUT_SECONDS from now, or timeout_ms if shorter
+    (None: no deadline).
+    """
+    timeout = REQUEST_TIMEOUT_SECONDS if REQUEST_TIMEOUT_SECONDS > 0 else None
+    if timeout_ms is not None:
+        timeout = min(timeout_ms / 1000, timeout) if timeout else timeout_ms / 1000
+    return asyncio.get_event_loop().time() + timeout if timeout else None
+
+async def handle_predict(file, explain, info, deadline=None):
+    """
+    The /predict work itself. Fills info["request_id"], info["cache"]
+    ("hit" or "miss" when the cache is on), info["timings"] (seconds per
+    step) and info["memory"] (image buffer peak) for the request log.
+    """
+    timings = info["timings"]
+    logger.debug(f"[API] Received POST /predict with explain={explain}")
+
     # Check if filename exists and is a supported format
     if not file.filename:
         raise HTTPException(status_code=400, detail="Missing filename")
@@ -65,33 +361,70 @@ async def predict(file: UploadFile = File(...), explain: bool = Query(False)):
     
     # Use a random filename to avoid conflicts and security issues
     secure_filename = f"{uuid.uuid4()}{file_ext}"
-    file_path = UPLOAD_DIR / secure_filename
+    request_id = Path(secure_filename).stem
+    info["request_id"] = request_id
     
-    # Check file size before writing to disk
+    # Read the upload into memory, checking the size as it arrives and
+    # hashing the bytes for the result cache
+    content_hash = hashlib.sha256()
+    image_bytes = bytearray()
     try:
-        total_size = 0
-        with file_path.open("wb") as buffer:
-            while chunk := await file.read(8192):
-                total_size += len(chunk)
-                if total_size > MAX_UPLOAD_SIZE:
-                    # Delete the incomplete file
-                    file_path.unlink(missing_ok=True)
+        with stage_timer("upload", timings):
+            while chunk := await file.read(64 * 1024):
+                if len(image_bytes) + len(chunk) > MAX_UPLOAD_SIZE:
                     raise HTTPException(status_code=413, detail="File too large. Maximum size: 5MB")
-                buffer.write(chunk)
+                image_bytes.extend(chunk)
+                content_hash.update(chunk)
     except HTTPException:
         raise
     except Exception as e:
         # Track what went wrong
         logger.error(f"File upload error: {e}", exc_info=True)
-        file_path.unlink(missing_ok=True)
         raise HTTPException(status_code=400, detail="Failed to upload file")
 
-    # Run Pipeline with optional Grad-CAM
+    loop = asyncio.get_event_loop()
+    versions = None
+    result = None
+    if result_cache.enabled:
+        # Keyed on the versions serving right now (the workers' in pool mode)
+        versions = serving_versions(inference_pool)
+        cache_key = result_cache_key(content_hash.hexdigest(), versions, explain)
+        result = await loop.run_in_executor(None, result_cache.get, cache_key)
+        info["cache"] = "hit" if result is not None else "miss"
+
+    if result is not None:
+        # Same photo seen before: skip the pipeline entirely
+        return build_response(result)
+
+    # Run Pipeline with optional Grad-CAM, once there is room for it
+    degraded = False
+    served = {}
     try:
-        print(f"[API] Processing image with explain={explain}")
-        result = run_pipeline(file_path, explain=explain)
-        print(f"[API] Pipeline result keys: {result.keys()}")
-        print(f"[API] Has heatmap_path: {'heatmap_path' in result}")
+        async with admission.admit(deadline):
+            if explain and admission.should_degrade(batchers["explainer"].pending):
+                # Busy: answer with the label only rather than queue for Grad-CAM
+                ADMISSION.inc(outcome="degraded")
+                explain = False
+                degraded = True
+
+            result = await run_pipeline_async(
+                image_bytes, secure_filename, batchers, explain=explain,
+                renderer=artifact_renderer, timings=timings,
+                deadline=deadline, limits=stage_limits, memory=info["memory"], shadow=shadow_runner,
+                versions=served,
+            )
+    except Overloaded as e:
+        logger.warning(f"Shedding request {request_id}: {e}")
+        raise HTTPException(status_code=503, detail="Server is busy. Please try again shortly.",
+                            headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
+    except DeadlineExceeded as e:
+        logger.warning(f"Request {request_id} timed out: {e}")
+        raise HTTPException(status_code=504, detail="Request timed out before it could be processed.")
+    except QualityRejected as e:
+        # Tell the user what to fix; the failed checks go in a header for clients
+        logger.info(f"Request {request_id} rejected by the quality gate: {', '.join(e.failed)}")
+        raise HTTPException(status_code=422, detail=" ".join(e.reasons),
+                            headers={"X-Quality-Failed": ",".join(e.failed)})
     except ValueError as e:
         # Pipeline found an issue with the image
         logger.warning(f"Pipeline validation error: {e}")
@@ -100,28 +433,301 @@ async def predict(file: UploadFile = File(...), explain: bool = Query(False)):
         # Log the full error but tell user something generic
         logger.error(f"Pipeline processing error: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Unable to process image. Please try again.")
-    finally:
-        # Clean up uploaded file after processing
-        file_path.unlink(missing_ok=True)
 
-    # Build the response for the frontend
-    # Convert absolute file path to URL: /static/results/filename.jpg
-    filename = Path(result["boxed_image_path"]).name
-    
+    # The embedding only goes into the similar-case index, never the cache
+    embedding = result.pop("embedding", None)
+    indexed = False
+    if embedding is not None and similar_index is not None:
+        indexed = await loop.run_in_executor(None, index_case, request_id, result, embedding)
+
+    # Stored under the versions that actually made the result: a worker still
+    # on the old model mid-swap must not fill the new version's entry, and a
+    # result mixing two versions isn't cached at all. Models that took no
+    # part keep their lookup version
+    if versions is not None and not degraded and MIXED_VERSION not in served.values():
+        cache_key = result_cache_key(content_hash.hexdigest(), dict(versions, **served), explain)
+        asyncio.ensure_future(cache_when_rendered(cache_key, result, request_id))
+
+    response = build_response(result, request_id)
+    if indexed:
+        response["similar_url"] = f"/similar/{request_id}"
+    if degraded:
+        response["degraded"] = True
+    return response
+
+def result_cache_key(content_hash, versions, explain):
+    # The upload, the model versions and every option that changes the result
+    return make_cache_key(
+        content_hash,
+        versions,
+        engine=PREPROCESS_ENGINE,
+        explain=explain,
+        gradcam=GRADCAM_METHOD if explain else None,
+        cascade=CASCADE and not explain,
+        tta=f"{TTA_VARIANTS}:{TTA_BAND_LOW}-{TTA_BAND_HIGH}" if TTA and not explain else None,
+        embeddings=(EMBEDDING_LAYER or "default") if EMBEDDINGS and not explain else None,
+    )
+
+def index_case(request_id, result, embedding):
+    """
+    Add a screened case to the similar-case index. Failures are logged and
+    skipped so the prediction still goes out. Returns whether it was added.
+    """
+    index = similar_index
+    if index is None:
+        return False
+    # Embeddings are only comparable from the same Keras model, listed as
+    # "keras" when another backend labeled the result
+    versions = result["model_versions"]
+    try:
+        index.add(
+            request_id, embedding, result["label"], result["confidence"],
+            image_path=result["boxed_image_path"], version=versions.get("keras") or versions["classifier"],
+        )
+        return True
+    except Exception as e:
+        logger.error(f"Could not index case {request_id}: {e}", exc_info=True)
+        return False
+
+async def cache_when_rendered(cache_key, result, request_id):
+    """
+    Cache a result once its images are on disk, so cache hits never point at
+    files that failed to render.
+    """
+    futures = artifact_renderer.futures(request_id)
+    rendered = await asyncio.gather(*[asyncio.wrap_future(future) for future in futures])
+    if all(rendered):
+        await asyncio.get_event_loop().run_in_executor(None, result_cache.put, cache_key, result)
+
+def build_response(result, request_id=None):
+    """
+    Build the response for the frontend, turning file paths into
+    /static URLs. With a request_id the images may still be rendering, and
+    artifacts_url reports when they are ready.
+    """
     response = {
         "label": result["label"],
         "confidence": result["confidence"],
-        "boxed_image_url": f"/static/results/{filename}",
+        "boxed_image_url": static_url(result["boxed_image_path"]),
         "note": result["note"]
     }
+
+    if request_id is not None:
+        response["request_id"] = request_id
+        response["artifacts_url"] = f"/artifacts/{request_id}"
     
     # Add heatmap to response if it was generated
     if "heatmap_path" in result:
-        heatmap_filename = Path(result["heatmap_path"]).name
-        response["heatmap_url"] = f"/static/results/{heatmap_filename}"
-        print(f"[API] Heatmap URL added to response: {response['heatmap_url']}")
-    else:
-        print(f"[API] No heatmap_path in result. Result keys: {result.keys()}")
-    
-    print(f"[API] Returning response with keys: {response.keys()}")
-    return response
\ No newline at end of file
+        response["heatmap_url"] = static_url(result["heatmap_path"])
+
+    # Results cached before versions were recorded don't have them
+    if "model_versions" in result:
+        response["model_versions"] = result["model_versions"]
+
+    # Borderline result averaged over augmented copies (mean, spread, count)
+    if "tta" in result:
+        response["tta"] = result["tta"]
+
+    # Answered by the cascade's color model without running the CNN
+    if "decided_by" in result:
+        response["decided_by"] = result["decided_by"]
+
+    # Quality gate in flag mode: the photo had problems but was classified anyway
+    if "quality" in result:
+        response["quality"] = result["quality"]
+
+    return response
+
+# Job ids are uuid4 hex strings
+JOB_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+# Columns of the /jobs/{job_id}/results stream
+JOB_RESULT_FIELDS = ["index", "name", "status", "label", "confidence", "boxed_image_url", "heatmap_url", "error"]
+
+def get_job_or_404(job_id):
+    job = job_store.get(job_id) if JOB_ID_PATTERN.match(job_id) else None
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job id")
+    return job
+
+def job_response(job):
+    """Progress and links for a job."""
+    job_id = job["id"]
+    processed = job["done"] + job["failed"]
+    response = {
+        "job_id": job_id,
+        "status": job["status"],
+        "total": job["total"],
+        "processed": processed,
+        "succeeded": job["done"],
+        "failed": job["failed"],
+        "progress": round(processed / job["total"], 4) if job["total"] else 1.0,
+        "created": job["created"],
+        "started": job["started"],
+        "finished": job["finished"],
+        "status_url": f"/jobs/{job_id}",
+        "results_url": f"/jobs/{job_id}/results",
+    }
+    if job["status"] == "done":
+        response["bundle_url"] = f"/jobs/{job_id}/bundle"
+    if job["error"]:
+        response["error"] = job["error"]
+    return response
+
+@app.post("/jobs", status_code=202)
+async def create_job(files: List[UploadFile] = File(...), explain: bool = Query(False)):
+    """
+    Screen many images in one upload: send several image files and/or zip
+    files of images. Returns a job id right away (202); the images are
+    processed in the background. Poll status_url for progress, read
+    results_url for per-image results as they finish, and download
+    bundle_url (results plus result images in one zip) once done.
+    """
+    job_id = uuid.uuid4().hex
+    loop = asyncio.get_event_loop()
+    uploads = [(upload.filename, upload.file) for upload in files]
+    try:
+        items = await loop.run_in_executor(
+            None, collect_inputs, uploads, job_store.inputs_dir(job_id), MAX_UPLOAD_SIZE,
+        )
+    except Exception as e:
+        await loop.run_in_executor(None, shutil.rmtree, job_store.job_dir(job_id), True)
+        if isinstance(e, ValueError):
+            raise HTTPException(status_code=400, detail=str(e))
+        logger.error(f"Job upload error: {e}", exc_info=True)
+        raise HTTPException(status_code=400, detail="Failed to upload files")
+
+    await loop.run_in_executor(None, job_store.create, job_id, items, explain)
+    job_runner.submit(job_id)
+    logger.info(f"Job {job_id} queued with {len(items)} images")
+    return job_response(job_store.get(job_id))
+
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    """Progress of a bulk job."""
+    return job_response(get_job_or_404(job_id))
+
+@app.get("/jobs/{job_id}/results")
+def job_results(job_id: str, fmt: str = Query("jsonl", alias="format", regex="^(jsonl|csv)$")):
+    """
+    Results finished so far, in upload order, streamed as JSONL (default)
+    or CSV (?format=csv). Image URLs may still 404 for a moment while
+    they are written.
+    """
+    get_job_or_404(job_id)
+
+    def rows():
+        for row in job_store.results(job_id):
+            for key, field in (("boxed_image_path", "boxed_image_url"), ("heatmap_path", "heatmap_url")):
+                row[field] = static_url(row[key]) if row[key] else None
+            yield row
+
+    media_type = "application/x-ndjson" if fmt == "jsonl" else "text/csv"
+    return StreamingResponse(result_lines(rows(), JOB_RESULT_FIELDS, fmt), media_type=media_type)
+
+@app.get("/jobs/{job_id}/bundle")
+def job_bundle(job_id: str):
+    """All results and result images of a finished job as one zip."""
+    job = get_job_or_404(job_id)
+    if job["status"] != "done":
+        raise HTTPException(status_code=409, detail="Job is not finished yet")
+    bundle_path = job_store.bundle_path(job_id)
+    if not bundle_path.exists():
+        raise HTTPException(status_code=404, detail="Bundle not found")
+    return FileResponse(bundle_path, media_type="application/zip", filename=f"anemo-job-{job_id}.zip")
+
+@app.websocket("/ws/screen")
+async def screen_stream(websocket: WebSocket, auto_finish: bool = False):
+    """
+    Screen from a camera stream instead of single photos.
+
+    Send each frame as a binary message (JPEG/PNG/WebP bytes); every frame
+    gets a {"type": "frame", ...} reply with the tracked box, its quality
+    and whether enough good frames have been seen ("ready"). Send the text
+    message {"action": "finish"} to classify the best frames and get a
+    {"type": "result", ...} reply (the same fields as /predict, plus
+    per-frame details), or {"action": "reset"} to start over. With
+    ?auto_finish=true the result is sent as soon as the stream is ready.
+
+    Frames and the final classification share the decode limit and request
+    timeout with /predict, and finishing takes an admission slot like a
+    /predict request. (Streams never run Grad-CAM, so there is nothing to
+    degrade.)
+    """
+    await websocket.accept()
+    session = StreamSession(batchers, renderer=artifact_renderer, limits=stage_limits)
+
+    async def send_result():
+        request_id = str(uuid.uuid4())
+        deadline = request_deadline()
+        try:
+            async with admission.admit(deadline):
+                result = await session.finish(f"{request_id}.jpg", deadline)
+        except ValueError as e:
+            await websocket.send_json({"type": "error", "detail": str(e)})
+            return
+        except Overloaded:
+            await websocket.send_json({"type": "error", "detail": "Server is busy. Please try again shortly."})
+            return
+        except DeadlineExceeded:
+            await websocket.send_json({"type": "error", "detail": "Timed out before the frames could be classified."})
+            return
+        except Exception as e:
+            logger.error(f"Stream processing error: {e}", exc_info=True)
+            await websocket.send_json({"type": "error", "detail": "Unable to process stream. Please try again."})
+            return
+        finally:
+            session.reset()
+
+        response = build_response(result, request_id)
+        for key in ("frames_received", "frames_used", "agreement", "frame_results"):
+            response[key] = result[key]
+        await websocket.send_json(dict(response, type="result"))
+
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+
+            data = message.get("bytes")
+            if data is not None:
+                if len(data) > MAX_UPLOAD_SIZE:
+                    await websocket.send_json({"type": "error", "detail": "Frame too large. Maximum size: 5MB"})
+                    await websocket.close(code=1009)
+                    return
+                if session.frames >= STREAM_MAX_FRAMES:
+                    await websocket.send_json({"type": "error", "detail": "Too many frames. Send finish or reset."})
+                    continue
+
+                try:
+                    feedback = await session.add_frame(data, request_deadline())
+                except ValueError:
+                    feedback = {"type": "frame", "frame": session.frames - 1, "error": "Could not read frame"}
+                except (Overloaded, DeadlineExceeded):
+                    feedback = {"type": "frame", "frame": session.frames - 1, "error": "Server busy, frame skipped"}
+                except Exception as e:
+                    # Batcher stopped, inference worker died, ...: skip the
+                    # frame but keep the stream open
+                    logger.error(f"Stream frame error: {e}", exc_info=True)
+                    feedback = {"type": "frame", "frame": session.frames - 1, "error": "Unable to process frame"}
+                await websocket.send_json(feedback)
+
+                if auto_finish and feedback.get("ready"):
+                    await send_result()
+                continue
+
+            try:
+                action = json.loads(message.get("text") or "{}").get("action")
+            except (ValueError, AttributeError):
+                action = None
+
+            if action == "finish":
+                await send_result()
+            elif action == "reset":
+                session.reset()
+                await websocket.send_json({"type": "reset"})
+            else:
+                await websocket.send_json({"type": "error", "detail": "Unknown message. Send frames or finish/reset."})
+    except WebSocketDisconnect:
+        pass
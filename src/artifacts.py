@@ -0,0 +1,153 @@
+# src/artifacts.py
+"""
+Result image (artifact) encoding and background rendering.
+The boxed detection image and the Grad-CAM overlay aren't needed for the
+headline result, so /predict hands them to a small worker pool and returns
+as soon as the label is known. Clients poll the status endpoint (or just
+retry the URL) until the images are ready.
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import cv2
+
+from src.config import (
+    ARTIFACT_FORMAT, ARTIFACT_JPEG_QUALITY, ARTIFACT_WEBP_QUALITY,
+    ARTIFACT_PREVIEW_MAX_DIM, ARTIFACT_WORKERS,
+)
+from src.results_store import results_store
+from src.metrics import stage_timer, QUEUE_DEPTH
+
+logger = logging.getLogger(__name__)
+
+# Output format -> (file extension, cv2.imwrite params)
+ENCODINGS = {
+    "jpg": (".jpg", [cv2.IMWRITE_JPEG_QUALITY, ARTIFACT_JPEG_QUALITY]),
+    "webp": (".webp", [cv2.IMWRITE_WEBP_QUALITY, ARTIFACT_WEBP_QUALITY]),
+    "png": (".png", [cv2.IMWRITE_PNG_COMPRESSION, 3]),
+}
+
+if ARTIFACT_FORMAT not in ENCODINGS:
+    raise ValueError(f"Unknown artifact format: {ARTIFACT_FORMAT}. Choose from {sorted(ENCODINGS)}")
+
+_PARAMS_BY_EXTENSION = {extension: params for extension, params in ENCODINGS.values()}
+_PARAMS_BY_EXTENSION[".jpeg"] = ENCODINGS["jpg"][1]
+
+# How many finished jobs to remember for the status endpoint
+MAX_TRACKED_JOBS = 10000
+
+
+def artifact_path(kind, image_name):
+    """
+    Where to save an artifact ("boxed" or "heatmap") for an image, using the
+    configured output format.
+    """
+    extension = ENCODINGS[ARTIFACT_FORMAT][0]
+    return results_store.path_for(kind, image_name, extension)
+
+
+def make_preview(image_bgr, max_dim=ARTIFACT_PREVIEW_MAX_DIM):
+    """
+    Downscale an image for display. Returns (preview, scale).
+    The preview is a new array, so it is safe to draw on.
+    """
+    h, w = image_bgr.shape[:2]
+    if max_dim and max(h, w) > max_dim:
+        scale = max_dim / max(h, w)
+        preview = cv2.resize(image_bgr, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+        return preview, scale
+    return image_bgr.copy(), 1.0
+
+
+def write_image(path, image_bgr):
+    """
+    Encode and save an image with the quality settings for its extension.
+    Returns True on success.
+    """
+    path = Path(path)
+    params = _PARAMS_BY_EXTENSION.get(path.suffix.lower(), [])
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with stage_timer("encode"):
+        if not cv2.imwrite(str(path), image_bgr, params):
+            return False
+
+    if results_store.contains(path):
+        results_store.record(path)
+    return True
+
+
+class ArtifactRenderer:
+    """
+    Renders artifacts on a thread pool and remembers their status per request.
+    """
+
+    def __init__(self, workers=ARTIFACT_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="artifact")
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._pending = 0
+        QUEUE_DEPTH.set_function(lambda: self._pending, queue="artifacts")
+
+    def submit(self, request_id, kind, path, render_fn, *args):
+        """
+        Queue render_fn(*args) for one artifact of a request. render_fn must
+        write the file at path and return a truthy value on success.
+        Returns a concurrent.futures.Future.
+        """
+        with self._lock:
+            self._pending += 1
+        future = self._executor.submit(self._render, kind, path, render_fn, *args)
+        future.add_done_callback(self._finished)
+        with self._lock:
+            self._jobs.setdefault(request_id, {})[kind] = (str(path), future)
+            self._jobs.move_to_end(request_id)
+            while len(self._jobs) > MAX_TRACKED_JOBS:
+                self._jobs.popitem(last=False)
+        return future
+
+    def _finished(self, _future):
+        with self._lock:
+            self._pending -= 1
+
+    @staticmethod
+    def _render(kind, path, render_fn, *args):
+        try:
+            if not render_fn(*args):
+                logger.warning(f"Rendering {kind} artifact returned nothing: {path}")
+                return False
+            return True
+        except Exception as e:
+            logger.error(f"Rendering {kind} artifact failed: {e}", exc_info=True)
+            return False
+
+    def status(self, request_id):
+        """
+        Status of every artifact for a request, or None if unknown:
+        {kind: {"status": "pending" | "ready" | "failed", "path": ...}}
+        """
+        with self._lock:
+            jobs = self._jobs.get(request_id)
+            if jobs is None:
+                return None
+            jobs = dict(jobs)
+
+        status = {}
+        for kind, (path, future) in jobs.items():
+            if not future.done():
+                state = "pending"
+            else:
+                state = "ready" if future.result() else "failed"
+            status[kind] = {"status": state, "path": path}
+        return status
+
+    def futures(self, request_id):
+        """The render futures for a request (empty if unknown)."""
+        with self._lock:
+            return [future for _, future in self._jobs.get(request_id, {}).values()]
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
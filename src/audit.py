@@ -0,0 +1,132 @@
+# src/audit.py
+"""
+Offline Grad-CAM audit for whole cohorts.
+Screens every image in a folder (or manifest) and saves a heatmap overlay
+for each one. Images go through in batches: one detector call, one
+gradient pass and one vectorized normalization per batch, with the
+overlays encoded in parallel. Labels, confidences and heatmap paths are
+written to a CSV or JSONL file as each batch finishes.
+
+Usage:
+    python -m src.audit --input-dir cohort/ --output-dir audit/
+    python -m src.audit --manifest cohort.csv --output-dir audit/ --method conv --batch-size 64
+"""
+
+import argparse
+import logging
+import time
+from pathlib import Path
+
+from src.config import ARTIFACT_FORMAT, EXPLAIN_WORKERS, GRADCAM_METHOD
+from src.artifacts import ENCODINGS
+from src.batch_runner import collect_image_paths, ResultWriter, StageTimer
+from src.classifier import get_model, label_from_probability
+from src.explain import explain_batch, METHODS
+from src.preprocess import preprocess_batch
+from src.preprocess_parity import load_crops
+
+logger = logging.getLogger(__name__)
+
+AUDIT_FIELDS = ["path", "status", "label", "confidence", "heatmap_path", "error"]
+
+
+def run_audit(paths, output_dir, results_path, batch_size=32, method=None, workers=EXPLAIN_WORKERS):
+    """
+    Explain every path, saving overlays to output_dir and one row per image
+    to results_path (.csv or .jsonl). Returns a summary dict.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    extension = ENCODINGS[ARTIFACT_FORMAT][0]
+
+    model = get_model()
+    timer = StageTimer()
+    writer = ResultWriter(results_path, AUDIT_FIELDS)
+    counts = {"ok": 0, "error": 0}
+
+    start = time.perf_counter()
+    try:
+        for offset in range(0, len(paths), batch_size):
+            chunk = paths[offset:offset + batch_size]
+            crops, used = timer.timed("detect", load_crops, chunk, batch_size)
+
+            rows = []
+            rows.extend(
+                {"path": str(path), "status": "error", "error": "no usable crop"}
+                for path in chunk if path not in used
+            )
+            tensors = timer.timed("preprocess", preprocess_batch, crops) if crops is not None else None
+            if crops is not None and tensors is None:
+                rows.extend({"path": str(path), "status": "error", "error": "preprocessing failed"} for path in used)
+            elif tensors is not None:
+                # Index prefix keeps names unique when a manifest repeats a file name
+                outputs = [output_dir / f"{offset + i:06d}_{path.stem}{extension}" for i, path in enumerate(used)]
+                probs, heatmaps = timer.timed("explain", explain_batch, model, tensors, crops, outputs, method, workers)
+                for path, p, heatmap_path in zip(used, probs, heatmaps):
+                    label, confidence = label_from_probability(float(p))
+                    rows.append({
+                        "path": str(path),
+                        "status": "ok",
+                        "label": label,
+                        "confidence": round(confidence * 100, 2),
+                        "heatmap_path": heatmap_path,
+                        "error": None if heatmap_path else "heatmap not rendered",
+                    })
+
+            timer.timed("write", writer.write, rows)
+            for row in rows:
+                counts[row["status"]] += 1
+            logger.info(f"Explained {min(offset + batch_size, len(paths))}/{len(paths)} images")
+    finally:
+        writer.close()
+
+    elapsed = time.perf_counter() - start
+    processed = counts["ok"] + counts["error"]
+    return {
+        "processed": processed,
+        "ok": counts["ok"],
+        "errors": counts["error"],
+        "seconds": elapsed,
+        "images_per_sec": processed / elapsed if elapsed > 0 else 0.0,
+        "stage_seconds": dict(timer.totals),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Save Grad-CAM heatmaps for a whole cohort of images")
+    parser.add_argument("--input-dir", help="Folder of images to explain")
+    parser.add_argument("--glob", default="*", help="Pattern for files inside --input-dir")
+    parser.add_argument("--manifest", help="Text/CSV file listing images to explain")
+    parser.add_argument("--output-dir", default="audit", help="Where to save the heatmap overlays")
+    parser.add_argument("--results", help="Results file, .csv or .jsonl (default: <output-dir>/results.csv)")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--method", choices=METHODS, default=GRADCAM_METHOD,
+                        help="Input-gradient saliency or conv-layer Grad-CAM (cheaper)")
+    parser.add_argument("--workers", type=int, default=EXPLAIN_WORKERS, help="Threads encoding overlays")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    if not args.input_dir and not args.manifest:
+        parser.error("Give --input-dir or --manifest")
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+
+    paths = collect_image_paths(args.input_dir, args.glob, args.manifest)
+    if not paths:
+        print("No images found to explain.")
+        return
+
+    results_path = Path(args.results) if args.results else Path(args.output_dir) / "results.csv"
+    print(f"Explaining {len(paths)} images ({args.method}) -> {args.output_dir}")
+    summary = run_audit(paths, args.output_dir, results_path, args.batch_size, args.method, args.workers)
+
+    print(f"\nProcessed: {summary['processed']} ({summary['ok']} ok, {summary['errors']} errors)")
+    print(f"Wall time: {summary['seconds']:.2f}s ({summary['images_per_sec']:.2f} images/sec)")
+    for stage, seconds in summary["stage_seconds"].items():
+        print(f"  {stage:<11} {seconds:8.2f}s")
+    print(f"Results: {results_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,400 @@
+# src/batch_runner.py
+"""
+Batch screening for folders of images.
+Files stream through decode -> detect -> preprocess -> classify as
+overlapping stages: decode and preprocessing run on a worker pool while the
+models work on whole batches. Results are written as each batch finishes so
+an interrupted run can be resumed.
+"""
+
+import csv
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from src.detector import ALLOWED_EXTENSIONS, detect_and_crop_batch, load_image
+from src.preprocess import preprocess_image
+from src.classifier import predict_anemia_batch
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_FIELDS = ["path", "status", "label", "confidence", "error"]
+
+# Marks the end of a stage's queue
+_DONE = object()
+
+
+def collect_image_paths(input_dir=None, pattern="*", manifest=None):
+    """
+    List the images to screen, either from a directory (with a glob pattern)
+    or from a manifest file with one path per line (or a CSV "path" column).
+    """
+    paths = []
+
+    if manifest is not None:
+        manifest = Path(manifest)
+        with manifest.open(newline="") as f:
+            if manifest.suffix.lower() == ".csv":
+                reader = csv.DictReader(f)
+                if not reader.fieldnames or "path" not in reader.fieldnames:
+                    raise ValueError("Manifest CSV needs a 'path' column")
+                paths = [Path(row["path"].strip()) for row in reader if row["path"].strip()]
+            else:
+                paths = [Path(line.strip()) for line in f if line.strip() and not line.startswith("#")]
+
+        # Relative manifest entries are relative to the manifest itself
+        paths = [p if p.is_absolute() else manifest.parent / p for p in paths]
+
+    if input_dir is not None:
+        input_dir = Path(input_dir)
+        if not input_dir.is_dir():
+            raise ValueError(f"Input directory not found: {input_dir}")
+        paths.extend(sorted(p for p in input_dir.glob(pattern) if p.is_file()))
+
+    return [p for p in paths if p.suffix.lower() in ALLOWED_EXTENSIONS]
+
+
+def load_labeled_manifest(manifest):
+    """
+    Read a CSV with "path" and "label" columns. Returns (paths, labels)
+    with labels as 1 (anemic) / 0. Relative paths are relative to the CSV.
+    """
+    manifest = Path(manifest)
+    paths, labels = [], []
+    with manifest.open(newline="") as f:
+        reader = csv.DictReader(f)
+        if not reader.fieldnames or not {"path", "label"} <= set(reader.fieldnames):
+            raise ValueError("Manifest CSV needs 'path' and 'label' columns")
+        for row in reader:
+            value = row["label"].strip().upper()
+            if value in ("ANEMIC", "1", "TRUE", "YES"):
+                labels.append(1)
+            elif value in ("NON-ANEMIC", "NON_ANEMIC", "0", "FALSE", "NO"):
+                labels.append(0)
+            else:
+                raise ValueError(f"Unknown label {row['label']!r} for {row['path']}")
+            path = Path(row["path"].strip())
+            paths.append(path if path.is_absolute() else manifest.parent / path)
+    return paths, np.array(labels, dtype=np.int32)
+
+
+def load_finished_paths(output_path):
+    """
+    Read an existing results file and return the paths already processed
+    successfully. Rows with status "error" are left out so a resumed run
+    retries them.
+    """
+    output_path = Path(output_path)
+    if not output_path.exists():
+        return set()
+
+    done = set()
+    with output_path.open(newline="") as f:
+        if output_path.suffix.lower() == ".csv":
+            for row in csv.DictReader(f):
+                if row.get("status") == "ok":
+                    done.add(row["path"])
+        else:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    row = json.loads(line)
+                    path = row["path"]
+                except (ValueError, KeyError, TypeError):
+                    # A half-written last line from an interrupted run
+                    continue
+                if row.get("status") == "ok":
+                    done.add(path)
+    return done
+
+
+class ResultWriter:
+    """
+    Append result rows to a CSV or JSONL file, flushing after each batch.
+    """
+
+    def __init__(self, output_path, fields=OUTPUT_FIELDS):
+        self.fields = fields
+        self.output_path = Path(output_path)
+        self.is_csv = self.output_path.suffix.lower() == ".csv"
+        self.output_path.parent.mkdir(parents=True, exist_ok=True)
+
+        write_header = self.is_csv and (not self.output_path.exists() or self.output_path.stat().st_size == 0)
+        self._file = self.output_path.open("a", newline="")
+        if self.is_csv:
+            self._csv = csv.DictWriter(self._file, fieldnames=self.fields)
+            if write_header:
+                self._csv.writeheader()
+
+    def write(self, rows):
+        for row in rows:
+            row = {field: row.get(field) for field in self.fields}
+            if self.is_csv:
+                self._csv.writerow(row)
+            else:
+                self._file.write(json.dumps(row) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class StageTimer:
+    """
+    Thread-safe running totals of seconds spent in each stage.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.totals = defaultdict(float)
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.totals[stage] += seconds
+
+    def timed(self, stage, fn, *args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+
+def boxed_names(paths):
+    """
+    Name each boxed visualization after the image's path relative to the
+    folder all inputs share, so files with the same name in different
+    subfolders don't overwrite each other.
+    """
+    paths = [Path(p) for p in paths]
+    if not paths:
+        return {}
+    try:
+        root = Path(os.path.commonpath([str(p.parent) for p in paths]))
+    except ValueError:
+        # Mixed absolute/relative paths or different drives
+        root = None
+
+    names = {}
+    for path in paths:
+        relative = path.relative_to(root) if root is not None else path
+        names[path] = "__".join(part for part in relative.parts if part not in ("/", "\\"))
+    return names
+
+
+def _take_batch(q, batch_size):
+    """
+    Block for one item, then take whatever else is ready up to batch_size.
+    Returns (items, finished).
+    """
+    item = q.get()
+    if item is _DONE:
+        return [], True
+
+    items = [item]
+    while len(items) < batch_size:
+        try:
+            item = q.get_nowait()
+        except queue.Empty:
+            break
+        if item is _DONE:
+            return items, True
+        items.append(item)
+    return items, False
+
+
+def _drain(q):
+    """
+    Throw away everything queued without blocking, cancelling decode or
+    preprocessing work that hasn't started. Returns True if the end marker
+    was among it.
+    """
+    while True:
+        try:
+            item = q.get_nowait()
+        except queue.Empty:
+            return False
+        if item is _DONE:
+            return True
+        if item[1] is not None:
+            item[1].cancel()
+
+
+def run_batch(paths, output_path, batch_size=16, workers=4, resume=True, save_boxed=False):
+    """
+    Screen every path and append results to output_path (.csv or .jsonl).
+
+    Returns a summary dict with counts, throughput and per-stage seconds.
+    """
+    paths = [Path(p) for p in paths]
+    # Named from the full input list so a resumed run keeps the same names
+    names = boxed_names(paths) if save_boxed else {}
+    skipped = 0
+    if resume:
+        finished = load_finished_paths(output_path)
+        remaining = [p for p in paths if str(p) not in finished]
+        skipped = len(paths) - len(remaining)
+        paths = remaining
+
+    timer = StageTimer()
+    writer = ResultWriter(output_path)
+    counts = {"ok": 0, "error": 0}
+
+    # Bounded queues keep memory flat: decode can only run a few batches ahead
+    decoded_q = queue.Queue(maxsize=batch_size * 4)
+    cropped_q = queue.Queue(maxsize=batch_size * 4)
+    errors = []
+    # Set when a stage fails: the others stop working and wind down
+    stop = threading.Event()
+
+    def fail(path, stage, err):
+        return {"path": str(path), "status": "error", "error": f"{stage}: {err}"}
+
+    def produce(pool):
+        # Stage 1: decode on the worker pool, in input order
+        try:
+            for path in paths:
+                if stop.is_set():
+                    break
+                decoded_q.put((path, pool.submit(timer.timed, "decode", load_image, path)))
+        finally:
+            decoded_q.put(_DONE)
+
+    def detect(pool):
+        # Stage 2: batched YOLO, then hand crops to the pool for preprocessing
+        finished = False
+        try:
+            while not finished:
+                items, finished = _take_batch(decoded_q, batch_size)
+                if stop.is_set():
+                    # Keep taking images until the producer is done, so it never blocks
+                    for _, future in items:
+                        future.cancel()
+                    continue
+                ready = []
+                for path, future in items:
+                    try:
+                        ready.append((path, future.result()))
+                    except Exception as e:
+                        cropped_q.put((path, None, fail(path, "decode", e)))
+
+                if not ready:
+                    continue
+
+                try:
+                    crops = timer.timed(
+                        "detect", detect_and_crop_batch,
+                        [image for _, image in ready],
+                        [names.get(path, path.name) for path, _ in ready],
+                        save_boxed,
+                    )
+                except Exception as e:
+                    logger.error(f"Detection batch failed: {e}", exc_info=True)
+                    for path, _ in ready:
+                        cropped_q.put((path, None, fail(path, "detect", e)))
+                    continue
+
+                for (path, _), crop_rgb in zip(ready, crops):
+                    if crop_rgb is None:
+                        cropped_q.put((path, None, fail(path, "detect", "no usable crop")))
+                    else:
+                        cropped_q.put((path, pool.submit(timer.timed, "preprocess", preprocess_image, crop_rgb), None))
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+            # Keep emptying the decode queue so the producer isn't left blocked
+            while not finished:
+                finished = _drain(decoded_q)
+                time.sleep(0.01)
+        finally:
+            cropped_q.put(_DONE)
+
+    # Stage 3 stacks tensors into this instead of a new array per batch
+    batch_buffer = np.empty((batch_size, 224, 224, 3), dtype=np.float32)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="batch-worker") as pool:
+        producer = threading.Thread(target=produce, args=(pool,), daemon=True)
+        detector = threading.Thread(target=detect, args=(pool,), daemon=True)
+        producer.start()
+        detector.start()
+
+        try:
+            # Stage 3: batched classification and incremental writes on this thread
+            finished = False
+            while not finished:
+                items, finished = _take_batch(cropped_q, batch_size)
+                rows = []
+                ready = []
+                for path, future, error_row in items:
+                    if error_row is not None:
+                        rows.append(error_row)
+                        continue
+                    try:
+                        tensor = future.result()
+                    except Exception as e:
+                        tensor = None
+                        logger.error(f"Preprocessing crashed for {path}: {e}")
+                    if tensor is None:
+                        rows.append(fail(path, "preprocess", "preprocessing failed"))
+                    else:
+                        ready.append((path, tensor))
+
+                if ready:
+                    try:
+                        batch = np.concatenate([tensor for _, tensor in ready], axis=0, out=batch_buffer[:len(ready)])
+                        predictions = timer.timed("classify", predict_anemia_batch, batch)
+                        for (path, _), (label, confidence) in zip(ready, predictions):
+                            rows.append({
+                                "path": str(path),
+                                "status": "ok",
+                                "label": label,
+                                "confidence": round(confidence * 100, 2),
+                            })
+                    except Exception as e:
+                        logger.error(f"Classification batch failed: {e}", exc_info=True)
+                        rows.extend(fail(path, "classify", e) for path, _ in ready)
+
+                if rows:
+                    timer.timed("write", writer.write, rows)
+                    for row in rows:
+                        counts[row["status"]] += 1
+        except BaseException:
+            # Stop the other stages, emptying the crop queue until the
+            # detector has finished so neither stays blocked on a full queue
+            stop.set()
+            while detector.is_alive():
+                _drain(cropped_q)
+                detector.join(0.05)
+            producer.join()
+            raise
+        finally:
+            writer.close()
+
+        producer.join()
+        detector.join()
+
+    if errors:
+        raise errors[0]
+
+    elapsed = time.perf_counter() - start
+    processed = counts["ok"] + counts["error"]
+    return {
+        "processed": processed,
+        "ok": counts["ok"],
+        "errors": counts["error"],
+        "skipped": skipped,
+        "seconds": elapsed,
+        "images_per_sec": processed / elapsed if elapsed > 0 else 0.0,
+        "stage_seconds": dict(timer.totals),
+    }
@@ -0,0 +1,191 @@
+# src/batching.py
+"""
+Dynamic micro-batching for model inference.
+Concurrent requests are collected for a short window and sent to the model
+as one batch, then each caller gets its own result back.
+"""
+
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from src.metrics import BATCH_SIZE, QUEUE_DEPTH
+from src.admission import ADMISSION, Overloaded, DeadlineExceeded
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    """
+    Collect items submitted from many coroutines and run them through
+    batch_fn together.
+
+    batch_fn takes a list of items and must return a list of results in the
+    same order. It runs on a dedicated thread so the event loop stays free
+    while the model is busy. With concurrency > 1, up to that many batches
+    run at once (e.g. one per inference worker process).
+
+    With max_queue > 0, submit raises Overloaded instead of queueing more
+    than that many items. Items whose deadline has passed by the time their
+    batch is formed are failed with DeadlineExceeded and never reach the model.
+    """
+
+    def __init__(self, batch_fn, max_batch_size=8, max_wait_ms=10.0, name="batcher", concurrency=1, max_queue=0):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max(max_wait_ms, 0) / 1000.0
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queue = max(0, max_queue)
+
+        # One thread per batch in flight: with the default of 1 the model only
+        # ever sees one batch at a time
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=name)
+        self._queue = None
+        self._task = None
+        self._slots = None
+        self._running = set()
+
+    async def start(self):
+        """Start the background collection loop (call from the event loop)."""
+        if self._task is not None:
+            return
+        self._queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(self.concurrency)
+        queue = self._queue
+        QUEUE_DEPTH.set_function(queue.qsize, queue=self.name)
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Stop collecting and fail anything still waiting."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+        for task in list(self._running):
+            task.cancel()
+        if self._running:
+            await asyncio.gather(*self._running, return_exceptions=True)
+
+        queue = self._queue
+        while queue is not None and not queue.empty():
+            _, future, _ = queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError(f"{self.name} stopped"))
+
+        self._executor.shutdown(wait=False)
+
+    @property
+    def pending(self):
+        """Items queued and not yet in a batch."""
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def submit(self, item, deadline=None):
+        """
+        Queue one item and wait for its result. deadline is an event loop
+        time after which the item is dropped if its batch hasn't started.
+        """
+        queue = self._queue
+        if self._task is None or queue is None:
+            raise RuntimeError(f"{self.name} is not running")
+        if self.max_queue and queue.qsize() >= self.max_queue:
+            ADMISSION.inc(outcome="shed")
+            raise Overloaded(f"{self.name} queue is full")
+
+        future = asyncio.get_event_loop().create_future()
+        await queue.put((item, future, deadline))
+        return await future
+
+    async def _collect(self, queue):
+        """Wait for the first item, then gather more until the batch is full or the window closes."""
+        loop = asyncio.get_event_loop()
+        batch = [await queue.get()]
+        deadline = loop.time() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            # Take whatever is already waiting without sleeping
+            if not queue.empty():
+                batch.append(queue.get_nowait())
+                continue
+
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def _run(self):
+        # Both are created by start() before this task is scheduled
+        queue, slots = self._queue, self._slots
+        if queue is None or slots is None:
+            return
+        while True:
+            # Wait for a free slot before collecting, so items keep piling up
+            # into the next batch while every slot is busy
+            await slots.acquire()
+            try:
+                batch = await self._collect(queue)
+            except BaseException:
+                slots.release()
+                raise
+
+            # Skip callers that gave up while we were waiting, and drop items
+            # that are already past their deadline
+            now = asyncio.get_event_loop().time()
+            kept = []
+            for item, future, deadline in batch:
+                if future.done():
+                    continue
+                if deadline is not None and now >= deadline:
+                    ADMISSION.inc(outcome="expired")
+                    future.set_exception(DeadlineExceeded(f"Deadline passed while queued for {self.name}"))
+                    continue
+                kept.append((item, future))
+            batch = kept
+            if not batch:
+                slots.release()
+                continue
+
+            task = asyncio.ensure_future(self._dispatch(batch, slots))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _dispatch(self, batch, slots):
+        loop = asyncio.get_event_loop()
+        items = [item for item, _ in batch]
+        BATCH_SIZE.observe(len(items), batcher=self.name)
+        try:
+            results = await loop.run_in_executor(self._executor, self.batch_fn, items)
+            if len(results) != len(items):
+                raise RuntimeError(f"{self.name} returned {len(results)} results for {len(items)} items")
+        except asyncio.CancelledError:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(RuntimeError(f"{self.name} stopped"))
+            raise
+        except Exception as e:
+            logger.error(f"{self.name} batch of {len(items)} failed: {e}", exc_info=True)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            slots.release()
+
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
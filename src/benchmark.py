@@ -0,0 +1,688 @@
+# src/benchmark.py
+"""
+Benchmark suite for the pipeline.
+Measures per-stage and end-to-end latency percentiles, batch-size scaling,
+throughput of the FastAPI app at several concurrency levels and peak RSS,
+and writes everything as JSON so runs can be compared across commits.
+
+It runs offline: images are synthetic (a pink "conjunctiva" on a skin-toned
+background), and when a model file or its library is missing a small
+stand-in model is registered in its place, so stage timings still mean
+something even without the real weights. The report records which models
+were real.
+
+Usage:
+    python -m src.benchmark --output bench.json
+    python -m src.benchmark --output new.json --compare bench.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from src.config import (
+    YOLO_MODEL_PATH, KERAS_MODEL_PATH, PREPROCESS_ENGINE, CLASSIFIER_BACKEND, BASE_DIR,
+    GRADCAM_LAYER,
+)
+from src.models import registry
+from src.results_store import results_store
+from src.detector import decode_image, detect_boxes, crop_to_box, render_boxed
+from src.preprocess import ENGINES, preprocess_image
+from src.classifier import predict_probabilities, get_model, BACKEND_PATHS, KERAS_ENTRY
+from src.explain import predict_and_explain, render_heatmap, normalize_heatmaps
+from src.pipeline import run_pipeline
+from src.streaming import box_iou
+from src.quality import check_image
+from src.batch_runner import collect_image_paths
+
+DEFAULT_BATCH_SIZES = (1, 2, 4, 8, 16, 32)
+DEFAULT_CONCURRENCY = (1, 4, 16)
+DEFAULT_DETECT_REFERENCE = 1280
+
+
+# ---- synthetic input ----
+
+def synthetic_images(count, width=1600, height=1200, seed=0):
+    """
+    Encoded JPEGs of a pink ellipse on a noisy skin-toned background.
+    Returns a list of bytes. The same seed always gives the same images.
+    """
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(count):
+        skin = rng.integers(120, 200, size=3)
+        image = np.empty((height, width, 3), dtype=np.uint8)
+        image[:] = skin
+        noise = rng.normal(0, 12, size=(height, width, 1))
+        image = np.clip(image + noise, 0, 255).astype(np.uint8)
+
+        center = (int(rng.uniform(0.3, 0.7) * width), int(rng.uniform(0.4, 0.7) * height))
+        axes = (int(rng.uniform(0.15, 0.3) * width), int(rng.uniform(0.05, 0.12) * height))
+        pink = tuple(int(c) for c in (rng.integers(90, 150), rng.integers(60, 110), rng.integers(170, 240)))
+        cv2.ellipse(image, center, axes, 0, 0, 360, pink, -1)
+        image = cv2.GaussianBlur(image, (5, 5), 0)
+
+        ok, encoded = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, 90])
+        if not ok:
+            raise ValueError("Could not encode synthetic image")
+        images.append(encoded.tobytes())
+    return images
+
+
+# ---- stand-in models ----
+
+class _StandInBoxes:
+    """Just enough of ultralytics' Boxes for the detector code."""
+
+    def __init__(self, xyxy):
+        self.xyxy = np.asarray(xyxy, dtype=np.float32).reshape(-1, 4)
+        self.cls = np.zeros(len(self.xyxy), dtype=np.float32)
+        self.conf = np.ones(len(self.xyxy), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.xyxy)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield _StandInBoxes(self.xyxy[i:i + 1])
+
+
+class _StandInResult:
+    names = {0: "palpebral"}
+
+    def __init__(self, xyxy):
+        self.boxes = _StandInBoxes(xyxy)
+
+
+class StandInDetector:
+    """
+    Finds the pinkest region with a colour threshold on a downscaled copy,
+    the way YOLO looks at a resized image. Cheap, but it does real work per
+    image so batch and concurrency numbers still move.
+    """
+
+    def __init__(self, imgsz=640):
+        self.imgsz = imgsz
+
+    def _detect(self, image_bgr, imgsz):
+        h, w = image_bgr.shape[:2]
+        scale = imgsz / max(h, w)
+        small = cv2.resize(image_bgr, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+        b, g, r = cv2.split(small.astype(np.int16))
+        mask = (r - g > 40) & (r > b)
+        ys, xs = np.nonzero(mask)
+        if len(xs) == 0:
+            return _StandInResult([])
+        box = np.array([xs.min(), ys.min(), xs.max() + 1, ys.max() + 1], dtype=np.float32) / scale
+        return _StandInResult([box])
+
+    def predict(self, source, conf=0.25, imgsz=None, verbose=False):
+        # Like YOLO, take one image or a list of them
+        if isinstance(source, np.ndarray) and source.ndim == 3:
+            source = [source]
+        return [self._detect(image, imgsz or self.imgsz) for image in source]
+
+
+class StandInClassifier:
+    """NumPy stand-in with the Keras predict() signature (no gradients)."""
+
+    def predict(self, batch, verbose=0):
+        batch = np.asarray(batch, dtype=np.float32)
+        redness = batch[..., 0].mean(axis=(1, 2)) - batch[..., 1].mean(axis=(1, 2))
+        return (1.0 / (1.0 + np.exp(-4.0 * redness)))[:, None]
+
+
+def _build_keras_stand_in():
+    """
+    A tiny conv net with the classifier's input/output shape, so the
+    compiled Grad-CAM paths can be benchmarked without the real weights.
+    Like the real model, the conv layers sit in a nested base model named
+    GRADCAM_LAYER, followed by the head.
+    """
+    import tensorflow as tf
+
+    tf.random.set_seed(0)
+    base_inputs = tf.keras.Input(shape=(224, 224, 3))
+    x = tf.keras.layers.Conv2D(8, 3, strides=2, activation="relu")(base_inputs)
+    x = tf.keras.layers.Conv2D(16, 3, strides=2, activation="relu")(x)
+    base = tf.keras.Model(base_inputs, x, name=GRADCAM_LAYER)
+
+    inputs = tf.keras.Input(shape=(224, 224, 3))
+    x = tf.keras.layers.GlobalAveragePooling2D()(base(inputs))
+    outputs = tf.keras.layers.Dense(1, activation="sigmoid")(x)
+    return tf.keras.Model(inputs, outputs)
+
+
+def _importable(module):
+    try:
+        __import__(module)
+        return True
+    except ImportError:
+        return False
+
+
+def install_models(mode="auto"):
+    """
+    Make sure both registry entries can load. mode is "real" (use the
+    model files), "stand-in" (always use stand-ins) or "auto" (stand-ins
+    only where the file or its library is missing).
+    Returns {"detector": "real" | "stand-in", "classifier": ...}.
+    """
+    if mode not in ("auto", "real", "stand-in"):
+        raise ValueError(f"Unknown model mode: {mode}")
+
+    kinds = {}
+
+    use_real = mode == "real" or (mode == "auto" and YOLO_MODEL_PATH.exists() and _importable("ultralytics"))
+    if not use_real:
+        registry.register("detector", StandInDetector)
+    kinds["detector"] = "real" if use_real else "stand-in"
+
+    use_real = mode == "real" or (
+        mode == "auto" and BACKEND_PATHS[CLASSIFIER_BACKEND].exists() and KERAS_MODEL_PATH.exists()
+        and _importable("tensorflow")
+    )
+    if not use_real:
+        loader = _build_keras_stand_in if _importable("tensorflow") else StandInClassifier
+        # The stand-in serves both predictions and Grad-CAM
+        for name in {"classifier", KERAS_ENTRY}:
+            registry.register(name, loader, preload=name == "classifier")
+        kinds["classifier"] = "stand-in (keras)" if _importable("tensorflow") else "stand-in (numpy, no grad-cam)"
+    else:
+        kinds["classifier"] = f"real ({CLASSIFIER_BACKEND})"
+
+    return kinds
+
+
+# ---- measurement helpers ----
+
+def summarize(seconds):
+    """Latency percentiles in milliseconds for a list of durations."""
+    if not seconds:
+        return {"n": 0}
+    ms = np.asarray(seconds, dtype=np.float64) * 1000
+    return {
+        "n": int(len(ms)),
+        "mean_ms": float(ms.mean()),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p90_ms": float(np.percentile(ms, 90)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "max_ms": float(ms.max()),
+    }
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    value = fn(*args, **kwargs)
+    return value, time.perf_counter() - start
+
+
+def _explain_available():
+    try:
+        predict_and_explain(get_model(), np.zeros((1, 224, 224, 3), dtype=np.float32))
+        return True
+    except Exception:
+        return False
+
+
+# ---- benchmarks ----
+
+def bench_stages(images, output_dir, iterations=1):
+    """
+    Time each stage on its own, one image at a time.
+    """
+    samples = {}
+    explain = _explain_available()
+
+    def add(stage, seconds):
+        samples.setdefault(stage, []).append(seconds)
+
+    for _ in range(iterations):
+        for i, data in enumerate(images):
+            image_bgr, seconds = _timed(decode_image, data)
+            add("decode", seconds)
+
+            _, seconds = _timed(check_image, image_bgr)
+            add("quality_gate", seconds)
+
+            (box,), seconds = _timed(detect_boxes, [image_bgr])
+            add("detect", seconds)
+
+            crop_rgb, seconds = _timed(crop_to_box, image_bgr, box)
+            add("crop", seconds)
+
+            for engine in ENGINES:
+                _, seconds = _timed(preprocess_image, crop_rgb, engine=engine)
+                add(f"preprocess[{engine}]", seconds)
+            tensor = preprocess_image(crop_rgb)
+
+            _, seconds = _timed(predict_probabilities, tensor)
+            add("classify", seconds)
+
+            _, seconds = _timed(render_boxed, image_bgr, box, output_dir / f"boxed_{i}.jpg")
+            add("render_boxed", seconds)
+
+            if explain:
+                (_, grad_maps), seconds = _timed(predict_and_explain, get_model(), tensor)
+                add("predict_and_explain", seconds)
+
+                _, seconds = _timed(render_heatmap, grad_maps[0], crop_rgb, output_dir / f"heatmap_{i}.jpg")
+                add("render_heatmap", seconds)
+
+    return {stage: summarize(values) for stage, values in samples.items()}
+
+
+def bench_end_to_end(paths, iterations=1):
+    """
+    Time run_pipeline (the CLI path) with and without Grad-CAM.
+    """
+    report = {}
+    modes = (False, True) if _explain_available() else (False,)
+    for explain in modes:
+        samples = []
+        for _ in range(iterations):
+            for path in paths:
+                _, seconds = _timed(run_pipeline, path, explain=explain)
+                samples.append(seconds)
+        report["explain" if explain else "plain"] = summarize(samples)
+    return report
+
+
+def bench_memory(paths):
+    """
+    Peak Python/NumPy allocations (tracemalloc) during one run_pipeline
+    call per image, i.e. how much memory a single request needs on top of
+    the loaded models.
+    """
+    peaks = []
+    tracemalloc.start()
+    try:
+        for path in paths:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            run_pipeline(path)
+            peaks.append((tracemalloc.get_traced_memory()[1] - baseline) / (1024 * 1024))
+    finally:
+        tracemalloc.stop()
+    return {
+        "n": len(peaks),
+        "mean_mb": float(np.mean(peaks)) if peaks else None,
+        "max_mb": float(np.max(peaks)) if peaks else None,
+    }
+
+
+# Runs in a fresh interpreter so nothing is imported or loaded yet
+_STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import src.api
+imported = time.perf_counter()
+from src.benchmark import install_models
+from src.models import registry
+models = install_models(sys.argv[1])
+registry.load_all(warm=True)
+ready = time.perf_counter()
+print(json.dumps({
+    "import_seconds": imported - start,
+    "ready_seconds": ready - start,
+    "models": models,
+    "load": registry.status(),
+}))
+"""
+
+
+def bench_startup(models_mode="auto", repeats=3):
+    """
+    Cold start of the API in a new process: how long importing src.api
+    takes (the server accepts requests after this) and how long until every
+    model is loaded and warm (when /ready turns 200).
+    """
+    runs = []
+    for _ in range(repeats):
+        completed = subprocess.run(
+            [sys.executable, "-c", _STARTUP_SCRIPT, models_mode],
+            cwd=BASE_DIR, capture_output=True, text=True,
+        )
+        if completed.returncode != 0:
+            return {"error": completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else "failed"}
+        runs.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+
+    return {
+        "import": summarize([run["import_seconds"] for run in runs]),
+        "ready": summarize([run["ready_seconds"] for run in runs]),
+        "models": runs[-1]["models"],
+        "load": runs[-1]["load"],
+    }
+
+
+def bench_batch_scaling(images, batch_sizes=DEFAULT_BATCH_SIZES, repeats=3):
+    """
+    Time the detector and classifier on batches of increasing size.
+    """
+    decoded = [decode_image(data) for data in images]
+    boxes = detect_boxes(decoded)
+    tensors = np.concatenate([preprocess_image(crop_to_box(image, box)) for image, box in zip(decoded, boxes)])
+    explain = _explain_available()
+
+    report = {}
+    for size in batch_sizes:
+        # Repeat the inputs if there are fewer images than the batch size
+        index = np.arange(size) % len(decoded)
+        image_batch = [decoded[i] for i in index]
+        tensor_batch = tensors[index]
+
+        stages = {
+            "detect": lambda: detect_boxes(image_batch),
+            "classify": lambda: predict_probabilities(tensor_batch),
+        }
+        if explain:
+            stages["predict_and_explain"] = lambda: predict_and_explain(get_model(), tensor_batch, "gradients")
+            stages["predict_and_explain[conv]"] = lambda: predict_and_explain(get_model(), tensor_batch, "conv")
+            stages["normalize_heatmaps"] = lambda: normalize_heatmaps(np.abs(tensor_batch[..., 0]))
+
+        row = {}
+        for stage, fn in stages.items():
+            fn()  # first call at a new batch size may retrace
+            samples = [_timed(fn)[1] for _ in range(repeats)]
+            median = float(np.median(samples))
+            row[stage] = {
+                "ms_per_batch": median * 1000,
+                "ms_per_image": median * 1000 / size,
+                "images_per_sec": size / median if median > 0 else None,
+            }
+        report[str(size)] = row
+    return report
+
+
+def bench_detect_sizes(images, sizes, reference_size=DEFAULT_DETECT_REFERENCE, repeats=3):
+    """
+    Accuracy/latency of the detector at several input sizes. Boxes are
+    compared with the ones found at reference_size: "agreement" is the
+    share of images where both find nothing or the boxes overlap with
+    IoU >= 0.5.
+    """
+    decoded = [decode_image(data) for data in images]
+    reference = detect_boxes(decoded, imgsz=reference_size)
+
+    report = {}
+    for size in sorted(sizes):
+        detect_boxes(decoded[:1], imgsz=size)  # warm up this size
+        samples = []
+        boxes = []
+        for _ in range(repeats):
+            boxes = []
+            for image in decoded:
+                (box,), seconds = _timed(detect_boxes, [image], imgsz=size)
+                samples.append(seconds)
+                boxes.append(box)
+
+        ious = [box_iou(box, ref) for box, ref in zip(boxes, reference) if box is not None and ref is not None]
+        agree = [
+            (box is None and ref is None) or (box is not None and ref is not None and box_iou(box, ref) >= 0.5)
+            for box, ref in zip(boxes, reference)
+        ]
+        report[str(size)] = dict(
+            summarize(samples),
+            detected=float(np.mean([box is not None for box in boxes])),
+            mean_iou=float(np.mean(ious)) if ious else None,
+            agreement=float(np.mean(agree)),
+        )
+    return {"reference_size": reference_size, "sizes": report}
+
+
+async def _bench_api_async(images, concurrency_levels, requests_per_level, explain):
+    import httpx
+    import src.api as api
+    from src.cache import ResultCache
+
+    # Every request should run the pipeline, not hit the cache
+    api.result_cache = ResultCache(max_entries=0)
+
+    report = {}
+    # Run the app's startup/shutdown hooks (batchers, sweepers) around the
+    # requests, with the job database in a throwaway folder
+    jobs_root = api.job_store.root
+    api.job_store.root = Path(tempfile.mkdtemp(prefix="anemo-bench-jobs-"))
+    try:
+        async with api.app.router.lifespan_context(api.app):
+            transport = httpx.ASGITransport(app=api.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+                for concurrency in concurrency_levels:
+                    semaphore = asyncio.Semaphore(concurrency)
+                    latencies = []
+                    statuses = {}
+
+                    async def one(i):
+                        data = images[i % len(images)]
+                        async with semaphore:
+                            start = time.perf_counter()
+                            response = await client.post(
+                                "/predict",
+                                params={"explain": str(explain).lower()},
+                                files={"file": (f"bench_{i}.jpg", data, "image/jpeg")},
+                            )
+                            latencies.append(time.perf_counter() - start)
+                        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+                    start = time.perf_counter()
+                    await asyncio.gather(*[one(i) for i in range(requests_per_level)])
+                    seconds = time.perf_counter() - start
+
+                    report[str(concurrency)] = dict(
+                        summarize(latencies),
+                        requests_per_sec=requests_per_level / seconds if seconds > 0 else None,
+                        statuses={str(code): count for code, count in sorted(statuses.items())},
+                    )
+    finally:
+        shutil.rmtree(api.job_store.root, ignore_errors=True)
+        api.job_store.root = jobs_root
+    return report
+
+
+def bench_api(images, concurrency_levels=DEFAULT_CONCURRENCY, requests_per_level=32, explain=False):
+    """
+    Throughput and latency of POST /predict, in process, at each concurrency
+    level (micro-batching kicks in above 1). Needs httpx.
+    """
+    if not _importable("httpx"):
+        return {"skipped": "httpx is not installed"}
+    return asyncio.run(_bench_api_async(images, concurrency_levels, requests_per_level, explain))
+
+
+# ---- report ----
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(args):
+    models = install_models(args.models)
+
+    # Inputs go to a temp folder, and result images to their own subfolder
+    # of static/results (the API turns them into /static URLs); both are
+    # removed afterwards
+    workdir = Path(tempfile.mkdtemp(prefix="anemo-bench-"))
+    results_root = results_store.root
+    results_store.root = results_root / f"benchmark-{os.getpid()}"
+
+    try:
+        return _run_sections(args, models, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        shutil.rmtree(results_store.root, ignore_errors=True)
+        results_store.root = results_root
+
+
+def _run_sections(args, models, workdir):
+    report = {
+        "meta": {
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "models": models,
+            "preprocess_engine": PREPROCESS_ENGINE,
+            "classifier_backend": CLASSIFIER_BACKEND,
+            "images": args.images,
+            "input_dir": args.input_dir,
+            "image_size": [args.width, args.height],
+            "iterations": args.iterations,
+        },
+        "peak_rss_mb": {},
+    }
+
+    if args.input_dir:
+        images = [path.read_bytes() for path in collect_image_paths(args.input_dir, args.glob)[:args.images]]
+        if not images:
+            raise ValueError(f"No images found in {args.input_dir}")
+    else:
+        images = synthetic_images(args.images, args.width, args.height, args.seed)
+    paths = []
+    for i, data in enumerate(images):
+        path = workdir / f"bench_{i}.jpg"
+        path.write_bytes(data)
+        paths.append(path)
+    report["peak_rss_mb"]["start"] = peak_rss_mb()
+
+    start = time.perf_counter()
+    registry.load_all(warm=True)
+    report["load"] = dict(registry.status(), total_seconds=time.perf_counter() - start)
+    report["peak_rss_mb"]["load"] = peak_rss_mb()
+
+    sections = [
+        ("stages", lambda: bench_stages(images, workdir, args.iterations)),
+        ("end_to_end", lambda: bench_end_to_end(paths, args.iterations)),
+        ("memory", lambda: bench_memory(paths)),
+        ("batch_scaling", lambda: bench_batch_scaling(images, args.batch_sizes, args.repeats)),
+        ("api", lambda: bench_api(images, args.concurrency, args.requests, args.explain)),
+        ("detect_sizes", lambda: bench_detect_sizes(images, args.detect_sizes, args.detect_reference, args.repeats)),
+        ("startup", lambda: bench_startup(args.models, args.repeats)),
+    ]
+    for name, fn in sections:
+        if name in args.skip or (name == "detect_sizes" and not args.detect_sizes):
+            continue
+        print(f"Running {name}...")
+        report[name] = fn()
+        report["peak_rss_mb"][name] = peak_rss_mb()
+
+    return report
+
+
+def _p50s(report):
+    """Flatten every p50 in a report to {"section/key": ms}."""
+    flat = {}
+    for section in ("stages", "end_to_end", "api"):
+        for key, stats in report.get(section, {}).items():
+            if isinstance(stats, dict) and "p50_ms" in stats:
+                flat[f"{section}/{key}"] = stats["p50_ms"]
+    return flat
+
+
+def compare(report, baseline):
+    """
+    Relative change in p50 latency against a baseline report.
+    Returns {"section/key": {"baseline_ms", "current_ms", "change"}}.
+    """
+    current, previous = _p50s(report), _p50s(baseline)
+    return {
+        key: {
+            "baseline_ms": previous[key],
+            "current_ms": current[key],
+            "change": (current[key] - previous[key]) / previous[key] if previous[key] else None,
+        }
+        for key in sorted(current)
+        if key in previous
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages, batching and API")
+    parser.add_argument("--output", help="Write the report as JSON to this file")
+    parser.add_argument("--compare", help="Baseline JSON report to compare p50 latencies against")
+    parser.add_argument("--models", default="auto", choices=["auto", "real", "stand-in"],
+                        help="Use the real models, stand-ins, or stand-ins only where files are missing")
+    parser.add_argument("--images", type=int, default=8, help="Number of images to use")
+    parser.add_argument("--input-dir", help="Use real sample images from this folder instead of synthetic ones")
+    parser.add_argument("--glob", default="*", help="Pattern for files inside --input-dir")
+    parser.add_argument("--width", type=int, default=1600)
+    parser.add_argument("--height", type=int, default=1200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--iterations", type=int, default=3, help="Passes over the images for stage timings")
+    parser.add_argument("--repeats", type=int, default=3, help="Timed calls per batch size")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=list(DEFAULT_BATCH_SIZES))
+    parser.add_argument("--concurrency", type=int, nargs="+", default=list(DEFAULT_CONCURRENCY))
+    parser.add_argument("--requests", type=int, default=32, help="Requests per concurrency level")
+    parser.add_argument("--explain", action="store_true", help="Ask for Grad-CAM in the API benchmark")
+    parser.add_argument("--detect-sizes", type=int, nargs="*", default=[],
+                        help="Detector input sizes to compare for accuracy/latency (e.g. 320 416 512 640)")
+    parser.add_argument("--detect-reference", type=int, default=DEFAULT_DETECT_REFERENCE,
+                        help="Input size whose boxes count as ground truth for --detect-sizes")
+    parser.add_argument("--skip", nargs="*", default=[],
+                        choices=["stages", "end_to_end", "memory", "batch_scaling", "api", "detect_sizes", "startup"],
+                        help="Sections to leave out")
+    args = parser.parse_args()
+
+    report = run_benchmarks(args)
+
+    print(f"\nModels: {report['meta']['models']}")
+    for section in ("stages", "end_to_end", "api"):
+        for key, stats in report.get(section, {}).items():
+            if isinstance(stats, dict) and "p50_ms" in stats:
+                print(f"  {section + '/' + key:<32} p50 {stats['p50_ms']:9.2f}ms  p99 {stats['p99_ms']:9.2f}ms")
+    print(f"  peak RSS {max(report['peak_rss_mb'].values()):.1f} MB")
+    if report.get("memory", {}).get("n"):
+        print(f"  per-request peak {report['memory']['mean_mb']:.1f} MB mean, {report['memory']['max_mb']:.1f} MB max")
+
+    startup = report.get("startup", {})
+    if "ready" in startup:
+        print(f"  cold start: import {startup['import']['p50_ms']:.0f}ms, models ready {startup['ready']['p50_ms']:.0f}ms")
+
+    if "detect_sizes" in report:
+        print(f"\nDetector input size vs {report['detect_sizes']['reference_size']}px reference:")
+        print(f"  {'imgsz':>6} {'p50 ms':>9} {'detected':>9} {'mean IoU':>9} {'agreement':>10}")
+        for size, row in report["detect_sizes"]["sizes"].items():
+            mean_iou = f"{row['mean_iou']:.3f}" if row["mean_iou"] is not None else "-"
+            print(f"  {size:>6} {row['p50_ms']:9.2f} {row['detected']:9.2f} {mean_iou:>9} {row['agreement']:10.2f}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            report["comparison"] = compare(report, json.load(f))
+        print(f"\nChange in p50 vs {args.compare}:")
+        for key, row in report["comparison"].items():
+            if row["change"] is not None:
+                print(f"  {key:<32} {row['change'] * 100:+7.1f}%")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nSaved report to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+# src/cache.py
+"""
+Content-addressed cache for pipeline results.
+Repeated uploads of the same photo (retakes, page refreshes) are answered
+from the cache instead of rerunning detection, classification and Grad-CAM.
+
+Entries are keyed on the SHA-256 of the uploaded bytes plus everything that
+changes the output (model versions, preprocessing engine, explain flag).
+There is an in-memory LRU tier and an optional on-disk tier that keeps its
+own copies of the boxed/heatmap images and evicts the least recently used
+entries once it goes over its size budget.
+"""
+
+import hashlib
+import json
+import logging
+import shutil
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Result keys that point at image files
+ARTIFACT_KEYS = ("boxed_image_path", "heatmap_path")
+
+
+def make_cache_key(content_hash, model_versions, **options):
+    """
+    Combine the upload hash with model versions and request options.
+    """
+    parts = [content_hash]
+    parts += [f"{name}={version}" for name, version in sorted(model_versions.items())]
+    parts += [f"{name}={value}" for name, value in sorted(options.items())]
+    return hashlib.sha256("|".join(parts).encode()).hexdigest()
+
+
+def _artifacts_exist(result):
+    return all(Path(result[key]).exists() for key in ARTIFACT_KEYS if result.get(key))
+
+
+class ResultCache:
+    """
+    Two-tier (memory LRU + optional disk) cache of pipeline result dicts.
+    """
+
+    def __init__(self, max_entries=512, disk_dir=None, disk_max_bytes=0):
+        self.max_entries = max_entries
+        self.disk_dir = Path(disk_dir) if disk_dir is not None and disk_max_bytes > 0 else None
+        self.disk_max_bytes = disk_max_bytes
+
+        self._memory = OrderedDict()
+        # key -> bytes used on disk, oldest access first
+        self._disk_index = OrderedDict()
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+
+        self.stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "memory_evictions": 0,
+            "disk_evictions": 0,
+        }
+
+        if self.disk_dir is not None:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+            self._load_disk_index()
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0 or self.disk_dir is not None
+
+    # ---- disk helpers ----
+
+    def _entry_dir(self, key):
+        # Shard by the first two hex characters to keep directories small
+        return self.disk_dir / key[:2]
+
+    def _entry_files(self, key):
+        return sorted(self._entry_dir(key).glob(f"{key}*"))
+
+    def _load_disk_index(self):
+        if self.disk_dir is None:
+            return
+        entries = []
+        for meta_path in self.disk_dir.glob("*/*.json"):
+            key = meta_path.stem
+            size = sum(p.stat().st_size for p in self._entry_files(key))
+            entries.append((meta_path.stat().st_mtime, key, size))
+
+        for _, key, size in sorted(entries):
+            self._disk_index[key] = size
+            self._disk_bytes += size
+
+    def _disk_get(self, key):
+        meta_path = self._entry_dir(key) / f"{key}.json"
+        try:
+            result = json.loads(meta_path.read_text())
+        except (OSError, ValueError):
+            return None
+
+        if not _artifacts_exist(result):
+            self._disk_remove(key)
+            return None
+
+        # Mark as recently used
+        meta_path.touch()
+        self._disk_index.move_to_end(key)
+        return result
+
+    def _disk_put(self, key, result):
+        entry_dir = self._entry_dir(key)
+        entry_dir.mkdir(parents=True, exist_ok=True)
+
+        # Keep our own copies of the images so the entry outlives the originals
+        stored = dict(result)
+        for artifact_key in ARTIFACT_KEYS:
+            source = result.get(artifact_key)
+            if not source:
+                continue
+            source = Path(source)
+            target = entry_dir / f"{key}_{artifact_key.split('_')[0]}{source.suffix}"
+            shutil.copyfile(source, target)
+            stored[artifact_key] = str(target)
+
+        (entry_dir / f"{key}.json").write_text(json.dumps(stored))
+
+        size = sum(p.stat().st_size for p in self._entry_files(key))
+        self._disk_bytes += size - self._disk_index.pop(key, 0)
+        self._disk_index[key] = size
+        self._evict_disk()
+        return stored
+
+    def _disk_remove(self, key):
+        for path in self._entry_files(key):
+            path.unlink(missing_ok=True)
+        self._disk_bytes -= self._disk_index.pop(key, 0)
+
+    def _evict_disk(self):
+        while self._disk_bytes > self.disk_max_bytes and len(self._disk_index) > 1:
+            oldest = next(iter(self._disk_index))
+            self._disk_remove(oldest)
+            self.stats["disk_evictions"] += 1
+
+    # ---- public API ----
+
+    def get(self, key):
+        """
+        Return a copy of the cached result, or None on a miss.
+        Entries whose image files have disappeared count as misses.
+        """
+        with self._lock:
+            result = self._memory.get(key)
+            if result is not None:
+                if _artifacts_exist(result):
+                    self._memory.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    return dict(result)
+                del self._memory[key]
+
+            if self.disk_dir is not None and key in self._disk_index:
+                result = self._disk_get(key)
+                if result is not None:
+                    self._memory_put(key, result)
+                    self.stats["disk_hits"] += 1
+                    return dict(result)
+
+            self.stats["misses"] += 1
+            return None
+
+    def _memory_put(self, key, result):
+        if self.max_entries <= 0:
+            return
+        self._memory[key] = result
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.stats["memory_evictions"] += 1
+
+    def put(self, key, result):
+        """
+        Store a result. With the disk tier on, the memory entry points at
+        the disk copies of the images.
+        """
+        with self._lock:
+            stored = dict(result)
+            if self.disk_dir is not None:
+                try:
+                    stored = self._disk_put(key, result)
+                except OSError as e:
+                    logger.warning(f"Could not write cache entry to disk: {e}")
+            self._memory_put(key, stored)
+
+    def snapshot(self):
+        """Counters plus current sizes, for monitoring."""
+        with self._lock:
+            lookups = self.stats["memory_hits"] + self.stats["disk_hits"] + self.stats["misses"]
+            hits = lookups - self.stats["misses"]
+            return dict(
+                self.stats,
+                hit_rate=hits / lookups if lookups else 0.0,
+                memory_entries=len(self._memory),
+                disk_entries=len(self._disk_index),
+                disk_bytes=self._disk_bytes,
+            )
@@ -0,0 +1,384 @@
+# src/cascade.py
+"""
+Two-stage cascade: a fast color-feature classifier ahead of the CNN.
+Conjunctival pallor shows up in plain color statistics (how red the
+tissue is against its green channel, where its Lab a* values sit), so a
+small gradient-boosted model on those features can settle the clear-cut
+cases in about a millisecond. Only crops it is unsure about go on to
+preprocessing and MobileNetV2.
+
+The model is trained and its thresholds calibrated offline:
+    python -m src.cascade train --manifest train.csv
+    python -m src.cascade calibrate --manifest val.csv --min-precision 0.97
+
+Both also take --store with a feature store folder (src.feature_store)
+instead of a manifest, reusing its stored crops.
+
+Manifests are CSV files with "path" and "label" columns (ANEMIC /
+NON-ANEMIC, or 1 / 0). Calibration picks the widest thresholds at which
+the cascade's own calls are still at least --min-precision correct, and
+reports how many requests it would short-circuit and what that does to
+accuracy compared with running the CNN on everything.
+"""
+
+import argparse
+import json
+import logging
+import time
+
+import cv2
+import numpy as np
+
+from src.config import CASCADE, CASCADE_MODEL_PATH, CASCADE_THRESHOLDS_PATH
+from src.models import registry
+from src.classifier import label_from_probability
+from src.metrics import metrics, stage_timer
+
+logger = logging.getLogger(__name__)
+
+CASCADE_DECISIONS = metrics.counter(
+    "anemo_cascade",
+    "Cascade outcomes (anemic / non_anemic answered by the color model, deferred to the CNN, error)",
+    ["outcome"],
+)
+
+FEATURE_NAMES = (
+    ["mean_r", "mean_g", "mean_b", "std_r", "std_g", "std_b", "ratio_rg", "ratio_rb", "ratio_gb",
+     "erythema_mean", "erythema_p25", "erythema_p75", "lab_l", "lab_a", "lab_b"]
+    + [f"a_hist_{i}" for i in range(8)]
+)
+
+# Color statistics don't need every pixel: every 2nd row and column
+FEATURE_STEP = 2
+
+LEVELS = np.arange(256, dtype=np.float64)
+LOG_LEVELS = np.log10(LEVELS + 1)
+# Lab a* (8-bit, 128 = neutral) histogram: 8 bins of 10 from pale pink (112)
+# to deep red (192), the ends catching everything beyond
+A_BINS = np.eye(8)[np.clip((np.arange(256) - 112) // 10, 0, 7)]
+
+
+def color_features(crops_rgb):
+    """
+    Color statistics for a batch of RGB crops ((N, H, W, 3) uint8, or a
+    single crop), as an (N, len(FEATURE_NAMES)) float32 array.
+    Everything comes from one 256-level histogram per channel (R, G, B,
+    L, a, b), built for the whole batch with a single bincount.
+    """
+    crops_rgb = np.asarray(crops_rgb)
+    if crops_rgb.ndim == 3:
+        crops_rgb = crops_rgb[None]
+    crops_rgb = np.ascontiguousarray(crops_rgb[:, ::FEATURE_STEP, ::FEATURE_STEP])
+    n, h, w, _ = crops_rgb.shape
+
+    # One cvtColor call for the whole batch, stacked into one tall image
+    lab = cv2.cvtColor(crops_rgb.reshape(n * h, w, 3), cv2.COLOR_RGB2LAB).reshape(n, h * w, 3)
+
+    # Offset each crop's channels into their own 256 bins
+    levels = np.concatenate([crops_rgb.reshape(n, h * w, 3), lab], axis=2).astype(np.intp)
+    levels += np.arange(n * 6).reshape(n, 1, 6) * 256
+    hist = np.bincount(levels.ravel(), minlength=n * 6 * 256).reshape(n, 6, 256) / (h * w)
+
+    means = hist @ LEVELS
+    stds = np.sqrt(np.maximum(hist @ LEVELS ** 2 - means ** 2, 0))
+    r, g, b = means[:, 0] + 1, means[:, 1] + 1, means[:, 2] + 1
+
+    # Erythema index log10(R + 1) - log10(G + 1): the mean comes straight from
+    # the histograms, the quartiles need the per-pixel values
+    log_means = hist[:, :2] @ LOG_LEVELS
+    erythema = LOG_LEVELS[crops_rgb[..., 0]] - LOG_LEVELS[crops_rgb[..., 1]]
+    erythema_p25, erythema_p75 = np.percentile(erythema.reshape(n, -1), [25, 75], axis=1)
+
+    return np.column_stack([
+        means[:, :3], stds[:, :3],
+        r / g, r / b, g / b,
+        log_means[:, 0] - log_means[:, 1], erythema_p25, erythema_p75,
+        means[:, 3:],
+        hist[:, 4] @ A_BINS,
+    ]).astype(np.float32)
+
+
+class CascadeModel:
+    """
+    The color model plus its calibrated thresholds. Probabilities at or
+    above high are answered as ANEMIC, at or below low as NON-ANEMIC;
+    None turns that side off.
+    """
+
+    def __init__(self, model, low=None, high=None):
+        self.model = model
+        self.low = low
+        self.high = high
+
+    def probabilities(self, features):
+        return self.model.predict_proba(features)[:, 1]
+
+    def decide(self, probability):
+        """ANEMIC / NON-ANEMIC if the probability is past a threshold, else None."""
+        if self.high is not None and probability >= self.high:
+            return "ANEMIC"
+        if self.low is not None and probability <= self.low:
+            return "NON-ANEMIC"
+        return None
+
+
+def _load_xgboost(model_path):
+    import xgboost
+
+    model = xgboost.XGBClassifier()
+    model.load_model(str(model_path))
+    # Single crops: threads only add overhead
+    model.set_params(n_jobs=1)
+    return model
+
+
+def load_thresholds(path=CASCADE_THRESHOLDS_PATH):
+    with open(path) as f:
+        thresholds = json.load(f)
+    return thresholds.get("low"), thresholds.get("high")
+
+
+def _load_cascade():
+    if not CASCADE_MODEL_PATH.exists() or not CASCADE_THRESHOLDS_PATH.exists():
+        raise RuntimeError(
+            f"Cascade needs {CASCADE_MODEL_PATH} and {CASCADE_THRESHOLDS_PATH} "
+            f"(python -m src.cascade train / calibrate)"
+        )
+    low, high = load_thresholds()
+    logger.info(f"Loading cascade model from {CASCADE_MODEL_PATH} (low={low}, high={high})")
+    return CascadeModel(_load_xgboost(CASCADE_MODEL_PATH), low, high)
+
+
+def _warm_up(cascade):
+    cascade.probabilities(color_features(np.zeros((1, 224, 224, 3), dtype=np.uint8)))
+
+
+# Versioned by the thresholds file, which calibrate rewrites after every training run
+registry.register("cascade", _load_cascade, _warm_up, source=CASCADE_THRESHOLDS_PATH, preload=CASCADE)
+
+
+def try_cascade(crop_rgb):
+    """
+    Score one 224x224 RGB crop with the color model.
+    Returns (label, confidence) when it is confident, or None when the
+    CNN should decide (including when the cascade isn't available).
+    """
+    try:
+        cascade = registry.get("cascade")
+        with stage_timer("cascade"):
+            probability = float(cascade.probabilities(color_features(crop_rgb))[0])
+    except Exception as e:
+        logger.error(f"Cascade failed, using the CNN: {e}")
+        CASCADE_DECISIONS.inc(outcome="error")
+        return None
+
+    label = cascade.decide(probability)
+    CASCADE_DECISIONS.inc(outcome="deferred" if label is None else label.lower().replace("-", "_"))
+    return None if label is None else label_from_probability(probability)
+
+
+# ---- training and calibration ----
+
+def _labeled_crops(manifest, batch_size):
+    from src.batch_runner import load_labeled_manifest
+    from src.preprocess_parity import load_crops
+
+    paths, labels = load_labeled_manifest(manifest)
+    crops, used = load_crops(paths, batch_size)
+    if crops is None:
+        raise ValueError(f"No usable crops in {manifest}")
+    label_of = dict(zip(paths, labels))
+    return crops, np.array([label_of[path] for path in used], dtype=np.int32)
+
+
+def _store_rows(store):
+    # Labeled rows with a crop in a feature store
+    rows = np.flatnonzero(store.ok & (store.labels >= 0))
+    if len(rows) == 0:
+        raise ValueError(f"No labeled usable crops in {store.path}")
+    return rows
+
+
+def train(crops, labels, model_path=CASCADE_MODEL_PATH, **params):
+    """Fit the gradient-boosted model on color features and save it as JSON."""
+    import xgboost
+
+    settings = dict(n_estimators=200, max_depth=3, learning_rate=0.1, subsample=0.8,
+                    colsample_bytree=0.8, eval_metric="logloss")
+    settings.update(params)
+    model = xgboost.XGBClassifier(**settings)
+    model.fit(color_features(crops), labels)
+    model.save_model(str(model_path))
+    return model
+
+
+def _side_threshold(probs, labels, min_precision, anemic):
+    """
+    The loosest threshold on one side whose calls are still at least
+    min_precision correct, or None if no threshold is good enough.
+    Thresholds stay on their own side of 0.5, so the cascade's label is
+    always the one its probability gives.
+    """
+    order = np.argsort(-probs if anemic else probs, kind="stable")
+    sorted_probs = probs[order]
+    correct = (labels[order] == (1 if anemic else 0)).astype(np.float64)
+    precision = np.cumsum(correct) / np.arange(1, len(correct) + 1)
+
+    # Only cut between different probabilities, so ties land on one side
+    cuts = np.append(sorted_probs[1:] != sorted_probs[:-1], True)
+    own_side = sorted_probs >= 0.5 if anemic else sorted_probs < 0.5
+    good = np.flatnonzero(cuts & own_side & (precision >= min_precision))
+    if len(good) == 0:
+        return None
+    return float(sorted_probs[good[-1]])
+
+
+def evaluate(cascade_probs, cnn_probs, labels, low, high):
+    """
+    What the cascade with these thresholds would have done on a labeled set:
+    the share it answers itself, how accurate those answers are (next to
+    the CNN's on the same images) and the overall accuracy against the CNN
+    alone.
+    """
+    cascade = CascadeModel(None, low, high)
+    decided = np.array([cascade.decide(p) is not None for p in cascade_probs])
+    final = np.where(decided, cascade_probs, cnn_probs) >= 0.5
+    cnn_correct = (cnn_probs >= 0.5) == labels
+    cascade_correct = (cascade_probs >= 0.5) == labels
+    return {
+        "low": low,
+        "high": high,
+        "short_circuit": float(decided.mean()),
+        "cascade_accuracy": float(cascade_correct[decided].mean()) if decided.any() else None,
+        "cnn_accuracy_same_images": float(cnn_correct[decided].mean()) if decided.any() else None,
+        "accuracy": float((final == labels).mean()),
+        "cnn_only_accuracy": float(cnn_correct.mean()),
+        "accuracy_change": float((final == labels).mean() - cnn_correct.mean()),
+    }
+
+
+def calibrate(cascade_probs, cnn_probs, labels, min_precision):
+    """Thresholds for min_precision, with evaluate's report for them."""
+    low = _side_threshold(cascade_probs, labels, min_precision, anemic=False)
+    high = _side_threshold(cascade_probs, labels, min_precision, anemic=True)
+    return evaluate(cascade_probs, cnn_probs, labels, low, high)
+
+
+def _cnn_probabilities(crops, batch_size):
+    from src.preprocess import preprocess_batch
+    from src.classifier import predict_probabilities
+
+    tensors = np.empty(crops.shape, dtype=np.float32)
+    probs = []
+    start = time.perf_counter()
+    for i in range(0, len(crops), batch_size):
+        batch = preprocess_batch(crops[i:i + batch_size], out=tensors[i:i + batch_size])
+        if batch is None:
+            raise ValueError(f"Preprocessing failed on batch starting at {i}")
+        probs.append(predict_probabilities(batch))
+    return np.concatenate(probs), (time.perf_counter() - start) / len(crops)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train and calibrate the color-feature cascade")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    train_parser = commands.add_parser("train", help="Fit the color model on a labeled manifest")
+    train_input = train_parser.add_mutually_exclusive_group(required=True)
+    train_input.add_argument("--manifest", help="CSV with path and label columns")
+    train_input.add_argument("--store", help="Feature store folder (python -m src.feature_store build)")
+    train_parser.add_argument("--model", default=str(CASCADE_MODEL_PATH), help="Where to save the model")
+    train_parser.add_argument("--batch-size", type=int, default=16)
+    train_parser.add_argument("--n-estimators", type=int, default=200)
+    train_parser.add_argument("--max-depth", type=int, default=3)
+
+    cal_parser = commands.add_parser("calibrate", help="Pick thresholds on a held-out labeled manifest")
+    cal_input = cal_parser.add_mutually_exclusive_group(required=True)
+    cal_input.add_argument("--manifest", help="CSV with path and label columns (not the training set)")
+    cal_input.add_argument("--store", help="Feature store folder of a held-out set; skips detection and preprocessing")
+    cal_parser.add_argument("--model", default=str(CASCADE_MODEL_PATH))
+    cal_parser.add_argument("--thresholds", default=str(CASCADE_THRESHOLDS_PATH), help="Where to save the thresholds")
+    cal_parser.add_argument("--min-precision", type=float, default=0.97,
+                            help="Share of the cascade's own answers that must be correct")
+    cal_parser.add_argument("--sweep", type=float, nargs="*", default=[0.9, 0.95, 0.97, 0.99],
+                            help="Other precision targets to show in the report")
+    cal_parser.add_argument("--batch-size", type=int, default=16)
+    cal_parser.add_argument("--output", help="Write the report as JSON to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    store = None
+    if args.store:
+        from src.feature_store import FeatureStore
+
+        store = FeatureStore(args.store)
+        rows = _store_rows(store)
+        crops, labels = store.crops[rows], store.labels[rows]
+
+    if args.command == "train":
+        if store is None:
+            crops, labels = _labeled_crops(args.manifest, args.batch_size)
+        print(f"Training on {len(labels)} crops ({int(labels.sum())} anemic)")
+        train(crops, labels, args.model, n_estimators=args.n_estimators, max_depth=args.max_depth)
+        print(f"Saved model to {args.model}. Now run: python -m src.cascade calibrate --manifest <held-out.csv>")
+        return
+
+    if not 0.5 < args.min_precision <= 1.0:
+        parser.error("--min-precision must be between 0.5 and 1")
+
+    if store is None:
+        crops, labels = _labeled_crops(args.manifest, args.batch_size)
+    model = CascadeModel(_load_xgboost(args.model))
+
+    start = time.perf_counter()
+    cascade_probs = model.probabilities(color_features(crops))
+    cascade_ms = 1000 * (time.perf_counter() - start) / len(crops)
+    if store is None:
+        cnn_probs, cnn_seconds = _cnn_probabilities(crops, args.batch_size)
+        cnn_step = "preprocessing + CNN"
+    else:
+        # Tensors come preprocessed from the store, so this is the CNN alone
+        from src.feature_store import classify_store
+
+        cnn_probs, cnn_seconds = classify_store(store, args.batch_size)
+        cnn_probs, cnn_seconds = cnn_probs[rows], cnn_seconds / store.ok.sum()
+        cnn_step = "CNN"
+
+    chosen = calibrate(cascade_probs, cnn_probs, labels, args.min_precision)
+    sweep = {str(target): calibrate(cascade_probs, cnn_probs, labels, target) for target in args.sweep}
+    report = {
+        "images": int(len(labels)),
+        "anemic": int(labels.sum()),
+        "min_precision": args.min_precision,
+        "chosen": chosen,
+        "sweep": sweep,
+        "cascade_ms_per_image": cascade_ms,
+        "cnn_ms_per_image": 1000 * cnn_seconds,
+    }
+
+    with open(args.thresholds, "w") as f:
+        json.dump({"low": chosen["low"], "high": chosen["high"], "min_precision": args.min_precision,
+                   "images": report["images"], "short_circuit": chosen["short_circuit"]}, f, indent=2)
+
+    def fmt(value):
+        return f"{value:.3f}" if isinstance(value, float) else "-"
+
+    print(f"\nCalibrated on {report['images']} images ({report['anemic']} anemic)")
+    print(f"Color model {cascade_ms:.2f} ms/image, {cnn_step} {1000 * cnn_seconds:.2f} ms/image\n")
+    print(f"  {'precision':>9} {'low':>6} {'high':>6} {'short-circ':>10} {'cascade acc':>11} "
+          f"{'cnn acc':>8} {'overall':>8} {'change':>8}")
+    for target, row in sorted(sweep.items()) + [(f"{args.min_precision}*", chosen)]:
+        print(f"  {target:>9} {fmt(row['low']):>6} {fmt(row['high']):>6} {row['short_circuit']:10.1%} "
+              f"{fmt(row['cascade_accuracy']):>11} {fmt(row['cnn_accuracy_same_images']):>8} "
+              f"{row['accuracy']:8.3f} {row['accuracy_change']:+8.3f}")
+    print(f"\n* saved to {args.thresholds}. Serve with ANEMO_CASCADE=1")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved report to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,86 @@
 import os
-import tensorflow as tf
-from src.config import KERAS_MODEL_PATH
+import logging
+from pathlib import Path
+import numpy as np
+from src.config import (
+    KERAS_MODEL_PATH, CLASSIFIER_BACKEND, TFLITE_MODEL_PATH, ONNX_MODEL_PATH, CLASSIFIER_THREADS,
+)
+from src.models import registry
+from src.runtimes import load_runtime
+from src.metrics import stage_timer
 
-# Silence TensorFlow's startup messages
-os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
-tf.get_logger().setLevel('ERROR')
+logger = logging.getLogger(__name__)
 
-print(f"Loading Keras model from {KERAS_MODEL_PATH}...")
 
-try:
-    model = tf.keras.models.load_model(KERAS_MODEL_PATH)
-except Exception as e:
-    raise RuntimeError(f"Could not load Keras model: {e}")
+def _load_model(path=KERAS_MODEL_PATH):
+    """
+    Import TensorFlow and load the Keras model (called once, on first use).
+    """
+    # Silence TensorFlow's startup messages
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+    import tensorflow as tf
+    tf.get_logger().setLevel('ERROR')
 
-def predict_anemia(input_tensor):
+    logger.info(f"Loading Keras model from {path}...")
+
+    try:
+        return tf.keras.models.load_model(path)
+    except Exception as e:
+        raise RuntimeError(f"Could not load Keras model: {e}")
+
+
+def _warm_up(model):
+    # One dummy prediction so the first real request doesn't build the graph
+    model.predict(np.zeros((1, 224, 224, 3), dtype=np.float32), verbose=0)
+
+
+# Backend name -> exported model file (keras uses the .h5 directly)
+BACKEND_PATHS = {
+    "keras": KERAS_MODEL_PATH,
+    "tflite": TFLITE_MODEL_PATH,
+    "onnx": ONNX_MODEL_PATH,
+}
+
+if CLASSIFIER_BACKEND not in BACKEND_PATHS:
+    raise ValueError(f"Unknown classifier backend: {CLASSIFIER_BACKEND}. Choose from {sorted(BACKEND_PATHS)}")
+
+# Registry entry that holds the Keras model, which Grad-CAM needs
+KERAS_ENTRY = "classifier" if CLASSIFIER_BACKEND == "keras" else "classifier_keras"
+
+
+def _load_backend():
     """
-    Input: (1, 224, 224, 3) float32 tensor
-    Output: (label: str, confidence: float)
+    Load the model used for predictions with the configured runtime.
     """
-    p = float(model.predict(input_tensor, verbose=0)[0][0])
+    if CLASSIFIER_BACKEND == "keras":
+        return _load_model()
+    return load_runtime(CLASSIFIER_BACKEND, BACKEND_PATHS[CLASSIFIER_BACKEND], CLASSIFIER_THREADS)
+
 
-    print(f"DEBUG: Raw Model Probability (p): {p:.4f}")
+# File suffix -> runtime, for classifiers given by path (e.g. a shadow model)
+SUFFIX_BACKENDS = {".h5": "keras", ".keras": "keras", ".tflite": "tflite", ".onnx": "onnx"}
 
+
+def load_classifier(path):
+    """
+    Load any classifier file with the runtime its suffix calls for.
+    The result has the Keras predict(batch, verbose=0) interface.
+    """
+    backend = SUFFIX_BACKENDS.get(Path(path).suffix.lower())
+    if backend is None:
+        raise ValueError(f"Unknown classifier file type: {path}. Use one of {sorted(SUFFIX_BACKENDS)}")
+    if backend == "keras":
+        return _load_model(path)
+    return load_runtime(backend, path, CLASSIFIER_THREADS)
+
+
+registry.register("classifier", _load_backend, _warm_up, source=BACKEND_PATHS[CLASSIFIER_BACKEND])
+if KERAS_ENTRY != "classifier":
+    # Only loaded if someone asks for a heatmap
+    registry.register(KERAS_ENTRY, _load_model, source=KERAS_MODEL_PATH, preload=False)
+
+
+def label_from_probability(p):
     # If probability < 0.5, person doesn't have anemia
     if p < 0.5:
         return "NON-ANEMIC", 1.0 - p
@@ -29,11 +88,56 @@ def predict_anemia(input_tensor):
         return "ANEMIC", p
 
 
+def probability_from_label(label, confidence):
+    # Undo label_from_probability: back to the raw anemia probability
+    return confidence if label == "ANEMIC" else 1.0 - confidence
+
+
+def predict_probabilities(input_batch):
+    """
+    Input: (N, 224, 224, 3) float32 tensor
+    Output: (N,) array of raw anemia probabilities
+    """
+    model = get_backend()
+    with stage_timer("classify"):
+        return model.predict(input_batch, verbose=0)[:, 0]
+
+
+def predict_anemia_batch(input_batch):
+    """
+    Input: (N, 224, 224, 3) float32 tensor
+    Output: list of N (label: str, confidence: float)
+    """
+    probs = predict_probabilities(input_batch)
+    return [label_from_probability(float(p)) for p in probs]
+
+
+def predict_anemia(input_tensor):
+    """
+    Input: (1, 224, 224, 3) float32 tensor
+    Output: (label: str, confidence: float)
+    """
+    p = float(predict_probabilities(input_tensor)[0])
+
+    logger.debug(f"Raw model probability (p): {p:.4f}")
+
+    return label_from_probability(p)
+
+
+def get_backend():
+    """
+    Return the model used for predictions: the Keras model, or a
+    TFLite/ONNX runtime wrapper with the same predict() method.
+    """
+    return registry.get("classifier")
+
+
 def get_model():
     """
     Return the model for visualization (no weights are changed).
+    Loads it on first call.
     
     Returns:
         Loaded Keras model
     """
-    return model
+    return registry.get(KERAS_ENTRY)
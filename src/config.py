@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 
 # Find the base directory
@@ -19,3 +20,180 @@ STATIC_DIR.mkdir(parents=True, exist_ok=True)
 # Path to the trained models
 YOLO_MODEL_PATH = MODELS_DIR / "conjunctiva_detector.pt"
 KERAS_MODEL_PATH = MODELS_DIR / "anemia_model.h5"
+
+# Detector weights can be swapped for an export (e.g. .onnx / .tflite),
+# which Ultralytics loads the same way
+YOLO_MODEL_PATH = Path(os.getenv("ANEMO_YOLO_MODEL_PATH", str(YOLO_MODEL_PATH)))
+
+# YOLO input size: images are downscaled to this longest side before
+# detection (rounded to a multiple of 32) and boxes are mapped back to the
+# full-resolution image for cropping. Smaller is faster; see
+# python -m src.benchmark --detect-sizes for the accuracy/latency trade-off.
+DETECT_IMGSZ = int(os.getenv("ANEMO_DETECT_IMGSZ", "640"))
+
+# Runtime for classifier predictions: "keras" (the .h5 model), "tflite" or
+# "onnx" (exports made with python -m src.export_model). Grad-CAM always
+# uses the Keras model.
+CLASSIFIER_BACKEND = os.getenv("ANEMO_CLASSIFIER_BACKEND", "keras").lower()
+TFLITE_MODEL_PATH = Path(os.getenv("ANEMO_TFLITE_MODEL_PATH", str(MODELS_DIR / "anemia_model.tflite")))
+ONNX_MODEL_PATH = Path(os.getenv("ANEMO_ONNX_MODEL_PATH", str(MODELS_DIR / "anemia_model.onnx")))
+# Threads per classifier runtime call (0 lets the runtime decide)
+CLASSIFIER_THREADS = int(os.getenv("ANEMO_CLASSIFIER_THREADS", "0"))
+
+# Micro-batching for /predict: wait up to BATCH_MAX_WAIT_MS for other
+# requests to arrive, then run one model call for up to BATCH_MAX_SIZE images
+BATCH_MAX_SIZE = int(os.getenv("ANEMO_BATCH_MAX_SIZE", "8"))
+BATCH_MAX_WAIT_MS = float(os.getenv("ANEMO_BATCH_MAX_WAIT_MS", "10"))
+
+# Preprocessing engine: "accurate" (non-local means denoise, the original
+# path) or "fast" (bilateral denoise with reused buffers)
+PREPROCESS_ENGINE = os.getenv("ANEMO_PREPROCESS_ENGINE", "accurate")
+
+# Result cache for repeated uploads: in-memory LRU size (0 turns it off) and
+# an optional on-disk tier with its own size budget (0 MB turns it off)
+CACHE_MAX_ENTRIES = int(os.getenv("ANEMO_CACHE_MAX_ENTRIES", "512"))
+CACHE_DIR = STATIC_DIR / "cache"
+CACHE_DISK_MAX_BYTES = int(float(os.getenv("ANEMO_CACHE_DISK_MAX_MB", "0")) * 1024 * 1024)
+
+# Result images (boxed detection + Grad-CAM overlay): format ("jpg", "webp"
+# or "png"), encoder quality, longest side of the boxed preview (0 keeps the
+# decoded size) and how many background threads render them
+ARTIFACT_FORMAT = os.getenv("ANEMO_ARTIFACT_FORMAT", "jpg").lower()
+ARTIFACT_JPEG_QUALITY = int(os.getenv("ANEMO_ARTIFACT_JPEG_QUALITY", "90"))
+ARTIFACT_WEBP_QUALITY = int(os.getenv("ANEMO_ARTIFACT_WEBP_QUALITY", "85"))
+ARTIFACT_PREVIEW_MAX_DIM = int(os.getenv("ANEMO_ARTIFACT_PREVIEW_MAX_DIM", "1024"))
+ARTIFACT_WORKERS = int(os.getenv("ANEMO_ARTIFACT_WORKERS", "2"))
+
+# Grad-CAM method: "gradients" (input-gradient saliency, the original
+# behaviour) or "conv" (classic Grad-CAM on the feature maps of
+# GRADCAM_LAYER, much cheaper), and encoder threads for batch explanations
+GRADCAM_METHOD = os.getenv("ANEMO_GRADCAM_METHOD", "gradients").lower()
+GRADCAM_LAYER = os.getenv("ANEMO_GRADCAM_LAYER", "mobilenetv2_1.00_224")
+EXPLAIN_WORKERS = int(os.getenv("ANEMO_EXPLAIN_WORKERS", str(os.cpu_count() or 1)))
+
+# Result image lifecycle: files older than the TTL are deleted, and the
+# oldest go first once the folder is over its quota (0 turns either off)
+RESULTS_TTL_SECONDS = int(os.getenv("ANEMO_RESULTS_TTL_SECONDS", str(24 * 60 * 60)))
+RESULTS_MAX_BYTES = int(float(os.getenv("ANEMO_RESULTS_MAX_MB", "1024")) * 1024 * 1024)
+RESULTS_SWEEP_INTERVAL = int(os.getenv("ANEMO_RESULTS_SWEEP_INTERVAL", "300"))
+
+# Per-request timing log: one line per /predict with the request id and the
+# time spent in each step, written to the "anemo.requests" logger
+LOG_REQUESTS = os.getenv("ANEMO_LOG_REQUESTS", "0").lower() in ("1", "true", "yes")
+
+# Multi-process inference: number of worker processes that each load their
+# own models (0 runs the models in the API process), and threads per worker
+# for TensorFlow/PyTorch (0 splits the CPU cores evenly between workers)
+INFERENCE_WORKERS = int(os.getenv("ANEMO_INFERENCE_WORKERS", "0"))
+INFERENCE_THREADS = int(os.getenv("ANEMO_INFERENCE_THREADS", "0"))
+
+# Camera streaming (/ws/screen): frames are detected at STREAM_DETECT_MAX_DIM,
+# and only the STREAM_TOP_FRAMES sharpest well-exposed frames with a steady
+# box are classified. STREAM_MIN_STABLE_FRAMES in a row with the same box
+# (and STREAM_MIN_SHARPNESS) mark the stream as ready to finish.
+STREAM_DETECT_MAX_DIM = int(os.getenv("ANEMO_STREAM_DETECT_MAX_DIM", "640"))
+STREAM_TOP_FRAMES = int(os.getenv("ANEMO_STREAM_TOP_FRAMES", "3"))
+STREAM_MAX_FRAMES = int(os.getenv("ANEMO_STREAM_MAX_FRAMES", "300"))
+STREAM_MIN_SHARPNESS = float(os.getenv("ANEMO_STREAM_MIN_SHARPNESS", "50"))
+STREAM_MIN_STABLE_FRAMES = int(os.getenv("ANEMO_STREAM_MIN_STABLE_FRAMES", "3"))
+
+# Admission control for /predict: requests processed at once, how many more
+# may wait for a slot before new ones get a fast 503 with Retry-After, and
+# the queue depth at which explain=true requests skip Grad-CAM (0 turns
+# degrading off)
+MAX_IN_FLIGHT = int(os.getenv("ANEMO_MAX_IN_FLIGHT", "32"))
+MAX_QUEUE = int(os.getenv("ANEMO_MAX_QUEUE", "64"))
+DEGRADE_QUEUE_DEPTH = int(os.getenv("ANEMO_DEGRADE_QUEUE_DEPTH", "16"))
+RETRY_AFTER_SECONDS = int(os.getenv("ANEMO_RETRY_AFTER_SECONDS", "2"))
+
+# Request deadline in seconds (clients can ask for less with ?timeout_ms=).
+# Work that hasn't started by the deadline is dropped with a 504.
+REQUEST_TIMEOUT_SECONDS = float(os.getenv("ANEMO_REQUEST_TIMEOUT_SECONDS", "30"))
+
+# Per-stage limits: requests decoding / preprocessing at once, and items each
+# model batcher may have queued before rejecting more (0 means no limit)
+DECODE_CONCURRENCY = int(os.getenv("ANEMO_DECODE_CONCURRENCY", str(os.cpu_count() or 1)))
+PREPROCESS_CONCURRENCY = int(os.getenv("ANEMO_PREPROCESS_CONCURRENCY", str(os.cpu_count() or 1)))
+BATCH_MAX_QUEUE = int(os.getenv("ANEMO_BATCH_MAX_QUEUE", "256"))
+
+# Bulk jobs (/jobs): where uploads, the SQLite job store and result bundles
+# live, the most images one job may hold, the largest upload (zip or files
+# together) in MB, how many jobs run at once, and how many of a job's images
+# are in the pipeline at once (enough to fill the model batches). Finished
+# jobs (uploads, bundle and results) are deleted after JOBS_TTL_SECONDS
+# (0: keep them), checked every RESULTS_SWEEP_INTERVAL
+JOBS_DIR = Path(os.getenv("ANEMO_JOBS_DIR", str(BASE_DIR / "jobs")))
+JOBS_TTL_SECONDS = int(os.getenv("ANEMO_JOBS_TTL_SECONDS", str(7 * 24 * 60 * 60)))
+JOB_MAX_IMAGES = int(os.getenv("ANEMO_JOB_MAX_IMAGES", "1000"))
+JOB_MAX_UPLOAD_BYTES = int(float(os.getenv("ANEMO_JOB_MAX_UPLOAD_MB", "500")) * 1024 * 1024)
+JOB_WORKERS = int(os.getenv("ANEMO_JOB_WORKERS", "1"))
+JOB_CONCURRENCY = int(os.getenv("ANEMO_JOB_CONCURRENCY", "16"))
+
+# Model hot swap: how often (seconds) to check the model files for a new
+# version, which is then loaded and warmed in the background and swapped in
+# without a restart (0 turns the check off)
+MODEL_WATCH_SECONDS = float(os.getenv("ANEMO_MODEL_WATCH_SECONDS", "30"))
+
+# Shadow model: an alternative classifier file (.h5/.keras, .tflite or
+# .onnx) run on SHADOW_SAMPLE_RATE of /predict requests on its own thread,
+# to compare its predictions and latency with the live model without
+# touching responses. At most SHADOW_MAX_PENDING sampled requests wait for
+# it; beyond that samples are skipped. An empty path turns it off.
+SHADOW_MODEL_PATH = os.getenv("ANEMO_SHADOW_MODEL_PATH", "")
+SHADOW_SAMPLE_RATE = float(os.getenv("ANEMO_SHADOW_SAMPLE_RATE", "0.1"))
+SHADOW_MAX_PENDING = int(os.getenv("ANEMO_SHADOW_MAX_PENDING", "8"))
+
+# Quality gate before detection: "flag" (the default) runs the models anyway
+# and adds the reasons to the result when a photo is blurry, badly exposed or
+# color-cast (or the detected eyelid is tiny), "reject" turns such photos away
+# with the reasons, "off" skips the checks. They run on a 128px copy of the decoded photo.
+# Sharpness is the Laplacian variance at 128px; color cast is how far the
+# average color leans green or blue (in Lab units); the region minimum is
+# the detected box's shorter side in pixels.
+QUALITY_GATE = os.getenv("ANEMO_QUALITY_GATE", "flag")
+QUALITY_MIN_SHARPNESS = float(os.getenv("ANEMO_QUALITY_MIN_SHARPNESS", "20"))
+QUALITY_MIN_BRIGHTNESS = float(os.getenv("ANEMO_QUALITY_MIN_BRIGHTNESS", "50"))
+QUALITY_MAX_BRIGHTNESS = float(os.getenv("ANEMO_QUALITY_MAX_BRIGHTNESS", "215"))
+QUALITY_MAX_CLIPPED = float(os.getenv("ANEMO_QUALITY_MAX_CLIPPED", "0.5"))
+QUALITY_MAX_COLOR_CAST = float(os.getenv("ANEMO_QUALITY_MAX_COLOR_CAST", "30"))
+QUALITY_MIN_REGION_PX = int(os.getenv("ANEMO_QUALITY_MIN_REGION_PX", "48"))
+
+# Cascade: score color statistics of the crop with a small gradient-boosted
+# model (python -m src.cascade train) and answer right away when it is
+# confident, running the CNN only for the rest. The thresholds file comes
+# from python -m src.cascade calibrate. Requests with explain=true always
+# use the CNN (Grad-CAM needs it).
+CASCADE = os.getenv("ANEMO_CASCADE", "0").lower() in ("1", "true", "yes")
+CASCADE_MODEL_PATH = Path(os.getenv("ANEMO_CASCADE_MODEL_PATH", str(MODELS_DIR / "cascade_model.json")))
+CASCADE_THRESHOLDS_PATH = Path(os.getenv("ANEMO_CASCADE_THRESHOLDS_PATH", str(MODELS_DIR / "cascade_thresholds.json")))
+
+# Test-time augmentation: when the first prediction's anemia probability
+# falls inside [TTA_BAND_LOW, TTA_BAND_HIGH], TTA_VARIANTS flipped, shifted
+# (by up to TTA_SHIFT_PX) and brightened/darkened (by TTA_BRIGHTNESS) copies
+# of the crop are classified in one batch and averaged. A band of 0-1 runs
+# it on every request. Requests with explain=true are not augmented.
+TTA = os.getenv("ANEMO_TTA", "0").lower() in ("1", "true", "yes")
+TTA_VARIANTS = int(os.getenv("ANEMO_TTA_VARIANTS", "8"))
+TTA_BAND_LOW = float(os.getenv("ANEMO_TTA_BAND_LOW", "0.3"))
+TTA_BAND_HIGH = float(os.getenv("ANEMO_TTA_BAND_HIGH", "0.7"))
+TTA_SHIFT_PX = int(os.getenv("ANEMO_TTA_SHIFT_PX", "8"))
+TTA_BRIGHTNESS = float(os.getenv("ANEMO_TTA_BRIGHTNESS", "0.1"))
+
+# Offline feature store (python -m src.feature_store): crops and
+# preprocessed tensors of a labeled image set, computed once per
+# detector/preprocessing version and memory-mapped by evaluation runs
+FEATURE_STORE_DIR = Path(os.getenv("ANEMO_FEATURE_STORE_DIR", str(BASE_DIR / "feature_store")))
+
+# Similar cases: with EMBEDDINGS on, plain /predict requests also get the
+# Keras model's penultimate-layer embedding (EMBEDDING_LAYER picks another
+# layer), from the pass that labels them when the backend is Keras. Embeddings
+# are kept as float16 in EMBEDDINGS_DIR, and GET /similar/{request_id}
+# returns the closest earlier cases. Up to SIMILAR_EXACT_MAX cases are
+# searched exactly; above that, a SIMILAR_SKETCH_DIM-dimensional random
+# projection picks candidates that are then re-ranked exactly.
+EMBEDDINGS = os.getenv("ANEMO_EMBEDDINGS", "0").lower() in ("1", "true", "yes")
+EMBEDDING_LAYER = os.getenv("ANEMO_EMBEDDING_LAYER", "")
+EMBEDDINGS_DIR = Path(os.getenv("ANEMO_EMBEDDINGS_DIR", str(BASE_DIR / "embeddings")))
+SIMILAR_MAX_K = int(os.getenv("ANEMO_SIMILAR_MAX_K", "50"))
+SIMILAR_EXACT_MAX = int(os.getenv("ANEMO_SIMILAR_EXACT_MAX", "5000"))
+SIMILAR_SKETCH_DIM = int(os.getenv("ANEMO_SIMILAR_SKETCH_DIM", "64"))
@@ -1,25 +1,57 @@
 # src/detector.py
 import cv2
 import logging
+import threading
 import numpy as np
 from pathlib import Path
-from ultralytics import YOLO
-from src.config import YOLO_MODEL_PATH, RESULTS_DIR
+from src.config import YOLO_MODEL_PATH, DETECT_IMGSZ
+from src.models import registry
+from src.artifacts import artifact_path, make_preview, write_image
+from src.metrics import stage_timer
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
 # File size and type limits
 MAX_IMAGE_SIZE = 100 * 1024 * 1024  # 100MB
+MAX_IMAGE_DIM = 2048  # Longest side kept after decoding
 ALLOWED_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp"}
 
-# Load YOLO model
-print(f"Loading YOLO model from {YOLO_MODEL_PATH}...")
-try:
-    yolo_model = YOLO(str(YOLO_MODEL_PATH))
-except Exception as e:
-    print(f"Error loading YOLO model: {e}")
-    raise RuntimeError(f"Failed to load YOLO model: {e}") from e
+# Minimum confidence for a YOLO box
+DETECT_CONF = 0.25
+
+# Per-thread scratch buffers
+_scratch = threading.local()
+
+def _load_model():
+    """
+    Import Ultralytics and load the YOLO model (called once, on first use).
+    """
+    from ultralytics import YOLO
+
+    logger.info(f"Loading YOLO model from {YOLO_MODEL_PATH}...")
+    try:
+        return YOLO(str(YOLO_MODEL_PATH))
+    except Exception as e:
+        logger.error(f"Error loading YOLO model: {e}")
+        raise RuntimeError(f"Failed to load YOLO model: {e}") from e
+
+
+def _warm_up(yolo_model):
+    # One dummy detection so the first real request doesn't pay for setup
+    imgsz = detect_size(DETECT_IMGSZ)
+    yolo_model.predict(source=np.zeros((imgsz, imgsz, 3), dtype=np.uint8), conf=DETECT_CONF, imgsz=imgsz, verbose=False)
+
+
+registry.register("detector", _load_model, _warm_up, source=YOLO_MODEL_PATH)
+
+
+def get_detector():
+    """
+    Return the YOLO model, loading it on first call.
+    """
+    return registry.get("detector")
+
 
 TARGET_CLASSES = {
     "palpebral",
@@ -27,9 +59,9 @@ TARGET_CLASSES = {
     "eye" # fallback in case the model labels it differently
 }
 
-def detect_and_crop(image_path):
+def load_image(image_path):
     """
-    Find the eye area, draw a box around it, and return the cropped image.
+    Check the image file and read it into a BGR array.
     """
     image_path = Path(image_path)
     
@@ -63,7 +95,78 @@ def detect_and_crop(image_path):
         logger.error(f"Can't read the file")
         raise ValueError("Cannot access image file")
     
-    image_bgr = cv2.imread(str(image_path))
+    try:
+        data = image_path.read_bytes()
+    except OSError as e:
+        logger.error(f"Can't read the file")
+        raise ValueError("Cannot access image file")
+
+    return decode_image(data)
+
+
+def _jpeg_size(data):
+    """
+    Read (width, height) from a JPEG's SOF header without decoding it.
+    Returns None for anything that isn't a readable JPEG.
+    """
+    if data[:2] != b"\xff\xd8":
+        return None
+
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        # Padding bytes and markers without a length field
+        if marker == 0xFF:
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            i += 2
+            continue
+        # SOF0-SOF15, except DHT (C4), JPG (C8) and DAC (CC)
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height = int.from_bytes(data[i + 5:i + 7], "big")
+            width = int.from_bytes(data[i + 7:i + 9], "big")
+            return width, height
+        i += 2 + int.from_bytes(data[i + 2:i + 4], "big")
+
+    return None
+
+
+# Decode flags for 1/2, 1/4 and 1/8 scale JPEG decoding
+_REDUCED_DECODE_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+
+def decode_image(data, max_dim=MAX_IMAGE_DIM):
+    """
+    Decode image bytes (from an upload or a file) into a BGR array no
+    bigger than max_dim on its longest side.
+
+    Oversized JPEGs are decoded at 1/2, 1/4 or 1/8 scale by libjpeg itself,
+    so we never build the full-resolution image just to shrink it.
+    """
+    if not data:
+        logger.error("Empty image data")
+        raise ValueError("Could not read image - file is empty")
+
+    if len(data) > MAX_IMAGE_SIZE:
+        logger.error(f"Image file exceeds size limit")
+        raise ValueError(f"Image file too large")
+
+    buffer = np.frombuffer(data, dtype=np.uint8)
+
+    # Pick the strongest reduction that still leaves at least max_dim pixels
+    flag = cv2.IMREAD_COLOR
+    size = _jpeg_size(data)
+    if size is not None:
+        for factor, reduced_flag in _REDUCED_DECODE_FLAGS:
+            if max(size) // factor >= max_dim:
+                flag = reduced_flag
+                break
+
+    with stage_timer("decode"):
+        image_bgr = cv2.imdecode(buffer, flag)
     
     if image_bgr is None:
         logger.error(f"Can't open the image - it might be broken or not a real image")
@@ -72,71 +175,196 @@ def detect_and_crop(image_path):
     # Shrink really big images so they don't use too much memory
     # Max dimension ~2048px, preserve aspect ratio
     h, w = image_bgr.shape[:2]
-    max_dim = 2048
     if w > max_dim or h > max_dim:
         scale = max_dim / max(w, h)
         new_w, new_h = int(w * scale), int(h * scale)
-        image_bgr = cv2.resize(image_bgr, (new_w, new_h), interpolation=cv2.INTER_AREA)
-        print(f"Resized image from {w}x{h} to {new_w}x{new_h} to prevent memory issues")
+        with stage_timer("resize"):
+            image_bgr = cv2.resize(image_bgr, (new_w, new_h), interpolation=cv2.INTER_AREA)
+        logger.debug(f"Resized image from {w}x{h} to {new_w}x{new_h} to prevent memory issues")
+
+    return image_bgr
+
+
+def detect_size(imgsz):
+    # YOLO needs a multiple of its 32px stride
+    return max(32, int(round(imgsz / 32)) * 32)
+
+
+def _to_numpy(values):
+    # Ultralytics returns torch tensors; stand-ins and exports may give arrays
+    if hasattr(values, "cpu"):
+        values = values.cpu().numpy()
+    return np.asarray(values)
 
-    # Run Inference
-    results = yolo_model.predict(source=image_bgr, conf=0.25, verbose=False)
-    
-    h, w, _ = image_bgr.shape
-    best_box = None
-    best_area = 0
 
+def _find_best_box(result, scale=1.0):
+    """
+    Pick the biggest target-class box from one YOLO result, or None.
+    scale is how much the image was downscaled before detection; the box
+    is returned in the original image's coordinates.
+    """
     # Look for the biggest eye area in the results
-    if results and len(results[0].boxes) > 0:
-        names = results[0].names
-        boxes = results[0].boxes
-
-        for box in boxes:
-            cls_id = int(box.cls.item())
-            cls_name = names.get(cls_id)
-
-            if cls_name in TARGET_CLASSES:
-                x1, y1, x2, y2 = map(int, box.xyxy[0].tolist())
-                area = (x2 - x1) * (y2 - y1)
-                if area > best_area:
-                    best_area = area
-                    best_box = (x1, y1, x2, y2)
-
-    # Create a safe filename for the output
-    boxed_filename = f"boxed_{image_path.name}"
-    # Remove any path separators from filename
-    boxed_filename = boxed_filename.replace("/", "_").replace("\\", "_")
-    boxed_path = RESULTS_DIR / boxed_filename
-    
+    if result is None or len(result.boxes) == 0:
+        return None
+
+    target_ids = [cls_id for cls_id, name in result.names.items() if name in TARGET_CLASSES]
+    cls_ids = _to_numpy(result.boxes.cls).astype(int)
+    # Map back to full resolution and truncate to whole pixels
+    xyxy = (_to_numpy(result.boxes.xyxy).reshape(-1, 4) / scale).astype(int)
+
+    areas = (xyxy[:, 2] - xyxy[:, 0]) * (xyxy[:, 3] - xyxy[:, 1])
+    areas = np.where(np.isin(cls_ids, target_ids), areas, 0)
+
+    best = int(np.argmax(areas))
+    if areas[best] <= 0:
+        return None
+    return tuple(int(v) for v in xyxy[best])
+
+
+def _downscale(image_bgr, imgsz):
+    """
+    Shrink an image so its longest side is imgsz (never enlarges).
+    Returns (image, scale).
+    """
+    h, w = image_bgr.shape[:2]
+    scale = imgsz / max(h, w)
+    if scale >= 1:
+        return image_bgr, 1.0
+    small = cv2.resize(image_bgr, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+    # Use the actual ratio after rounding so boxes map back exactly
+    return small, small.shape[1] / w
+
+
+def _clamp_box(best_box, image_shape):
+    h, w = image_shape[:2]
+    x1, y1, x2, y2 = best_box
+    # Clamp coordinates to image size
+    return max(0, x1), max(0, y1), min(w, x2), min(h, y2)
+
+
+def crop_to_box(image_bgr, best_box):
+    """
+    Return the 224x224 RGB crop for a box, or the whole image resized if
+    there is no box.
+    """
+    with stage_timer("crop"):
+        return _crop_to_box(image_bgr, best_box)
+
+
+def _resize_buffer():
+    # Per-thread 224x224 scratch image for the resize before the RGB conversion
+    buffer = getattr(_scratch, "resized", None)
+    if buffer is None:
+        buffer = _scratch.resized = np.empty((224, 224, 3), dtype=np.uint8)
+    return buffer
+
+
+def _crop_to_box(image_bgr, best_box):
     crop_rgb = None
 
     if best_box:
-        x1, y1, x2, y2 = best_box
-        # Clamp coordinates to image size
-        x1, y1 = max(0, x1), max(0, y1)
-        x2, y2 = min(w, x2), min(h, y2)
+        x1, y1, x2, y2 = _clamp_box(best_box, image_bgr.shape)
 
-        # Draw Green Box
-        boxed_img = image_bgr.copy()
-        cv2.rectangle(boxed_img, (x1, y1), (x2, y2), (0, 255, 0), 2)
-        cv2.imwrite(str(boxed_path), boxed_img)
-        print(f"Saved detection visualization to: {boxed_path}")
-
-        # Crop
+        # Crop (a view, nothing is copied yet)
         crop_bgr = image_bgr[y1:y2, x1:x2]
         
         # Make sure we actually got an image
         if crop_bgr.size != 0:
-            # Resize to 224x224 here to ensure consistency
-            crop_bgr = cv2.resize(crop_bgr, (224, 224))
-            crop_rgb = cv2.cvtColor(crop_bgr, cv2.COLOR_BGR2RGB)
+            # Resize to 224x224 here to ensure consistency; only the RGB
+            # crop that is returned gets a new array
+            resized = cv2.resize(crop_bgr, (224, 224), dst=_resize_buffer())
+            crop_rgb = cv2.cvtColor(resized, cv2.COLOR_BGR2RGB)
     
     else:
-        print("No conjunctiva detected. Using full image as fallback.")
-        cv2.imwrite(str(boxed_path), image_bgr)
+        logger.debug("No conjunctiva detected. Using full image as fallback.")
         
         # If no eye is detected, just use the whole image
-        resized_full = cv2.resize(image_bgr, (224, 224))
+        resized_full = cv2.resize(image_bgr, (224, 224), dst=_resize_buffer())
         crop_rgb = cv2.cvtColor(resized_full, cv2.COLOR_BGR2RGB)
 
-    return crop_rgb
\ No newline at end of file
+    return crop_rgb
+
+
+def render_boxed(image_bgr, best_box, output_path):
+    """
+    Save the detection visualization: a (downscaled) preview of the image
+    with the box drawn on it. Returns the saved path, or None on failure.
+    """
+    # Draw on a preview instead of a full-size copy
+    boxed_img, scale = make_preview(image_bgr)
+
+    if best_box:
+        x1, y1, x2, y2 = _clamp_box(best_box, image_bgr.shape)
+        # Draw Green Box
+        cv2.rectangle(
+            boxed_img,
+            (int(x1 * scale), int(y1 * scale)),
+            (int(x2 * scale), int(y2 * scale)),
+            (0, 255, 0), 2
+        )
+
+    if not write_image(output_path, boxed_img):
+        logger.error(f"Failed to write detection visualization: {output_path}")
+        return None
+
+    logger.debug(f"Saved detection visualization to: {output_path}")
+    return str(output_path)
+
+
+def boxed_path_for(image_name):
+    """Where the boxed visualization for an image is saved."""
+    # Remove any path separators from filename
+    safe_name = str(image_name).replace("/", "_").replace("\\", "_")
+    return artifact_path("boxed", safe_name)
+
+
+def detect_boxes(images_bgr, imgsz=None):
+    """
+    Run one YOLO call over several decoded images.
+    Returns the best target box (or None) per image, in the same order.
+
+    Each image is downscaled to imgsz (default DETECT_IMGSZ) first, so YOLO
+    never has to resize a large image itself; the boxes come back in the
+    full-resolution coordinates, ready for cropping.
+    """
+    if not images_bgr:
+        return []
+
+    imgsz = detect_size(imgsz or DETECT_IMGSZ)
+    with stage_timer("detect_resize"):
+        resized = [_downscale(image_bgr, imgsz) for image_bgr in images_bgr]
+
+    # Run Inference on the whole batch at once
+    yolo_model = get_detector()
+    with stage_timer("yolo"):
+        results = yolo_model.predict(
+            source=[small for small, _ in resized], conf=DETECT_CONF, imgsz=imgsz, verbose=False
+        )
+    return [_find_best_box(result, scale) for result, (_, scale) in zip(results, resized)]
+
+
+def detect_and_crop_batch(images_bgr, image_names, save_boxed=True):
+    """
+    Run one YOLO call over several decoded images.
+    Returns one 224x224 RGB crop (or None) per image, in the same order.
+    Set save_boxed=False to skip writing the boxed visualizations.
+    """
+    if len(images_bgr) != len(image_names):
+        raise ValueError("Need exactly one name per image")
+
+    crops = []
+    for image_bgr, image_name, best_box in zip(images_bgr, image_names, detect_boxes(images_bgr)):
+        if save_boxed:
+            render_boxed(image_bgr, best_box, boxed_path_for(image_name))
+        crops.append(crop_to_box(image_bgr, best_box))
+
+    return crops
+
+
+def detect_and_crop(image_path):
+    """
+    Find the eye area, draw a box around it, and return the cropped image.
+    """
+    image_path = Path(image_path)
+    image_bgr = load_image(image_path)
+    return detect_and_crop_batch([image_bgr], [image_path.name])[0]
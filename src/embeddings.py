@@ -0,0 +1,99 @@
+# src/embeddings.py
+"""
+Penultimate-layer embeddings from the classifier.
+The same forward pass that gives the anemia probability also returns the
+features the final layer sees, L2-normalized so that a dot product between
+two embeddings is their cosine similarity. Used by the similar-case index
+(src/similar.py).
+"""
+
+import logging
+
+import numpy as np
+
+from src.config import EMBEDDINGS, EMBEDDING_LAYER
+from src.models import registry
+from src.classifier import KERAS_ENTRY
+from src.metrics import stage_timer
+
+logger = logging.getLogger(__name__)
+
+# Compiled predict-with-embeddings functions, one per model and layer
+_compiled = {}
+
+
+def _split_for_embedding(model, layer_name):
+    """
+    Split the classifier's layer chain after the embedding layer: by
+    default the one feeding the output layer (for MobileNetV2 + head, the
+    pooled 1280 features).
+    """
+    layers = [layer for layer in model.layers if layer.__class__.__name__ != "InputLayer"]
+    names = [layer.name for layer in layers]
+    if not layer_name:
+        index = len(layers) - 2
+    elif layer_name in names:
+        index = names.index(layer_name)
+    else:
+        raise ValueError(f"Embedding layer not found in model: {layer_name}")
+    return layers[:index + 1], layers[index + 1:]
+
+
+def _compile_predict_with_embeddings(model, layer_name):
+    """
+    Build a tf.function that returns the anemia probability and the
+    normalized embedding from one pass through the layers.
+    """
+    import tensorflow as tf
+
+    body, head = _split_for_embedding(model, layer_name)
+
+    @tf.function(input_signature=[tf.TensorSpec(shape=(None, 224, 224, 3), dtype=tf.float32)])
+    def predict_with_embeddings_fn(images):
+        x = images
+        for layer in body:
+            x = layer(x, training=False)
+        features = x
+        for layer in head:
+            x = layer(x, training=False)
+
+        # Feature maps (a conv layer picked by name) are pooled to one vector
+        if len(features.shape) == 4:
+            features = tf.reduce_mean(features, axis=(1, 2))
+        return x[:, 0], tf.math.l2_normalize(features, axis=-1)
+
+    return predict_with_embeddings_fn
+
+
+def predict_with_embeddings(model, input_batch, layer_name=EMBEDDING_LAYER):
+    """
+    Input: (N, 224, 224, 3) float32 batch
+    Output: (probabilities (N,), embeddings (N, D) float16, unit length)
+    """
+    import tensorflow as tf
+
+    key = (id(model), layer_name)
+    fn = _compiled.get(key)
+    if fn is None:
+        fn = _compile_predict_with_embeddings(model, layer_name)
+        _compiled[key] = fn
+
+    with stage_timer("classify"):
+        scores, embeddings = fn(tf.convert_to_tensor(input_batch, dtype=tf.float32))
+        return scores.numpy(), embeddings.numpy().astype(np.float16)
+
+
+def _warm_up(model):
+    # Trace the compiled graph once so the first request starts warm
+    predict_with_embeddings(model, np.zeros((1, 224, 224, 3), dtype=np.float32))
+
+
+def _forget_compiled(old_model, new_model):
+    # The compiled functions hold on to the model they were built for
+    for key in [key for key in _compiled if key[0] == id(old_model)]:
+        del _compiled[key]
+
+
+if EMBEDDINGS:
+    registry.add_warmup(KERAS_ENTRY, _warm_up)
+    registry.on_swap(KERAS_ENTRY, _forget_compiled)
@@ -2,14 +2,21 @@
 """
 Grad-CAM Explainability Module
 Generates visual explanations of CNN predictions without modifying model weights.
+explain_batch does whole batches at once for offline audits (python -m src.audit).
 """
 
 import cv2
 import logging
 import numpy as np
-import tensorflow as tf
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+from src.config import GRADCAM_METHOD, GRADCAM_LAYER, EXPLAIN_WORKERS
+from src.models import registry
+from src.classifier import KERAS_ENTRY
+from src.artifacts import write_image
+from src.metrics import stage_timer
+
 # Set up error logging
 logger = logging.getLogger(__name__)
 
@@ -18,99 +25,196 @@ MAX_HEATMAP_SIZE = 50 * 1024 * 1024  # 50MB max output file
 ALLOWED_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp"}
 
 
-def generate_gradcam(model, input_tensor, original_rgb, last_conv_layer_name=None, output_path=None):
+# Compiled predict-and-explain functions, one per model and method
+_compiled = {}
+
+METHODS = ("gradients", "conv")
+
+# Gaussian blur kernel size for the heatmaps
+_BLUR_KSIZE = 7
+
+
+def _compile_predict_and_explain(model):
     """
-    Create a visual heatmap showing what the model is looking at.
-    Shows which parts of the image influence the anemia prediction.
+    Build a tf.function that returns the anemia probability and the input
+    gradient map from the same forward pass.
     """
-    try:
-        # SECURITY: Validate inputs
-        if not isinstance(input_tensor, (np.ndarray, type(tf.constant([])))):
-            logger.error("Invalid input_tensor type")
-            return None
-        
-        if not isinstance(original_rgb, np.ndarray):
-            logger.error("Invalid original_rgb type")
-            return None
-        
-        if input_tensor.shape != (1, 224, 224, 3):
-            logger.error(f"Invalid input_tensor shape: {input_tensor.shape}, expected (1, 224, 224, 3)")
-            return None
-        
-        if original_rgb.shape[2] != 3:
-            logger.error(f"Invalid RGB channels: {original_rgb.shape[2]}, expected 3")
-            return None
-        
-        if output_path is None:
-            logger.error("Output path is required")
-            return None
-        
-        # Make sure the output path is safe to use
-        output_path = Path(output_path)
-        
-        # Check the file extension
-        if output_path.suffix.lower() not in ALLOWED_EXTENSIONS:
-            logger.error(f"Invalid output extension: {output_path.suffix}")
-            return None
-        
-        # Prevent directory traversal attacks
-        if ".." in str(output_path):
-            logger.error("Directory traversal attempt detected in output_path")
-            return None
-        
-        # Debug logging
-        print(f"[Grad-CAM] Starting with input shape: {input_tensor.shape}")
-        print(f"[Grad-CAM] Output path: {output_path}")
-        
-        # Get the underlying MobileNetV2 model 
-        base_model = model.get_layer('mobilenetv2_1.00_224')
-        
-        # Track gradients to see what the model cares about
-        input_tensor_var = tf.Variable(input_tensor)
-        
+    import tensorflow as tf
+
+    @tf.function(input_signature=[tf.TensorSpec(shape=(None, 224, 224, 3), dtype=tf.float32)])
+    def predict_and_explain_fn(images):
         with tf.GradientTape() as tape:
+            tape.watch(images)
             # Forward through model
-            predictions = model(input_tensor_var, training=False)
-            loss = predictions[0, 0]  # Get the positive class probability
-        
-        print(f"[Grad-CAM] Prediction score: {loss.numpy()}")
-        
-        # Get gradients w.r.t input
-        input_grads = tape.gradient(loss, input_tensor_var)
-        
-        # Calculate how sensitive the prediction is to each pixel
-        if input_grads is None:
-            logger.warning("[Grad-CAM] Could not compute input gradients")
-            return None
-        
-        print(f"[Grad-CAM] Gradient shape: {input_grads.shape}")
-        
+            predictions = model(images, training=False)
+            scores = predictions[:, 0]  # Positive class probability per image
+
+        # In inference mode each score only depends on its own image, so the
+        # gradient of the sum gives every image its own gradient
+        input_grads = tape.gradient(scores, images)
+
         # Use the gradient strength to create an attention map
-        grad_magnitude = tf.reduce_max(tf.abs(input_grads[0]), axis=-1)
+        grad_maps = tf.reduce_max(tf.abs(input_grads), axis=-1)
+        return scores, grad_maps
 
-        # Stretch the heatmap to show contrast better
-        heatmap = grad_magnitude.numpy()
-        print(f"[Grad-CAM] Heatmap shape before processing: {heatmap.shape}")
-        print(f"[Grad-CAM] Heatmap value range: {heatmap.min()} to {heatmap.max()}")
+    return predict_and_explain_fn
 
-        heatmap = np.maximum(heatmap, 0)
-        p_low = np.percentile(heatmap, 40)
-        p_high = np.percentile(heatmap, 99)
-        print(f"[Grad-CAM] Percentiles -> p40: {p_low}, p99: {p_high}")
 
-        if p_high <= p_low:
-            logger.warning("[Grad-CAM] Invalid percentile range; heatmap collapsed")
-            return None
+def _split_at_layer(model, layer_name):
+    """
+    Split the classifier's layer stack into (layers before, the feature
+    layer, head layers after). The classifier is the MobileNetV2 base
+    followed by a small head, so the layers form a simple chain.
+    """
+    layers = [layer for layer in model.layers if layer.__class__.__name__ != "InputLayer"]
+    names = [layer.name for layer in layers]
+    if layer_name not in names:
+        raise ValueError(f"Grad-CAM layer not found in model: {layer_name}")
+    index = names.index(layer_name)
+    return layers[:index], layers[index], layers[index + 1:]
+
+
+def _compile_conv_cam(model, layer_name):
+    """
+    Build a tf.function for classic Grad-CAM: gradients are only taken back
+    to the feature maps of layer_name (7x7 for MobileNetV2), weighted per
+    channel and upsampled to 224x224. Much cheaper than input gradients.
+    """
+    import tensorflow as tf
+
+    before, feature_layer, head = _split_at_layer(model, layer_name)
+
+    @tf.function(input_signature=[tf.TensorSpec(shape=(None, 224, 224, 3), dtype=tf.float32)])
+    def conv_cam_fn(images):
+        x = images
+        for layer in before:
+            x = layer(x, training=False)
+
+        with tf.GradientTape() as tape:
+            features = feature_layer(x, training=False)
+            tape.watch(features)
+            x = features
+            for layer in head:
+                x = layer(x, training=False)
+            scores = x[:, 0]
 
-        heatmap = np.clip(heatmap, p_low, p_high)
-        heatmap = (heatmap - p_low) / max(p_high - p_low, 1e-6)
-        heatmap = np.clip(heatmap, 0, 1)
+        # Channel weights are the spatially averaged gradients
+        grads = tape.gradient(scores, features)
+        weights = tf.reduce_mean(grads, axis=(1, 2), keepdims=True)
+        cams = tf.nn.relu(tf.reduce_sum(weights * features, axis=-1))
+        cams = tf.squeeze(tf.image.resize(tf.expand_dims(cams, -1), (224, 224), method="bilinear"), -1)
+        return scores, cams
 
-        # Hide the faint parts so the important areas stand out
-        heatmap[heatmap < 0.4] = 0
+    return conv_cam_fn
+
+
+def predict_and_explain(model, input_batch, method=None, layer_name=GRADCAM_LAYER):
+    """
+    Classify and compute gradient maps in one traced call.
+
+    Input: (N, 224, 224, 3) float32 batch
+    Output: (probabilities (N,), gradient maps (N, 224, 224)) as NumPy arrays
+
+    method is "gradients" (input gradients) or "conv" (Grad-CAM on the
+    feature maps of layer_name); it defaults to GRADCAM_METHOD.
+    """
+    import tensorflow as tf
+
+    method = method or GRADCAM_METHOD
+    if method not in METHODS:
+        raise ValueError(f"Unknown Grad-CAM method: {method}. Choose from {list(METHODS)}")
+
+    key = (id(model), method, layer_name if method == "conv" else None)
+    fn = _compiled.get(key)
+    if fn is None:
+        fn = _compile_conv_cam(model, layer_name) if method == "conv" else _compile_predict_and_explain(model)
+        _compiled[key] = fn
+
+    with stage_timer("gradcam"):
+        scores, grad_maps = fn(tf.convert_to_tensor(input_batch, dtype=tf.float32))
+        return scores.numpy(), grad_maps.numpy()
+
+
+def _warm_up(model):
+    # Trace the compiled graph once so explained requests start warm
+    predict_and_explain(model, np.zeros((1, 224, 224, 3), dtype=np.float32))
+
+
+def _forget_compiled(old_model, new_model):
+    # The compiled functions hold on to the model they were built for
+    for key in [key for key in _compiled if key[0] == id(old_model)]:
+        del _compiled[key]
+
+
+registry.add_warmup(KERAS_ENTRY, _warm_up)
+registry.on_swap(KERAS_ENTRY, _forget_compiled)
+
+
+def _check_output_path(output_path):
+    if output_path is None:
+        logger.error("Output path is required")
+        return None
 
-        # Smooth out the heatmap so it looks cleaner
-        heatmap = cv2.GaussianBlur(heatmap, (7, 7), sigmaX=1.5, sigmaY=1.5)
+    # Make sure the output path is safe to use
+    output_path = Path(output_path)
+
+    # Check the file extension
+    if output_path.suffix.lower() not in ALLOWED_EXTENSIONS:
+        logger.error(f"Invalid output extension: {output_path.suffix}")
+        return None
+
+    # Prevent directory traversal attacks
+    if ".." in str(output_path):
+        logger.error("Directory traversal attempt detected in output_path")
+        return None
+
+    return output_path
+
+
+def normalize_heatmaps(grad_maps):
+    """
+    Stretch, threshold and smooth a stack of (N, 224, 224) gradient maps
+    in one go. Returns (heatmaps scaled to 0-1, valid), where valid[i] is
+    False if map i has no contrast to show.
+    """
+    heatmaps = np.maximum(np.asarray(grad_maps, dtype=np.float32), 0)
+
+    # Stretch each map between its own 40th and 99th percentile
+    # (one partition per map for both), done in place in float32
+    p_low, p_high = np.percentile(heatmaps, (40, 99), axis=(1, 2), keepdims=True).astype(np.float32)
+    valid = (p_high > p_low).reshape(-1)
+    heatmaps -= p_low
+    heatmaps *= 1.0 / np.maximum(p_high - p_low, 1e-6)
+    np.clip(heatmaps, 0, 1, out=heatmaps)
+
+    # Hide the faint parts so the important areas stand out
+    heatmaps[heatmaps < 0.4] = 0
+
+    # Smooth out the heatmaps so they look cleaner. Each map gets its own
+    # mirrored border (cv2's default) and the stack is blurred as one tall
+    # image; the borders keep neighbouring maps from bleeding into each other
+    n, h, w = heatmaps.shape
+    pad = _BLUR_KSIZE // 2
+    tall = np.pad(heatmaps, ((0, 0), (pad, pad), (pad, pad)), mode="reflect").reshape(n * (h + 2 * pad), w + 2 * pad)
+    blurred = cv2.GaussianBlur(tall, (_BLUR_KSIZE, _BLUR_KSIZE), sigmaX=1.5, sigmaY=1.5)
+    heatmaps = blurred.reshape(n, h + 2 * pad, w + 2 * pad)[:, pad:pad + h, pad:pad + w]
+
+    return np.ascontiguousarray(heatmaps), valid
+
+
+def _write_overlay(heatmap, original_rgb, output_path):
+    """
+    Blend a normalized heatmap over the crop and save it.
+    Returns the saved path, or None on failure.
+    """
+    try:
+        if not isinstance(original_rgb, np.ndarray) or original_rgb.ndim != 3 or original_rgb.shape[2] != 3:
+            logger.error("Invalid original_rgb for heatmap overlay")
+            return None
+
+        output_path = _check_output_path(output_path)
+        if output_path is None:
+            return None
 
         # Resize to match cropped image dimensions
         target_h, target_w = original_rgb.shape[:2]
@@ -131,12 +235,8 @@ def generate_gradcam(model, input_tensor, original_rgb, last_conv_layer_name=Non
         # Blend the heatmap with the image so you can see both
         overlay = cv2.addWeighted(original_gray_bgr, 0.45, heatmap_colored, 0.65, 0)
         
-        # Create the output folder if needed
-        output_path = Path(output_path)
-        output_path.parent.mkdir(parents=True, exist_ok=True)
-        
-        # Save the heatmap
-        cv2.imwrite(str(output_path), overlay)
+        # Save the heatmap (creates the output folder if needed)
+        write_image(output_path, overlay)
         
         # Check file was created and is within size limits
         if not output_path.exists():
@@ -149,8 +249,99 @@ def generate_gradcam(model, input_tensor, original_rgb, last_conv_layer_name=Non
             output_path.unlink(missing_ok=True)
             return None
         
-        print(f"✓ [Grad-CAM] Heatmap saved to {output_path} ({file_size} bytes)")
+        logger.debug(f"[Grad-CAM] Heatmap saved to {output_path} ({file_size} bytes)")
         return str(output_path)
+
+    except Exception as e:
+        # Track the error but don't expose details to the user
+        logger.error(f"Heatmap rendering error: {e}", exc_info=True)
+        return None
+
+
+def render_heatmap(grad_map, original_rgb, output_path):
+    """
+    Turn a (224, 224) gradient map into a heatmap overlay and save it.
+    Returns the saved path, or None on failure.
+    """
+    try:
+        heatmaps, valid = normalize_heatmaps(np.asarray(grad_map)[None])
+    except Exception as e:
+        logger.error(f"Heatmap rendering error: {e}", exc_info=True)
+        return None
+
+    if not valid[0]:
+        logger.warning("[Grad-CAM] Invalid percentile range; heatmap collapsed")
+        return None
+    return _write_overlay(heatmaps[0], original_rgb, output_path)
+
+
+def explain_batch(model, input_batch, originals_rgb, output_paths, method=None, workers=EXPLAIN_WORKERS):
+    """
+    Grad-CAM for a whole batch, for offline audits.
+    One gradient pass for the (N, 224, 224, 3) batch, one vectorized
+    normalization, then the overlays are encoded on a thread pool.
+    originals_rgb are the N crops to draw on, output_paths where to save
+    each overlay.
+
+    Returns (probabilities (N,), saved path or None per image).
+    """
+    if not (len(input_batch) == len(originals_rgb) == len(output_paths)):
+        raise ValueError("input_batch, originals_rgb and output_paths must have the same length")
+    if len(input_batch) == 0:
+        return np.zeros(0, dtype=np.float32), []
+
+    scores, grad_maps = predict_and_explain(model, input_batch, method)
+    heatmaps, valid = normalize_heatmaps(grad_maps)
+
+    def write(i):
+        if not valid[i]:
+            logger.warning(f"[Grad-CAM] Heatmap collapsed for {output_paths[i]}")
+            return None
+        return _write_overlay(heatmaps[i], originals_rgb[i], output_paths[i])
+
+    # cv2 releases the GIL while encoding, so threads write in parallel
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(input_batch))), thread_name_prefix="explain") as pool:
+        paths = list(pool.map(write, range(len(input_batch))))
+    return scores, paths
+
+
+def generate_gradcam(model, input_tensor, original_rgb, last_conv_layer_name=None, output_path=None):
+    """
+    Create a visual heatmap showing what the model is looking at.
+    Shows which parts of the image influence the anemia prediction.
+    """
+    import tensorflow as tf
+
+    try:
+        # SECURITY: Validate inputs
+        if not isinstance(input_tensor, np.ndarray) and not tf.is_tensor(input_tensor):
+            logger.error("Invalid input_tensor type")
+            return None
+        
+        if not isinstance(original_rgb, np.ndarray):
+            logger.error("Invalid original_rgb type")
+            return None
+        
+        if input_tensor.shape != (1, 224, 224, 3):
+            logger.error(f"Invalid input_tensor shape: {input_tensor.shape}, expected (1, 224, 224, 3)")
+            return None
+        
+        if original_rgb.shape[2] != 3:
+            logger.error(f"Invalid RGB channels: {original_rgb.shape[2]}, expected 3")
+            return None
+        
+        if _check_output_path(output_path) is None:
+            return None
+        
+        # One compiled pass gives both the score and the gradients. A named
+        # layer switches to classic Grad-CAM on that layer's feature maps
+        if last_conv_layer_name:
+            scores, grad_maps = predict_and_explain(model, input_tensor, "conv", last_conv_layer_name)
+        else:
+            scores, grad_maps = predict_and_explain(model, input_tensor)
+        logger.debug(f"[Grad-CAM] Prediction score: {scores[0]}")
+
+        return render_heatmap(grad_maps[0], original_rgb, output_path)
         
     except Exception as e:
         # Track the error but don't expose details to the user
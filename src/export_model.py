@@ -0,0 +1,270 @@
+# src/export_model.py
+"""
+Export the classifier (and optionally the YOLO detector) for a faster CPU
+runtime, then check the export against the Keras model.
+
+The classifier goes to TFLite or ONNX, optionally quantized:
+- float16 halves the file size with almost no change in output
+- int8 is calibrated on real crops from --input-dir, so the
+  activation ranges match what the model actually sees
+
+The parity check runs the same crops through Keras and the export and
+reports probability drift, label agreement, per-image latency and file size.
+Serve the export with ANEMO_CLASSIFIER_BACKEND=tflite (or onnx).
+
+Usage:
+    python -m src.export_model --format tflite --quantize float16 --input-dir samples/
+    python -m src.export_model --format onnx --quantize int8 --input-dir samples/ --report parity.json
+    python -m src.export_model --format onnx --detector
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from src.config import KERAS_MODEL_PATH, YOLO_MODEL_PATH, TFLITE_MODEL_PATH, ONNX_MODEL_PATH
+from src.batch_runner import collect_image_paths
+from src.preprocess import preprocess_batch
+from src.preprocess_parity import load_crops
+from src.runtimes import load_runtime
+
+FORMATS = ("tflite", "onnx")
+QUANTIZATIONS = ("none", "float16", "int8")
+DEFAULT_OUTPUTS = {"tflite": TFLITE_MODEL_PATH, "onnx": ONNX_MODEL_PATH}
+
+# Crops used to calibrate int8 quantization
+CALIBRATION_SAMPLES = 200
+
+
+def _load_keras_model():
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+    import tensorflow as tf
+    tf.get_logger().setLevel('ERROR')
+    return tf.keras.models.load_model(KERAS_MODEL_PATH)
+
+
+def load_sample_tensors(input_dir=None, glob="*", manifest=None, limit=CALIBRATION_SAMPLES):
+    """
+    Detect, crop and preprocess sample images into an (N, 224, 224, 3)
+    float32 array, or None if no samples were given.
+    """
+    if not input_dir and not manifest:
+        return None
+    paths = collect_image_paths(input_dir, glob, manifest)[:limit]
+    crops, _ = load_crops(paths)
+    if crops is None:
+        raise ValueError("No usable crops found in the sample images")
+    return preprocess_batch(crops)
+
+
+# ---- TFLite ----
+
+def export_tflite(model, output_path, quantize="none", samples=None):
+    import tensorflow as tf
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantize == "float16":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantize == "int8":
+        if samples is None:
+            raise ValueError("int8 quantization needs sample tensors for calibration")
+
+        def representative_dataset():
+            for tensor in samples:
+                yield [tensor[None].astype(np.float32)]
+
+        # Int8 weights and activations; inputs and outputs stay float so the
+        # runtime can be swapped in without touching preprocessing
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+
+    Path(output_path).write_bytes(converter.convert())
+
+
+# ---- ONNX ----
+
+class _CalibrationReader:
+    """Feeds sample tensors to onnxruntime's static quantizer one at a time."""
+
+    def __init__(self, input_name, samples):
+        self._batches = iter([{input_name: tensor[None].astype(np.float32)} for tensor in samples])
+
+    def get_next(self):
+        return next(self._batches, None)
+
+
+def export_onnx(model, output_path, quantize="none", samples=None):
+    import tensorflow as tf
+    import tf2onnx
+
+    signature = [tf.TensorSpec((None, 224, 224, 3), tf.float32, name="input")]
+    if quantize == "none":
+        tf2onnx.convert.from_keras(model, input_signature=signature, opset=13, output_path=str(output_path))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        float_path = Path(tmp) / "float.onnx"
+        tf2onnx.convert.from_keras(model, input_signature=signature, opset=13, output_path=str(float_path))
+
+        if quantize == "float16":
+            import onnx
+            from onnxconverter_common import float16
+            # keep_io_types leaves the float32 input/output in place
+            converted = float16.convert_float_to_float16(onnx.load(str(float_path)), keep_io_types=True)
+            onnx.save(converted, str(output_path))
+        else:
+            from onnxruntime.quantization import QuantType, quantize_static
+            quantize_static(
+                str(float_path), str(output_path), _CalibrationReader("input", samples),
+                weight_type=QuantType.QInt8, activation_type=QuantType.QInt8,
+            )
+
+
+def _write_calibration_yaml(folder, image_paths, names):
+    """
+    Ultralytics calibrates int8 exports from a dataset YAML, not a folder of
+    images: list the sample images in a text file and point both splits at
+    it. No labels are needed, calibration only runs the images through.
+    """
+    folder = Path(folder)
+    list_path = folder / "calibration.txt"
+    list_path.write_text("".join(f"{Path(p).resolve()}\n" for p in image_paths))
+
+    # JSON strings are valid YAML and quote paths safely
+    lines = [
+        f"path: {json.dumps(str(folder))}",
+        f"train: {json.dumps(str(list_path))}",
+        f"val: {json.dumps(str(list_path))}",
+        "names:",
+    ]
+    lines += [f"  {int(index)}: {json.dumps(str(name))}" for index, name in sorted(names.items())]
+    data_path = folder / "calibration.yaml"
+    data_path.write_text("\n".join(lines) + "\n")
+    return data_path
+
+
+def export_detector(fmt, quantize="none", sample_paths=None):
+    """
+    Export the YOLO detector with Ultralytics' own exporter. Returns the
+    exported file's path (point ANEMO_YOLO_MODEL_PATH at it to use it).
+    int8 needs sample_paths, the images to calibrate on.
+    """
+    from ultralytics import YOLO
+
+    model = YOLO(str(YOLO_MODEL_PATH))
+    options = {"format": fmt}
+    if quantize == "float16":
+        options["half"] = True
+    elif quantize == "int8":
+        if not sample_paths:
+            raise ValueError("int8 quantization needs sample images for calibration")
+        options["int8"] = True
+        with tempfile.TemporaryDirectory() as tmp:
+            options["data"] = str(_write_calibration_yaml(tmp, sample_paths, model.names))
+            return model.export(**options)
+    return model.export(**options)
+
+
+# ---- parity ----
+
+def _latency_ms(predict, samples, repeats=3):
+    # Single-image latency, as /predict sees it without batching
+    predict(samples[:1])
+    timings = []
+    for _ in range(repeats):
+        for tensor in samples[:50]:
+            start = time.perf_counter()
+            predict(tensor[None])
+            timings.append(time.perf_counter() - start)
+    return 1000 * float(np.median(timings))
+
+
+def parity_report(keras_model, runtime, samples, batch_size=16):
+    """
+    Compare an exported runtime against the Keras model on the same tensors.
+    """
+    def keras_predict(batch):
+        return keras_model.predict(batch, verbose=0)[:, 0]
+
+    def runtime_predict(batch):
+        return runtime.predict(batch)[:, 0]
+
+    reference = np.concatenate([keras_predict(samples[i:i + batch_size]) for i in range(0, len(samples), batch_size)])
+    probs = np.concatenate([runtime_predict(samples[i:i + batch_size]) for i in range(0, len(samples), batch_size)])
+    drift = np.abs(probs - reference)
+
+    keras_ms = _latency_ms(keras_predict, samples)
+    runtime_ms = _latency_ms(runtime_predict, samples)
+
+    return {
+        "images": int(len(samples)),
+        "prob_drift_mean": float(drift.mean()),
+        "prob_drift_p95": float(np.percentile(drift, 95)),
+        "prob_drift_max": float(drift.max()),
+        "label_agreement": float(np.mean((probs >= 0.5) == (reference >= 0.5))),
+        "keras_ms_per_image": keras_ms,
+        "runtime_ms_per_image": runtime_ms,
+        "speedup": keras_ms / runtime_ms if runtime_ms > 0 else None,
+        "keras_file_bytes": KERAS_MODEL_PATH.stat().st_size,
+        "runtime_file_bytes": Path(runtime.path).stat().st_size,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the classifier to TFLite/ONNX and check it against Keras")
+    parser.add_argument("--format", choices=FORMATS, default="tflite")
+    parser.add_argument("--quantize", choices=QUANTIZATIONS, default="none")
+    parser.add_argument("--output", help="Exported classifier path (defaults to the path the backend loads)")
+    parser.add_argument("--input-dir", help="Sample images for int8 calibration and the parity check")
+    parser.add_argument("--glob", default="*", help="Pattern for files inside --input-dir")
+    parser.add_argument("--manifest", help="Text/CSV file listing sample images")
+    parser.add_argument("--limit", type=int, default=CALIBRATION_SAMPLES, help="Maximum number of sample images")
+    parser.add_argument("--detector", action="store_true", help="Also export the YOLO detector")
+    parser.add_argument("--report", help="Write the parity report as JSON to this file")
+    args = parser.parse_args()
+
+    samples = load_sample_tensors(args.input_dir, args.glob, args.manifest, args.limit)
+    if args.quantize == "int8" and samples is None:
+        parser.error("int8 quantization needs sample images (--input-dir or --manifest) for calibration")
+
+    output_path = Path(args.output) if args.output else DEFAULT_OUTPUTS[args.format]
+    keras_model = _load_keras_model()
+
+    print(f"Exporting classifier to {output_path} ({args.format}, quantize={args.quantize})...")
+    exporter = export_tflite if args.format == "tflite" else export_onnx
+    exporter(keras_model, output_path, args.quantize, samples)
+    print(f"Saved {output_path} ({output_path.stat().st_size / 1e6:.1f} MB, "
+          f"Keras: {KERAS_MODEL_PATH.stat().st_size / 1e6:.1f} MB)")
+
+    if args.detector:
+        print("Exporting detector...")
+        sample_paths = None
+        if args.input_dir or args.manifest:
+            sample_paths = collect_image_paths(args.input_dir, args.glob, args.manifest)[:args.limit]
+        detector_path = export_detector(args.format, args.quantize, sample_paths)
+        print(f"Saved {detector_path} (set ANEMO_YOLO_MODEL_PATH to use it)")
+
+    if samples is None:
+        print("No sample images given; skipping the parity check.")
+        return
+
+    report = parity_report(keras_model, load_runtime(args.format, output_path), samples)
+    print(f"\nParity over {report['images']} images:")
+    for key, value in report.items():
+        print(f"  {key:<22} {value:.4f}" if isinstance(value, float) else f"  {key:<22} {value}")
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(dict(report, format=args.format, quantize=args.quantize), f, indent=2)
+        print(f"\nSaved report to {args.report}")
+
+
+if __name__ == "__main__":
+    main()
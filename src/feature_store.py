@@ -0,0 +1,417 @@
+# src/feature_store.py
+"""
+Offline feature store for evaluating on a labeled image archive.
+Detection and preprocessing (the non-local means denoise in particular)
+are most of the cost of an evaluation run, and their output only depends
+on the image and on the detector / preprocessing version. The store keeps
+both once per version on disk:
+
+    feature_store/<version>/crops.npy     (N, 224, 224, 3) uint8 crops
+    feature_store/<version>/tensors.npy   (N, 224, 224, 3) uint8 preprocessed
+    feature_store/<version>/index.csv     row, path, label, status
+    feature_store/<version>/meta.json     what the version is made of
+
+Tensors are stored as the preprocessed 0-255 image (preprocessing ends
+with a division by 255), so they take a quarter of the space of float32
+and read back bit-identical. Both arrays are memory-mapped, so reading a
+batch is a slice of the file and only the float conversion copies.
+
+Usage:
+    python -m src.feature_store build --manifest labeled.csv
+    python -m src.feature_store evaluate --output report.json
+"""
+
+import argparse
+import csv
+import hashlib
+import json
+import logging
+import shutil
+import time
+from pathlib import Path
+
+import numpy as np
+
+from src.config import FEATURE_STORE_DIR, YOLO_MODEL_PATH, DETECT_IMGSZ, PREPROCESS_ENGINE
+from src.models import file_version
+
+logger = logging.getLogger(__name__)
+
+# Bumped when the store layout changes
+STORE_FORMAT = 1
+
+INDEX_FIELDS = ["row", "path", "label", "status"]
+
+CROP_SHAPE = (224, 224, 3)
+
+
+def store_version(engine=None):
+    """
+    (version key, parts) for the current detector weights, detection size,
+    preprocessing engine and preprocessing code. Any change gives a new key.
+    """
+    from src import preprocess
+
+    engine = engine or PREPROCESS_ENGINE
+    parts = {
+        "format": STORE_FORMAT,
+        "detector": file_version(YOLO_MODEL_PATH),
+        "detect_imgsz": DETECT_IMGSZ,
+        "engine": engine,
+        "preprocess": hashlib.sha1(Path(preprocess.__file__).read_bytes()).hexdigest()[:12],
+    }
+    key = hashlib.sha1(json.dumps(parts, sort_keys=True).encode()).hexdigest()[:12]
+    return key, parts
+
+
+def _to_float(stored, engine, out):
+    # The same final step as the engine's preprocessing, so the result is
+    # bit-identical to what preprocess_image returns
+    if engine == "fast":
+        return np.multiply(stored, np.float32(1.0 / 255.0), out=out, dtype=np.float32)
+    return np.divide(stored, np.float32(255.0), out=out, dtype=np.float32)
+
+
+class FeatureStore:
+    """
+    A built store, opened read-only. crops is the memory-mapped (N, 224,
+    224, 3) uint8 array; rows whose image could not be read or had no
+    detection are False in ok and left zero.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        meta_path = self.path / "meta.json"
+        if not meta_path.exists():
+            raise ValueError(f"No finished feature store at {self.path}")
+        self.meta = json.loads(meta_path.read_text())
+        self.engine = self.meta["parts"]["engine"]
+
+        with (self.path / "index.csv").open(newline="") as f:
+            rows = list(csv.DictReader(f))
+        self.paths = [row["path"] for row in rows]
+        self.labels = np.array([int(row["label"]) for row in rows], dtype=np.int32)
+        self.ok = np.array([row["status"] == "ok" for row in rows], dtype=bool)
+
+        self.crops = np.load(self.path / "crops.npy", mmap_mode="r")
+        self._tensors = np.load(self.path / "tensors.npy", mmap_mode="r")
+
+    @classmethod
+    def current(cls, root=FEATURE_STORE_DIR, engine=None):
+        """The store for the current detector / preprocessing version."""
+        key, _ = store_version(engine)
+        path = Path(root) / key
+        if not (path / "meta.json").exists():
+            raise ValueError(
+                f"No feature store for the current models at {path}. Build it with: python -m src.feature_store build"
+            )
+        return cls(path)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def tensors(self, start, stop, out=None):
+        """Preprocessed float32 tensors for rows start:stop, like preprocess_batch returns."""
+        stored = self._tensors[start:stop]
+        if out is None:
+            out = np.empty(stored.shape, dtype=np.float32)
+        return _to_float(stored, self.engine, out[:len(stored)])
+
+    def batches(self, batch_size=256):
+        """
+        Yield (row indices, float32 tensors) for the usable rows, batch_size
+        rows of the file at a time. The tensor buffer is reused between
+        batches.
+        """
+        buffer = np.empty((batch_size,) + CROP_SHAPE, dtype=np.float32)
+        for start in range(0, len(self), batch_size):
+            stop = min(start + batch_size, len(self))
+            ok = self.ok[start:stop]
+            if not ok.any():
+                continue
+            batch = self.tensors(start, stop, buffer)
+            rows = np.arange(start, stop)
+            if not ok.all():
+                batch, rows = batch[ok], rows[ok]
+            yield rows, batch
+
+
+def build_store(paths, labels=None, root=FEATURE_STORE_DIR, engine=None, batch_size=32, force=False):
+    """
+    Detect, crop and preprocess every path into the store for the current
+    version. labels (1 anemic / 0, or None for unlabeled) follow paths.
+    An existing store for the version is reused unless force is set.
+    Returns the opened FeatureStore.
+    """
+    from src.detector import detect_and_crop_batch, load_image
+    from src.preprocess import preprocess_batch
+
+    key, parts = store_version(engine)
+    path = Path(root) / key
+    if (path / "meta.json").exists() and not force:
+        logger.info(f"Feature store {path} is already built for this version")
+        return FeatureStore(path)
+
+    # Build into a temporary folder and rename it once complete, so a
+    # crashed build never looks finished
+    partial = Path(root) / f"{key}.partial"
+    shutil.rmtree(partial, ignore_errors=True)
+    partial.mkdir(parents=True)
+
+    n = len(paths)
+    labels = np.full(n, -1, dtype=np.int32) if labels is None else np.asarray(labels, dtype=np.int32)
+    crops = np.lib.format.open_memmap(partial / "crops.npy", mode="w+", dtype=np.uint8, shape=(n,) + CROP_SHAPE)
+    tensors = np.lib.format.open_memmap(partial / "tensors.npy", mode="w+", dtype=np.uint8, shape=(n,) + CROP_SHAPE)
+    buffer = np.empty((batch_size,) + CROP_SHAPE, dtype=np.float32)
+    status = ["pending"] * n
+
+    start_time = time.perf_counter()
+    for start in range(0, n, batch_size):
+        rows, images = [], []
+        for row in range(start, min(start + batch_size, n)):
+            try:
+                images.append(load_image(paths[row]))
+                rows.append(row)
+            except ValueError:
+                status[row] = "unreadable"
+
+        found = []
+        if images:
+            names = [Path(paths[row]).name for row in rows]
+            for row, crop_rgb in zip(rows, detect_and_crop_batch(images, names, save_boxed=False)):
+                if crop_rgb is None:
+                    status[row] = "no_detection"
+                else:
+                    crops[row] = crop_rgb
+                    found.append(row)
+
+        if found:
+            # Rows found in one batch are not always contiguous, so
+            # preprocess from a stacked copy
+            batch = preprocess_batch(crops[found], engine=parts["engine"], out=buffer[:len(found)])
+            if batch is None:
+                raise ValueError(f"Preprocessing failed on the batch starting at row {start}")
+            # Exact: every value is a whole number of 255ths
+            tensors[found] = np.rint(batch * 255)
+            for row in found:
+                status[row] = "ok"
+
+        logger.info(f"Stored {min(start + batch_size, n)}/{n} images")
+
+    crops.flush()
+    tensors.flush()
+    del crops, tensors
+
+    with (partial / "index.csv").open("w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(INDEX_FIELDS)
+        writer.writerows((row, str(paths[row]), int(labels[row]), status[row]) for row in range(n))
+
+    meta = {
+        "version": key,
+        "parts": parts,
+        "images": n,
+        "usable": status.count("ok"),
+        "built": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "build_seconds": round(time.perf_counter() - start_time, 2),
+    }
+    (partial / "meta.json").write_text(json.dumps(meta, indent=2))
+
+    shutil.rmtree(path, ignore_errors=True)
+    partial.rename(path)
+    return FeatureStore(path)
+
+
+def classify_store(store, batch_size=256):
+    """
+    Anemia probability for every usable row, one model call per batch.
+    Returns (probabilities with NaN for unusable rows, model seconds).
+    """
+    from src.classifier import predict_probabilities
+
+    probs = np.full(len(store), np.nan, dtype=np.float32)
+    seconds = 0.0
+    for rows, batch in store.batches(batch_size):
+        start = time.perf_counter()
+        probs[rows] = predict_probabilities(batch)
+        seconds += time.perf_counter() - start
+    return probs, seconds
+
+
+# ---- metrics (labels 1 = anemic, probabilities of anemia) ----
+
+def roc_curve(labels, probs):
+    """
+    (false positive rates, true positive rates, thresholds) with one point
+    per distinct probability, highest threshold first.
+    """
+    order = np.argsort(-probs, kind="stable")
+    probs, labels = probs[order], labels[order]
+    # Last position of each run of equal probabilities
+    ends = np.append(np.flatnonzero(np.diff(probs)), len(probs) - 1)
+    tps = np.cumsum(labels)[ends]
+    fps = ends + 1 - tps
+    positives, negatives = max(tps[-1], 1), max(fps[-1], 1)
+    return (np.append(0.0, fps / negatives), np.append(0.0, tps / positives),
+            np.append(np.inf, probs[ends]))
+
+
+def roc_auc(fpr, tpr):
+    # Trapezoid rule
+    return float(np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2))
+
+
+def confusion(labels, probs, threshold=0.5):
+    """Confusion matrix counts and the usual rates at one threshold."""
+    predicted = probs >= threshold
+    tp = int(np.sum(predicted & (labels == 1)))
+    fp = int(np.sum(predicted & (labels == 0)))
+    fn = int(np.sum(~predicted & (labels == 1)))
+    tn = int(np.sum(~predicted & (labels == 0)))
+
+    def ratio(a, b):
+        return a / b if b else None
+
+    precision, recall = ratio(tp, tp + fp), ratio(tp, tp + fn)
+    return {
+        "threshold": threshold,
+        "tp": tp, "fp": fp, "fn": fn, "tn": tn,
+        "accuracy": ratio(tp + tn, len(labels)),
+        "sensitivity": recall,
+        "specificity": ratio(tn, tn + fp),
+        "precision": precision,
+        "f1": ratio(2 * precision * recall, precision + recall) if precision and recall else None,
+    }
+
+
+def calibration(labels, probs, bins=10):
+    """
+    Reliability table over equal-width probability bins, with the expected
+    calibration error (count-weighted gap) and Brier score.
+    """
+    index = np.minimum((probs * bins).astype(int), bins - 1)
+    counts = np.bincount(index, minlength=bins)
+    predicted = np.bincount(index, weights=probs, minlength=bins)
+    observed = np.bincount(index, weights=labels, minlength=bins)
+    filled = counts > 0
+    mean_predicted = np.divide(predicted, counts, out=np.zeros(bins), where=filled)
+    fraction_anemic = np.divide(observed, counts, out=np.zeros(bins), where=filled)
+    return {
+        "bins": [
+            {"low": i / bins, "high": (i + 1) / bins, "count": int(counts[i]),
+             "mean_predicted": float(mean_predicted[i]), "fraction_anemic": float(fraction_anemic[i])}
+            for i in range(bins) if filled[i]
+        ],
+        "ece": float(np.sum(counts * np.abs(mean_predicted - fraction_anemic)) / len(probs)),
+        "brier": float(np.mean((probs - labels) ** 2)),
+    }
+
+
+def evaluation_report(labels, probs, threshold=0.5, bins=10, roc_points=101):
+    """All metrics for labeled probabilities, with the ROC curve resampled to roc_points thresholds."""
+    fpr, tpr, thresholds = roc_curve(labels, probs)
+    grid = np.linspace(1.0, 0.0, roc_points)
+    # For each grid threshold, the last curve point whose threshold is still >= it
+    at = np.searchsorted(-thresholds, -grid, side="right") - 1
+    return {
+        "images": int(len(labels)),
+        "anemic": int(labels.sum()),
+        "auc": roc_auc(fpr, tpr),
+        "confusion": confusion(labels, probs, threshold),
+        "calibration": calibration(labels, probs, bins),
+        "roc": {"threshold": grid.round(4).tolist(), "fpr": fpr[at].tolist(), "tpr": tpr[at].tolist()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and evaluate the offline crop/tensor feature store")
+    parser.add_argument("--root", default=str(FEATURE_STORE_DIR), help="Folder holding one store per version")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = commands.add_parser("build", help="Detect, crop and preprocess an image set once")
+    build_parser.add_argument("--manifest", help="CSV with path (and label) columns, or a text list of paths")
+    build_parser.add_argument("--input-dir", help="Folder of images (unlabeled)")
+    build_parser.add_argument("--glob", default="*", help="Pattern for files inside --input-dir")
+    build_parser.add_argument("--engine", help="Preprocessing engine (default: ANEMO_PREPROCESS_ENGINE)")
+    build_parser.add_argument("--batch-size", type=int, default=32)
+    build_parser.add_argument("--force", action="store_true", help="Rebuild even if the version is already stored")
+
+    eval_parser = commands.add_parser("evaluate", help="Classify a store and report ROC, confusion and calibration")
+    eval_parser.add_argument("--store", help="Store folder (default: the current version under --root)")
+    eval_parser.add_argument("--engine", help="Preprocessing engine of the store to use")
+    eval_parser.add_argument("--batch-size", type=int, default=256)
+    eval_parser.add_argument("--threshold", type=float, default=0.5, help="Threshold for the confusion matrix")
+    eval_parser.add_argument("--bins", type=int, default=10, help="Calibration bins")
+    eval_parser.add_argument("--predictions", help="Also save the probabilities (.npy, NaN for unusable rows)")
+    eval_parser.add_argument("--output", help="Write the report as JSON to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+
+    if args.command == "build":
+        from src.batch_runner import collect_image_paths, load_labeled_manifest
+
+        if not args.input_dir and not args.manifest:
+            parser.error("Give --manifest or --input-dir")
+        labels = None
+        if args.manifest and args.input_dir is None and Path(args.manifest).suffix.lower() == ".csv":
+            with open(args.manifest, newline="") as f:
+                labeled = "label" in (csv.DictReader(f).fieldnames or [])
+            if labeled:
+                paths, labels = load_labeled_manifest(args.manifest)
+        if labels is None:
+            paths = collect_image_paths(args.input_dir, args.glob, args.manifest)
+        if not paths:
+            print("No images found.")
+            return
+
+        store = build_store(paths, labels, args.root, args.engine, args.batch_size, args.force)
+        meta = store.meta
+        print(f"\nStore {store.path}: {meta['usable']}/{meta['images']} usable images "
+              f"(built in {meta['build_seconds']}s, {meta['parts']['engine']} preprocessing)")
+        return
+
+    store = FeatureStore(args.store) if args.store else FeatureStore.current(args.root, args.engine)
+    probs, seconds = classify_store(store, args.batch_size)
+    usable = store.ok & (store.labels >= 0)
+    if not usable.any():
+        print(f"No labeled usable images in {store.path}")
+        return
+
+    report = evaluation_report(store.labels[usable], probs[usable], args.threshold, args.bins)
+    report["store"] = str(store.path)
+    report["version"] = store.meta["parts"]
+    report["skipped"] = int(len(store) - usable.sum())
+    report["classify_images_per_sec"] = float(store.ok.sum() / seconds) if seconds > 0 else None
+
+    c = report["confusion"]
+
+    def fmt(value):
+        return f"{value:.3f}" if value is not None else "-"
+
+    print(f"\n{report['images']} images ({report['anemic']} anemic) from {store.path}, {report['skipped']} skipped")
+    print(f"Classifier: {report['classify_images_per_sec']:.1f} images/sec")
+    print(f"AUC {report['auc']:.3f}")
+    print(f"At threshold {c['threshold']}: accuracy {fmt(c['accuracy'])}, sensitivity {fmt(c['sensitivity'])}, "
+          f"specificity {fmt(c['specificity'])}, precision {fmt(c['precision'])}, F1 {fmt(c['f1'])}")
+    print(f"                  predicted ANEMIC  predicted NON-ANEMIC")
+    print(f"  ANEMIC          {c['tp']:16d}  {c['fn']:20d}")
+    print(f"  NON-ANEMIC      {c['fp']:16d}  {c['tn']:20d}")
+    print(f"Calibration: ECE {report['calibration']['ece']:.3f}, Brier {report['calibration']['brier']:.3f}")
+    for b in report["calibration"]["bins"]:
+        print(f"  {b['low']:.1f}-{b['high']:.1f}  n={b['count']:<6d} predicted {b['mean_predicted']:.3f}  "
+              f"actual {b['fraction_anemic']:.3f}")
+
+    if args.predictions:
+        np.save(args.predictions, probs)
+        print(f"Saved probabilities to {args.predictions}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved report to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,474 @@
+# src/jobs.py
+"""
+Bulk screening jobs.
+A job is a set of images uploaded together (as a zip or as many files).
+The upload is saved to disk and the job id returned straight away; the
+images then run through the same batched pipeline as /predict in the
+background, a few dozen at a time so the model batches stay full.
+Progress and per-image results are kept in a small SQLite database, so a
+restarted server picks unfinished jobs back up. When a job finishes, its
+results and result images are packed into one zip bundle.
+"""
+
+import asyncio
+import csv
+import io
+import json
+import logging
+import shutil
+import sqlite3
+import threading
+import time
+import zipfile
+from pathlib import Path
+
+from src.config import (
+    JOBS_DIR, JOB_MAX_IMAGES, JOB_MAX_UPLOAD_BYTES, JOB_WORKERS, JOB_CONCURRENCY, RETRY_AFTER_SECONDS,
+    JOBS_TTL_SECONDS, RESULTS_SWEEP_INTERVAL,
+)
+from src.detector import ALLOWED_EXTENSIONS
+from src.pipeline import run_pipeline_async
+from src.admission import Overloaded
+from src.quality import QualityRejected
+from src.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+JOB_IMAGES = metrics.counter("anemo_job_images", "Images processed by bulk jobs, by outcome", ["status"])
+
+# Columns of the bundled results; image paths point inside the zip
+BUNDLE_FIELDS = ["index", "name", "status", "label", "confidence", "boxed_image", "heatmap", "error"]
+
+# Times an image is retried when the model queues are full
+MAX_ATTEMPTS = 5
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    explain INTEGER NOT NULL,
+    total INTEGER NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS items (
+    job_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    file TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    label TEXT,
+    confidence REAL,
+    boxed_image_path TEXT,
+    heatmap_path TEXT,
+    error TEXT,
+    PRIMARY KEY (job_id, idx)
+);
+"""
+
+
+class JobStore:
+    """
+    Jobs and their per-image results in SQLite. One connection shared
+    under a lock, so it can be used from the event loop and worker threads.
+    Nothing touches the disk until open(). Finished jobs older than
+    ttl_seconds (0: keep forever) are removed by sweep().
+    """
+
+    def __init__(self, root=JOBS_DIR, ttl_seconds=JOBS_TTL_SECONDS):
+        self.root = Path(root)
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._db = None
+        self._stop = threading.Event()
+        self._sweeper = None
+
+    def open(self):
+        """Create the folder and database if needed and connect."""
+        with self._lock:
+            if self._db is not None:
+                return
+            self.root.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(str(self.root / "jobs.sqlite3"), check_same_thread=False)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(_SCHEMA)
+            self._db = db
+
+    def _connection(self):
+        # Callers hold self._lock
+        if self._db is None:
+            raise RuntimeError("Job store is not open")
+        return self._db
+
+    def job_dir(self, job_id):
+        return self.root / job_id
+
+    def inputs_dir(self, job_id):
+        return self.job_dir(job_id) / "inputs"
+
+    def bundle_path(self, job_id):
+        return self.job_dir(job_id) / f"{job_id}.zip"
+
+    def create(self, job_id, items, explain=False):
+        """Record a new job. items is a list of (original name, saved file name)."""
+        with self._lock, self._connection() as db:
+            db.execute(
+                "INSERT INTO jobs (id, status, explain, total, created) VALUES (?, 'queued', ?, ?, ?)",
+                (job_id, int(explain), len(items), time.time()),
+            )
+            db.executemany(
+                "INSERT INTO items (job_id, idx, name, file) VALUES (?, ?, ?, ?)",
+                [(job_id, i, name, file) for i, (name, file) in enumerate(items)],
+            )
+
+    def get(self, job_id):
+        """The job's row as a dict, or None if unknown."""
+        with self._lock:
+            row = self._connection().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["explain"] = bool(job["explain"])
+        return job
+
+    def set_status(self, job_id, status, error=None):
+        now = time.time()
+        with self._lock, self._connection() as db:
+            if status == "running":
+                db.execute("UPDATE jobs SET status = ?, started = COALESCE(started, ?) WHERE id = ?",
+                           (status, now, job_id))
+            elif status in ("done", "failed"):
+                db.execute("UPDATE jobs SET status = ?, finished = ?, error = ? WHERE id = ?",
+                           (status, now, error, job_id))
+            else:
+                db.execute("UPDATE jobs SET status = ? WHERE id = ?", (status, job_id))
+
+    def pending(self, job_id):
+        """(index, name, saved file name) for images not processed yet."""
+        with self._lock:
+            rows = self._connection().execute(
+                "SELECT idx, name, file FROM items WHERE job_id = ? AND status = 'pending' ORDER BY idx", (job_id,)
+            ).fetchall()
+        return [tuple(row) for row in rows]
+
+    def record(self, job_id, index, result):
+        """Save one image's result and bump the job's progress counters."""
+        counter = "done" if result["status"] == "ok" else "failed"
+        with self._lock, self._connection() as db:
+            db.execute(
+                "UPDATE items SET status = ?, label = ?, confidence = ?, boxed_image_path = ?, heatmap_path = ?, "
+                "error = ? WHERE job_id = ? AND idx = ?",
+                (result["status"], result.get("label"), result.get("confidence"), result.get("boxed_image_path"),
+                 result.get("heatmap_path"), result.get("error"), job_id, index),
+            )
+            db.execute(f"UPDATE jobs SET {counter} = {counter} + 1 WHERE id = ?", (job_id,))
+
+    def results(self, job_id, page_size=500):
+        """Yield finished results in index order, a page at a time."""
+        last = -1
+        while True:
+            with self._lock:
+                rows = self._connection().execute(
+                    "SELECT idx AS 'index', name, status, label, confidence, boxed_image_path, heatmap_path, error "
+                    "FROM items WHERE job_id = ? AND status != 'pending' AND idx > ? ORDER BY idx LIMIT ?",
+                    (job_id, last, page_size),
+                ).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield dict(row)
+            last = rows[-1]["index"]
+
+    def unfinished(self):
+        """Ids of jobs that were queued or running (e.g. before a restart)."""
+        with self._lock:
+            rows = self._connection().execute(
+                "SELECT id FROM jobs WHERE status IN ('queued', 'running') ORDER BY created"
+            ).fetchall()
+        return [row["id"] for row in rows]
+
+    def sweep(self, now=None):
+        """
+        Delete finished jobs (rows, uploads and bundle) older than the TTL,
+        and job folders without a job (e.g. left by a crash mid-upload) once
+        they are as old. Returns the number of jobs removed.
+        """
+        if not self.ttl_seconds:
+            return 0
+        cutoff = (time.time() if now is None else now) - self.ttl_seconds
+
+        with self._lock, self._connection() as db:
+            expired = [
+                row["id"] for row in db.execute(
+                    "SELECT id FROM jobs WHERE status IN ('done', 'failed') AND finished < ?", (cutoff,)
+                ).fetchall()
+            ]
+            db.executemany("DELETE FROM items WHERE job_id = ?", [(job_id,) for job_id in expired])
+            db.executemany("DELETE FROM jobs WHERE id = ?", [(job_id,) for job_id in expired])
+            known = {row["id"] for row in db.execute("SELECT id FROM jobs").fetchall()}
+
+        for job_id in expired:
+            shutil.rmtree(self.job_dir(job_id), ignore_errors=True)
+
+        orphans = 0
+        for path in self.root.iterdir():
+            try:
+                if path.is_dir() and path.name not in known and path.stat().st_mtime < cutoff:
+                    shutil.rmtree(path, ignore_errors=True)
+                    orphans += 1
+            except OSError:
+                continue
+
+        if expired or orphans:
+            logger.info(f"Jobs sweep removed {len(expired)} expired jobs and {orphans} orphaned folders")
+        return len(expired) + orphans
+
+    def _sweep_loop(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"Jobs sweep failed: {e}", exc_info=True)
+
+    def start_sweeper(self, interval=RESULTS_SWEEP_INTERVAL):
+        """Sweep once now, then every interval seconds on a daemon thread."""
+        if interval <= 0 or not self.ttl_seconds or (self._sweeper is not None and self._sweeper.is_alive()):
+            return
+        self.sweep()
+        self._stop.clear()
+        self._sweeper = threading.Thread(
+            target=self._sweep_loop, args=(interval,), name="jobs-sweeper", daemon=True
+        )
+        self._sweeper.start()
+
+    def stop_sweeper(self):
+        self._stop.set()
+        if self._sweeper is not None:
+            self._sweeper.join(timeout=5)
+            self._sweeper = None
+
+    def close(self):
+        self.stop_sweeper()
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+def collect_inputs(uploads, inputs_dir, max_image_bytes, max_images=JOB_MAX_IMAGES,
+                   max_total_bytes=JOB_MAX_UPLOAD_BYTES):
+    """
+    Save uploaded images to inputs_dir, expanding zip files.
+    uploads is a list of (filename, binary file object). Files are saved
+    under numbered names, so names inside a zip never become paths.
+    Returns a list of (original name, saved file name).
+    Raises ValueError for unsupported files or when a limit is exceeded.
+    """
+    inputs_dir = Path(inputs_dir)
+    inputs_dir.mkdir(parents=True, exist_ok=True)
+    items = []
+    total = 0
+
+    def save(name, data):
+        nonlocal total
+        if len(items) >= max_images:
+            raise ValueError(f"Too many images. Maximum per job: {max_images}")
+        if len(data) > max_image_bytes:
+            raise ValueError(f"Image too large: {name}")
+        total += len(data)
+        if total > max_total_bytes:
+            raise ValueError("Upload too large")
+        saved = f"{len(items):05d}{Path(name).suffix.lower()}"
+        (inputs_dir / saved).write_bytes(data)
+        items.append((name, saved))
+
+    for filename, fileobj in uploads:
+        suffix = Path(filename or "").suffix.lower()
+        if suffix == ".zip":
+            try:
+                archive = zipfile.ZipFile(fileobj)
+            except zipfile.BadZipFile:
+                raise ValueError(f"Not a valid zip file: {filename}")
+            with archive:
+                for info in archive.infolist():
+                    name = Path(info.filename).name
+                    # Skip folders, macOS metadata and anything that isn't an image
+                    if info.is_dir() or info.filename.startswith("__MACOSX/") or name.startswith("."):
+                        continue
+                    if Path(name).suffix.lower() not in ALLOWED_EXTENSIONS:
+                        continue
+                    if info.file_size > max_image_bytes:
+                        raise ValueError(f"Image too large: {name}")
+                    # Read at most one byte past the limit, in case the header lies
+                    with archive.open(info) as member:
+                        save(name, member.read(max_image_bytes + 1))
+        elif suffix in ALLOWED_EXTENSIONS:
+            save(Path(filename).name, fileobj.read(max_image_bytes + 1))
+        else:
+            raise ValueError(f"File type not supported: {filename}. Upload images or a zip")
+
+    if not items:
+        raise ValueError("No images found in the upload")
+    return items
+
+
+def result_lines(rows, fields, fmt="jsonl"):
+    """Turn result rows into JSONL or CSV text with the given columns, one chunk per row."""
+    if fmt == "jsonl":
+        for row in rows:
+            yield json.dumps({field: row.get(field) for field in fields}) + "\n"
+        return
+
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields, extrasaction="ignore")
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def build_bundle(store, job_id):
+    """
+    Zip a finished job's results (JSONL and CSV) and result images.
+    Image paths in the bundled results point inside the zip.
+    """
+    rows = []
+    files = []
+    for row in store.results(job_id):
+        stem = f"{row['index']:05d}_{Path(row['name']).stem}"
+        for key, field, folder in (("boxed_image_path", "boxed_image", "boxed"), ("heatmap_path", "heatmap", "heatmaps")):
+            path = row.get(key)
+            row[field] = None
+            if path and Path(path).exists():
+                row[field] = f"{folder}/{stem}{Path(path).suffix}"
+                files.append((path, row[field]))
+        rows.append(row)
+
+    bundle_path = store.bundle_path(job_id)
+    partial = bundle_path.with_suffix(".partial")
+    with zipfile.ZipFile(partial, "w", compression=zipfile.ZIP_DEFLATED) as bundle:
+        bundle.writestr("results.jsonl", "".join(result_lines(rows, BUNDLE_FIELDS, "jsonl")))
+        bundle.writestr("results.csv", "".join(result_lines(rows, BUNDLE_FIELDS, "csv")))
+        for path, arcname in files:
+            # Images are already compressed
+            bundle.write(path, arcname, compress_type=zipfile.ZIP_STORED)
+    partial.replace(bundle_path)
+    return bundle_path
+
+
+class JobRunner:
+    """
+    Runs jobs in the background on the API's event loop, JOB_WORKERS jobs
+    at a time, each with up to JOB_CONCURRENCY images in the pipeline.
+    batchers and limits are the ones /predict uses, so job images share
+    model batches with live requests.
+    """
+
+    def __init__(self, store, batchers, limits=None, workers=JOB_WORKERS, concurrency=JOB_CONCURRENCY):
+        self.store = store
+        self.batchers = batchers
+        self.limits = limits
+        self.concurrency = max(1, concurrency)
+        self._slots = asyncio.Semaphore(max(1, workers))
+        self._tasks = {}
+
+    def submit(self, job_id):
+        """Queue a stored job to run."""
+        if job_id in self._tasks:
+            return
+        task = asyncio.ensure_future(self._run(job_id))
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job_id, None))
+
+    def resume(self):
+        """Queue jobs left unfinished by a previous run."""
+        for job_id in self.store.unfinished():
+            logger.info(f"Resuming job {job_id}")
+            self.submit(job_id)
+
+    async def stop(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self, job_id):
+        loop = asyncio.get_event_loop()
+        async with self._slots:
+            job = self.store.get(job_id)
+            self.store.set_status(job_id, "running")
+            logger.info(f"Job {job_id}: {job['total']} images")
+
+            try:
+                pending = self.store.pending(job_id)
+                in_flight = asyncio.Semaphore(self.concurrency)
+
+                async def process(index, name, file):
+                    async with in_flight:
+                        result = await self._process(job_id, index, name, file, job["explain"])
+                    await loop.run_in_executor(None, self.store.record, job_id, index, result)
+
+                await asyncio.gather(*[process(*item) for item in pending])
+                await loop.run_in_executor(None, build_bundle, self.store, job_id)
+            except asyncio.CancelledError:
+                # Server shutting down: leave the job to be resumed
+                raise
+            except Exception as e:
+                logger.error(f"Job {job_id} failed: {e}", exc_info=True)
+                self.store.set_status(job_id, "failed", error="Job failed. Please try again.")
+                return
+
+            self.store.set_status(job_id, "done")
+            await loop.run_in_executor(None, shutil.rmtree, self.store.inputs_dir(job_id), True)
+            logger.info(f"Job {job_id} done")
+
+    async def _process(self, job_id, index, name, file, explain):
+        loop = asyncio.get_event_loop()
+        try:
+            data = await loop.run_in_executor(None, (self.store.inputs_dir(job_id) / file).read_bytes)
+        except OSError as e:
+            logger.error(f"Job {job_id}: missing input {file}: {e}")
+            return self._failed(name, "Upload missing")
+
+        # The image name sets the result image names, so keep it unique per job
+        image_name = f"{job_id}_{index:05d}{Path(file).suffix}"
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            try:
+                result = await run_pipeline_async(data, image_name, self.batchers, explain=explain, limits=self.limits)
+                break
+            except Overloaded:
+                # Live traffic has the queues full; back off and try again
+                if attempt == MAX_ATTEMPTS:
+                    return self._failed(name, "Server busy")
+                await asyncio.sleep(RETRY_AFTER_SECONDS * attempt)
+            except QualityRejected as e:
+                return self._failed(name, " ".join(e.reasons))
+            except ValueError:
+                return self._failed(name, "Invalid image or processing failed")
+            except Exception as e:
+                logger.error(f"Job {job_id}: image {index} failed: {e}", exc_info=True)
+                return self._failed(name, "Unable to process image")
+
+        JOB_IMAGES.inc(status="ok")
+        return {
+            "name": name,
+            "status": "ok",
+            "label": result["label"],
+            "confidence": result["confidence"],
+            "boxed_image_path": result["boxed_image_path"],
+            "heatmap_path": result.get("heatmap_path"),
+        }
+
+    @staticmethod
+    def _failed(name, error):
+        JOB_IMAGES.inc(status="error")
+        return {"name": name, "status": "error", "error": error}
@@ -0,0 +1,303 @@
+# src/metrics.py
+"""
+Lightweight Prometheus-style metrics.
+Histograms for per-stage latency and batch sizes, gauges for queue depths,
+and counters, all rendered in the Prometheus text format by /metrics.
+Recording a value is a dict update under a lock, so it is cheap enough to
+do on every request (unlike the stdout prints it replaces).
+"""
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Default latency buckets in seconds (1ms .. 30s)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+# Per-request image memory buckets in bytes (1MB .. 256MB)
+MEMORY_BUCKETS = tuple(2 ** n * 1024 * 1024 for n in range(9))
+
+
+def _label_key(label_names, labels):
+    if set(labels) != set(label_names):
+        raise ValueError(f"Expected labels {label_names}, got {sorted(labels)}")
+    return tuple(str(labels[name]) for name in label_names)
+
+
+def _format_labels(label_names, key, extra=None):
+    pairs = list(zip(label_names, key))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    body = ",".join(f'{name}="{value}"' for name, value in pairs)
+    return "{" + body + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+
+    def _header(self):
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help_text, label_names=()):
+        super().__init__(name, help_text, label_names)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(self.label_names, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(_label_key(self.label_names, labels), 0)
+
+    def render(self):
+        lines = self._header()
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}")
+        return lines
+
+
+class Gauge(_Metric):
+    """
+    A value that goes up and down. Either set() it, or give set_function()
+    a callable that is read at scrape time (e.g. a queue's size).
+    """
+    kind = "gauge"
+
+    def __init__(self, name, help_text, label_names=()):
+        super().__init__(name, help_text, label_names)
+        self._values = {}
+        self._functions = {}
+
+    def set(self, value, **labels):
+        key = _label_key(self.label_names, labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, fn, **labels):
+        key = _label_key(self.label_names, labels)
+        with self._lock:
+            self._functions[key] = fn
+
+    def remove(self, **labels):
+        """Stop reporting a label combination (e.g. a version no longer loaded)."""
+        key = _label_key(self.label_names, labels)
+        with self._lock:
+            self._values.pop(key, None)
+            self._functions.pop(key, None)
+
+    def render(self):
+        lines = self._header()
+        with self._lock:
+            values = dict(self._values)
+            functions = dict(self._functions)
+        for key, fn in functions.items():
+            try:
+                values[key] = fn()
+            except Exception:
+                continue
+        for key, value in sorted(values.items()):
+            if value is None:
+                continue
+            lines.append(f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # key -> [bucket counts..., sum, count]
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = _label_key(self.label_names, labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+                    break
+            state[-2] += value
+            state[-1] += 1
+
+    def render(self):
+        lines = self._header()
+        with self._lock:
+            items = sorted((key, list(state)) for key, state in self._values.items())
+        for key, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                labels = _format_labels(self.label_names, key, ("le", _format_value(float(bound))))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(state[-2])}")
+            lines.append(f"{self.name}_count{labels} {state[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+
+    def _add(self, metric):
+        if metric.name in self._metrics:
+            return self._metrics[metric.name]
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text, label_names=()):
+        return self._add(Counter(name, help_text, label_names))
+
+    def gauge(self, name, help_text, label_names=()):
+        return self._add(Gauge(name, help_text, label_names))
+
+    def histogram(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help_text, label_names, buckets))
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# Shared registry and the metrics used across the pipeline
+metrics = MetricsRegistry()
+
+STAGE_SECONDS = metrics.histogram(
+    "anemo_stage_seconds",
+    "Time spent in each pipeline stage (per call; batched stages per batch)",
+    ["stage"],
+)
+REQUEST_SECONDS = metrics.histogram(
+    "anemo_request_seconds",
+    "End-to-end request latency",
+    ["endpoint", "status"],
+)
+BATCH_SIZE = metrics.histogram(
+    "anemo_batch_size",
+    "Number of items per batched model call",
+    ["batcher"],
+    buckets=BATCH_SIZE_BUCKETS,
+)
+QUEUE_DEPTH = metrics.gauge(
+    "anemo_queue_depth",
+    "Items waiting in each queue",
+    ["queue"],
+)
+
+REQUEST_IMAGE_BYTES = metrics.histogram(
+    "anemo_request_image_bytes",
+    "Peak bytes of image buffers a request held at once",
+    buckets=MEMORY_BUCKETS,
+)
+PROCESS_MEMORY = metrics.gauge(
+    "anemo_process_memory_bytes",
+    "Resident memory of the API process (current and peak)",
+    ["kind"],
+)
+
+
+def _rss_bytes():
+    # Linux only; other platforms just don't report it
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def _peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 if resource else None
+
+
+PROCESS_MEMORY.set_function(_rss_bytes, kind="rss")
+PROCESS_MEMORY.set_function(_peak_rss_bytes, kind="peak_rss")
+
+
+class PeakTracker:
+    """
+    Tracks the image buffers one request holds (upload, decoded image,
+    crop, tensors, ...): hold() them as they are created, release() them
+    once the request drops them, and peak is the most bytes held at any
+    one time.
+    """
+
+    def __init__(self):
+        self.current = 0
+        self.peak = 0
+
+    @staticmethod
+    def _size(arrays):
+        return sum(array.nbytes if hasattr(array, "nbytes") else len(array) for array in arrays if array is not None)
+
+    def hold(self, *arrays):
+        self.current += self._size(arrays)
+        self.peak = max(self.peak, self.current)
+
+    def release(self, *arrays):
+        self.current -= self._size(arrays)
+
+
+def observe_stage(stage, seconds):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+
+
+@contextmanager
+def stage_timer(stage, timings=None):
+    """
+    Time a block into anemo_stage_seconds. If a timings dict is given, the
+    elapsed seconds are also added under the stage name (for per-request logs).
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        observe_stage(stage, elapsed)
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + elapsed
+
+
+@contextmanager
+def request_timer(step, timings):
+    """
+    Time one step of a request (including any queueing) into a timings dict,
+    without touching the stage histograms.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[step] = timings.get(step, 0.0) + time.perf_counter() - start
@@ -0,0 +1,318 @@
+# src/models.py
+"""
+Model registry with lazy loading, warm-up and hot swapping.
+Models are loaded the first time they are needed (or in a background thread
+at server start), then warmed with a dummy inference so the first real
+request doesn't pay for graph tracing and memory allocation.
+When a model file is replaced, reload() loads and warms the new version
+next to the old one and swaps it in; requests already holding the old
+model finish with it, so nothing is dropped and no restart is needed.
+"""
+
+import hashlib
+import logging
+import threading
+import time
+from pathlib import Path
+
+from src.config import MODEL_WATCH_SECONDS
+from src.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+MODEL_INFO = metrics.gauge("anemo_model_info", "Model version currently loaded (always 1)", ["model", "version"])
+MODEL_SWAPS = metrics.counter("anemo_model_swaps", "Model reloads by outcome (swapped, failed)", ["model", "outcome"])
+
+
+def file_version(path):
+    """
+    Short fingerprint of a model file (size + modification time), or None
+    if the file is missing. Changes whenever the file is replaced.
+    """
+    try:
+        stat = Path(path).stat()
+    except OSError:
+        return None
+    return hashlib.sha1(f"{stat.st_size}-{stat.st_mtime_ns}".encode()).hexdigest()[:12]
+
+
+class _ModelEntry:
+    def __init__(self, name, loader):
+        self.name = name
+        self.loader = loader
+        self.source = None
+        self.preload = True
+        self.warmups = []
+        self.swap_hooks = []
+        self.model = None
+        self.version = None
+        self.warm = False
+        self.error = None
+        self.load_seconds = None
+        self.warmup_seconds = None
+        self.swaps = 0
+        self.reload_error = None
+        # Fingerprint that last failed to reload, so the watcher doesn't retry it
+        self.failed_version = None
+        self.lock = threading.Lock()
+        self.reload_lock = threading.Lock()
+
+    def set_version(self, version):
+        # Keep anemo_model_info showing just the loaded version
+        MODEL_INFO.remove(model=self.name, version=self.version or "-")
+        self.version = version
+        MODEL_INFO.set(1, model=self.name, version=version or "-")
+
+
+class ModelRegistry:
+    """
+    Keeps one instance of each named model and loads it on first use.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._background = None
+        self._stop = threading.Event()
+        self._watcher = None
+
+    def register(self, name, loader, warmup=None, source=None, preload=True):
+        """
+        Register a model loader. loader() returns the model; warmup(model)
+        runs a dummy inference on it. source is the model file, used to
+        fingerprint the version. Models with preload=False are skipped by
+        load_all and readiness, and only load when first asked for.
+        """
+        entry = self._entries.setdefault(name, _ModelEntry(name, loader))
+        entry.loader = loader
+        entry.source = source
+        entry.preload = preload
+        if warmup is not None:
+            entry.warmups.insert(0, warmup)
+
+    def add_warmup(self, name, warmup):
+        """
+        Attach an extra warm-up step to a registered model (for example,
+        tracing a compiled function that wraps it). The model doesn't have
+        to be registered yet.
+        """
+        self._entries.setdefault(name, _ModelEntry(name, None)).warmups.append(warmup)
+
+    def on_swap(self, name, hook):
+        """
+        Call hook(old_model, new_model) after reload swaps in a new version,
+        e.g. to drop functions compiled for the old model.
+        """
+        self._entries.setdefault(name, _ModelEntry(name, None)).swap_hooks.append(hook)
+
+    def _entry(self, name):
+        entry = self._entries.get(name)
+        if entry is None or entry.loader is None:
+            raise KeyError(f"Unknown model: {name}")
+        return entry
+
+    def get(self, name):
+        """
+        Return the model, loading it first if needed (thread-safe).
+        """
+        entry = self._entry(name)
+        if entry.model is not None:
+            return entry.model
+
+        with entry.lock:
+            if entry.model is None:
+                start = time.perf_counter()
+                version = self._file_version(entry)
+                try:
+                    entry.model = entry.loader()
+                    entry.error = None
+                except Exception as e:
+                    entry.error = str(e)
+                    raise
+                entry.set_version(version)
+                entry.load_seconds = time.perf_counter() - start
+                logger.info(f"Loaded {name} model in {entry.load_seconds:.2f}s")
+        return entry.model
+
+    def warm_up(self, name):
+        """
+        Load the model if needed and run its warm-up steps once.
+        """
+        entry = self._entry(name)
+        model = self.get(name)
+
+        with entry.lock:
+            if entry.warm:
+                return
+            start = time.perf_counter()
+            try:
+                for warmup in entry.warmups:
+                    warmup(model)
+            except Exception as e:
+                # A failed warm-up is not fatal: the first request just pays for it
+                logger.warning(f"Warm-up for {name} failed: {e}")
+            entry.warmup_seconds = time.perf_counter() - start
+            entry.warm = True
+            logger.info(f"Warmed {name} model in {entry.warmup_seconds:.2f}s")
+
+    def reload(self, name):
+        """
+        Load a fresh copy of the model from its file, run the warm-up steps
+        on it, then swap it in. The next get() returns the new model; calls
+        already holding the old one finish with it. If loading or warming
+        fails the old model keeps serving and the error is raised.
+        Returns the new version.
+        """
+        entry = self._entry(name)
+        with entry.reload_lock:
+            version = self._file_version(entry)
+            start = time.perf_counter()
+            try:
+                model = entry.loader()
+                # Unlike at startup, a failed warm-up counts: the old model is still there
+                for warmup in entry.warmups:
+                    warmup(model)
+            except Exception as e:
+                entry.reload_error = str(e)
+                entry.failed_version = version
+                MODEL_SWAPS.inc(model=name, outcome="failed")
+                logger.error(f"Reloading {name} model (version {version}) failed, keeping {entry.version}: {e}")
+                raise
+
+            with entry.lock:
+                old = entry.model
+                entry.model = model
+                entry.warm = True
+                entry.error = entry.reload_error = None
+                entry.swaps += 1
+                entry.set_version(version)
+
+            MODEL_SWAPS.inc(model=name, outcome="swapped")
+            logger.info(f"Swapped in {name} model version {version} in {time.perf_counter() - start:.2f}s")
+            for hook in entry.swap_hooks:
+                try:
+                    hook(old, model)
+                except Exception as e:
+                    logger.warning(f"Swap hook for {name} failed: {e}")
+            return version
+
+    def check_for_updates(self, seen=None):
+        """
+        Reload every loaded model whose file changed. A new fingerprint has
+        to show up in two checks in a row (seen carries it over from the
+        last call), so a file that is still being copied isn't loaded.
+        Returns the names that were swapped.
+        """
+        seen = {} if seen is None else seen
+        swapped = []
+        for name, entry in self._entries.items():
+            if entry.loader is None or entry.model is None or entry.source is None:
+                continue
+            version = file_version(entry.source)
+            previous, seen[name] = seen.get(name), version
+            if version is None or version in (entry.version, entry.failed_version) or version != previous:
+                continue
+            try:
+                self.reload(name)
+                swapped.append(name)
+            except Exception:
+                pass
+        return swapped
+
+    def _watch_loop(self, interval):
+        seen = {}
+        while not self._stop.wait(interval):
+            try:
+                self.check_for_updates(seen)
+            except Exception as e:
+                logger.error(f"Model watcher failed: {e}", exc_info=True)
+
+    def start_watcher(self, interval=MODEL_WATCH_SECONDS):
+        """Check the model files every interval seconds on a daemon thread."""
+        if interval <= 0 or (self._watcher is not None and self._watcher.is_alive()):
+            return
+        self._stop.clear()
+        self._watcher = threading.Thread(
+            target=self._watch_loop, args=(interval,), name="model-watcher", daemon=True
+        )
+        self._watcher.start()
+
+    def stop_watcher(self):
+        self._stop.set()
+        if self._watcher is not None:
+            self._watcher.join(timeout=5)
+            self._watcher = None
+
+    @staticmethod
+    def _file_version(entry):
+        return file_version(entry.source) if entry.source is not None else None
+
+    def load_all(self, warm=True):
+        """
+        Load (and optionally warm) every registered model that preloads.
+        """
+        for name in self.names():
+            if not self._entries[name].preload:
+                continue
+            try:
+                if warm:
+                    self.warm_up(name)
+                else:
+                    self.get(name)
+            except Exception as e:
+                logger.error(f"Could not load {name} model: {e}", exc_info=True)
+
+    def load_all_in_background(self, warm=True):
+        """
+        Start load_all on a daemon thread. Safe to call more than once.
+        """
+        if self._background is None or not self._background.is_alive():
+            self._background = threading.Thread(
+                target=self.load_all, kwargs={"warm": warm}, name="model-loader", daemon=True
+            )
+            self._background.start()
+        return self._background
+
+    def is_ready(self):
+        """True once every registered model is loaded and warmed."""
+        entries = [entry for entry in self._entries.values() if entry.loader is not None and entry.preload]
+        return bool(entries) and all(entry.model is not None and entry.warm for entry in entries)
+
+    def status(self):
+        """Per-model load state and timings, for the readiness endpoint."""
+        return {
+            name: {
+                "loaded": entry.model is not None,
+                "preload": entry.preload,
+                "warm": entry.warm,
+                "load_seconds": entry.load_seconds,
+                "warmup_seconds": entry.warmup_seconds,
+                "error": entry.error,
+                "version": self._version(entry),
+                "swaps": entry.swaps,
+                "reload_error": entry.reload_error,
+            }
+            for name, entry in self._entries.items()
+            if entry.loader is not None
+        }
+
+    def versions(self):
+        """
+        Version of every registered model: the one loaded, or for models
+        not loaded in this process (yet) the fingerprint of their file.
+        """
+        return {
+            name: self._version(entry)
+            for name, entry in self._entries.items()
+            if entry.loader is not None
+        }
+
+    def _version(self, entry):
+        return entry.version if entry.model is not None else self._file_version(entry)
+
+    def names(self):
+        """Names of all registered models."""
+        return [name for name, entry in self._entries.items() if entry.loader is not None]
+
+
+# Shared registry for the whole process
+registry = ModelRegistry()
@@ -1,80 +1,601 @@
 from pathlib import Path
+import asyncio
 import logging
+import threading
 import cv2
+import numpy as np
 
-from src.detector import detect_and_crop
+from src.detector import (
+    load_image, detect_boxes, crop_to_box, render_boxed, boxed_path_for, decode_image,
+)
 from src.preprocess import preprocess_image
-from src.classifier import predict_anemia, get_model
-from src.config import RESULTS_DIR
-from src.explain import generate_gradcam
+from src.classifier import (
+    predict_anemia, predict_anemia_batch, predict_probabilities, get_model, label_from_probability,
+    probability_from_label, KERAS_ENTRY,
+)
+from src.config import BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS, BATCH_MAX_QUEUE, QUALITY_GATE, CASCADE, TTA, EMBEDDINGS
+from src.artifacts import artifact_path
+from src.explain import predict_and_explain, render_heatmap
+from src.batching import MicroBatcher
+from src.metrics import metrics, request_timer, PeakTracker, REQUEST_IMAGE_BYTES
+from src.models import registry
+from src.admission import StageLimits, DeadlineExceeded
+from src import quality, cascade, tta, embeddings
 
 logger = logging.getLogger(__name__)
 
-def run_pipeline(image_path, explain=False):
-    """
-    Run the full analysis on an image.
-    """
+# With a TFLite/ONNX backend the Keras model only supplies Grad-CAM maps and
+# embeddings and the backend labels every result, so asking for either never
+# changes it (and TTA re-runs the model that made the first pass)
+_KERAS_LABELS = KERAS_ENTRY == "classifier"
+
+PREDICTIONS = metrics.counter(
+    "anemo_predictions",
+    "Predictions by label and version of the classifier that made them",
+    ["label", "version"],
+)
+
+
+def _check_inputs(image_path, explain):
     image_path = Path(image_path)
-    
+
     # Check if the image file exists
     if not image_path.exists():
         logger.error(f"Pipeline: Image file validation failed")
         raise ValueError(f"Image file not found")
-    
+
     # Make sure explain is a true/false value
     if not isinstance(explain, bool):
         logger.warning(f"Pipeline: Invalid explain type, coercing to bool")
         explain = bool(explain)
 
-    # 1. Detect & Crop
-    crop_rgb = detect_and_crop(image_path)
-    
+    return image_path, explain
+
+
+def _build_result(image_name, label, confidence, note=None):
+    boxed_image_path = boxed_path_for(image_name)
+    return {
+        "label": label,
+        "confidence": round(confidence * 100, 2),
+        "boxed_image_path": str(boxed_image_path),
+        "note": note
+    }
+
+
+def model_versions(versions, keras=False, decided_by=None):
+    """
+    Versions of the models behind a result, from versions ({registry name:
+    version} of the models that served it, see record_versions). Results
+    are labeled by the configured backend (or the cascade's color model
+    when it answered on its own); when the backend isn't Keras and the
+    Keras model supplied a heatmap or embedding (keras), it is listed as
+    "keras".
+    """
+    result = {
+        "detector": versions.get("detector"),
+        "classifier": versions.get("cascade" if decided_by == "cascade" else "classifier"),
+    }
+    if keras and not _KERAS_LABELS:
+        result["keras"] = versions.get(KERAS_ENTRY)
+    return result
+
+
+# Recorded for a model that served one request from two versions
+MIXED_VERSION = "mixed"
+
+
+def serving_versions(pool=None):
+    """
+    {registry name: version} of the models that could serve a request now
+    (the cascade only when it is on). A model whose file is missing is None.
+    With an InferencePool, the detector and classifiers are the ones its
+    workers report; the cascade always runs in this process.
+    """
+    names = ["detector", "classifier", KERAS_ENTRY]
+    if CASCADE:
+        names.append("cascade")
+    versions = registry.versions()
+    if pool is not None:
+        reported = pool.versions()
+        versions.update({name: reported.get(name) for name in ("detector", "classifier", KERAS_ENTRY)})
+    return {name: versions.get(name) for name in names}
+
+
+def record_versions(served, used, *names):
+    """
+    Add the versions of the named models from one batch reply (used) to
+    served, the versions behind a request so far. A model that answered two
+    parts of the request from different versions (swapped in between) is
+    recorded as MIXED_VERSION.
+    """
+    for name in names:
+        version = used.get(name)
+        served[name] = version if served.get(name, version) == version else MIXED_VERSION
+
+
+def _cascade_result(image_name, decided, checks, served):
+    # Result for a request the cascade answered, skipping the CNN
+    label, confidence = decided
+    result = _build_result(image_name, label, confidence)
+    result["decided_by"] = "cascade"
+    result["model_versions"] = model_versions(served, decided_by="cascade")
+    _add_quality(result, checks)
+    return result
+
+
+def _check_image(image_bgr):
+    # First half of the quality gate, before detection (None with the gate off)
+    if QUALITY_GATE == "off":
+        return None
+    image_check = quality.check_image(image_bgr)
+    quality.enforce(image_check)
+    return image_check
+
+
+def _decode_and_check(image_bytes):
+    # One trip to the thread pool for the decode and the pre-detection checks
+    image_bgr = decode_image(image_bytes)
+    return image_bgr, _check_image(image_bgr)
+
+
+def _check_region(image_check, box, image_shape):
+    """
+    Second half of the quality gate, once the box is known. Raises
+    quality.QualityRejected in "reject" mode; otherwise returns all the
+    checks merged (None with the gate off).
+    """
+    if image_check is None:
+        return None
+    region_check = quality.check_region(box, image_shape) if box is not None else None
+    if region_check is not None:
+        quality.enforce(region_check)
+    return quality.merge_checks(image_check, region_check)
+
+
+def _add_quality(result, checks):
+    # Flag mode: the result goes out, with what was wrong with the photo
+    if checks is None:
+        return
+    quality.record(checks)
+    if not checks["passed"]:
+        result["quality"] = {"passed": False, "failed": checks["failed"], "reasons": checks["reasons"]}
+
+
+def _versioned(fn):
+    """
+    Wrap an in-process batch function so each item's result comes paired
+    with the model versions it was made with, like the InferencePool's.
+    """
+    def run(items):
+        versions = registry.versions()
+        return [(value, versions) for value in fn(items)]
+    return run
+
+
+@_versioned
+def _explain_batch(tensors):
+    """
+    Classify and compute Grad-CAM gradient maps in one compiled pass.
+    Returns (((label, confidence), grad_map), versions) per tensor.
+    """
+    probs, grad_maps = predict_and_explain(get_model(), _stack(tensors))
+    return [(label_from_probability(float(p)), grad_map) for p, grad_map in zip(probs, grad_maps)]
+
+
+@_versioned
+def _embed_batch(tensors):
+    """
+    Classify and return the penultimate-layer embeddings from the same pass.
+    Returns (((label, confidence), embedding), versions) per tensor.
+    """
+    probs, vectors = embeddings.predict_with_embeddings(get_model(), _stack(tensors))
+    return [(label_from_probability(float(p)), vector) for p, vector in zip(probs, vectors)]
+
+
+def _add_heatmap(result, image_name, grad_map, crop_rgb):
+    """
+    Render the Grad-CAM heatmap and add its path to the result.
+    Failures are logged and skipped so the prediction still goes out.
+    """
+    heatmap_path = artifact_path("heatmap", image_name)
+    try:
+        heatmap_result = render_heatmap(grad_map, crop_rgb, heatmap_path)
+        if heatmap_result:
+            result["heatmap_path"] = heatmap_result
+        else:
+            logger.warning("Grad-CAM heatmap generation returned None")
+    except Exception as e:
+        logger.error(f"Grad-CAM generation failed: {e}", exc_info=True)
+        # Don't fail the request, just skip heatmap
+
+    return result
+
+
+def run_pipeline(image_path, explain=False):
+    """
+    Run the full analysis on an image.
+    """
+    image_path, explain = _check_inputs(image_path, explain)
+    versions = registry.versions()
+
+    # 1. Quality gate, then Detect & Crop
+    image_bgr = load_image(image_path)
+    image_check = _check_image(image_bgr)
+    (best_box,) = detect_boxes([image_bgr])
+    checks = _check_region(image_check, best_box, image_bgr.shape)
+    render_boxed(image_bgr, best_box, boxed_path_for(image_path.name))
+    crop_rgb = crop_to_box(image_bgr, best_box)
+
     # If detection failed, stop here
     if crop_rgb is None:
         raise ValueError("Failed to extract image data for classification")
 
-    note = None
-    boxed_image_path = RESULTS_DIR / f"boxed_{image_path.name}"
+    # Clear-cut cases are answered by the cascade's color model alone
+    if CASCADE and not explain:
+        decided = cascade.try_cascade(crop_rgb)
+        if decided is not None:
+            return _cascade_result(image_path.name, decided, checks, versions)
 
     # 2. Preprocess
     input_tensor = preprocess_image(crop_rgb)
-    
+
     # If preprocessing failed, stop here
     if input_tensor is None:
         raise ValueError("Failed to preprocess image")
 
-    # Run the classifier
-    label, confidence = predict_anemia(input_tensor)
-
-    # Build result dictionary
-    result = {
-        "label": label,
-        "confidence": round(confidence * 100, 2),
-        "boxed_image_path": str(boxed_image_path),
-        "note": note
-    }
-    
-    # Make a heatmap if the user asked for it
+    # Run the classifier, with the Grad-CAM gradients from the same pass if asked
+    grad_map = None
     if explain:
-        heatmap_path = RESULTS_DIR / f"heatmap_{image_path.name}"
         try:
-            model = get_model()
-            # generate_gradcam auto-detects the best conv layer in MobileNetV2
-            heatmap_result = generate_gradcam(
-                model=model,
-                input_tensor=input_tensor,
-                original_rgb=crop_rgb,
-                output_path=heatmap_path
-            )
-            if heatmap_result:
-                result["heatmap_path"] = heatmap_result
-                print(f"✓ Grad-CAM heatmap generated: {heatmap_result}")
-            else:
-                print(f"✗ Grad-CAM heatmap generation returned None")
+            ((label, confidence), grad_map), _ = _explain_batch([input_tensor])[0]
+        except Exception as e:
+            logger.error(f"Pipeline: predict-and-explain failed, classifying without heatmap: {e}", exc_info=True)
+
+    embedding = None
+    if grad_map is None and EMBEDDINGS:
+        try:
+            ((label, confidence), embedding), _ = _embed_batch([input_tensor])[0]
         except Exception as e:
-            print(f"✗ Grad-CAM generation failed: {e}")
-            import traceback
-            traceback.print_exc()
-            # Don't fail the request, just skip heatmap
-    
+            logger.error(f"Pipeline: embedding extraction failed, classifying without it: {e}", exc_info=True)
+
+    if not _KERAS_LABELS or (grad_map is None and embedding is None):
+        label, confidence = predict_anemia(input_tensor)
+
+    # Borderline answer: average it with augmented copies of the crop
+    augmented = None
+    first_probability = probability_from_label(label, confidence)
+    if TTA and grad_map is None and tta.in_band(first_probability):
+        probs = predict_probabilities(tta.augment(input_tensor, tta.SPECS[1:]))
+        label, confidence, augmented = tta.aggregate(first_probability, probs)
+
+    # Build result dictionary
+    result = _build_result(image_path.name, label, confidence)
+    result["model_versions"] = model_versions(versions, grad_map is not None or embedding is not None)
+    if augmented is not None:
+        result["tta"] = augmented
+    if embedding is not None:
+        result["embedding"] = embedding
+    _add_quality(result, checks)
+
+    # Make a heatmap if the user asked for it
+    if grad_map is not None:
+        _add_heatmap(result, image_path.name, grad_map, crop_rgb)
+
+    return result
+
+
+@_versioned
+def _detect_batch(images):
+    # One YOLO call for the batch; returns (crop_rgb, box) per image
+    boxes = detect_boxes(images)
+    return [(crop_to_box(image, box), box) for image, box in zip(images, boxes)]
+
+
+# Per-thread (N, 224, 224, 3) buffer the batchers stack tensors into
+_scratch = threading.local()
+
+
+def _stack(tensors):
+    """
+    Stack (1, 224, 224, 3) tensors into one batch, reusing this thread's
+    buffer instead of allocating a new batch array every time. The result
+    is only valid until the thread's next call.
+    """
+    n = sum(len(tensor) for tensor in tensors)
+    buffer = getattr(_scratch, "batch", None)
+    if buffer is None or len(buffer) < n:
+        buffer = _scratch.batch = np.empty((n, 224, 224, 3), dtype=np.float32)
+    return np.concatenate(tensors, axis=0, out=buffer[:n])
+
+
+@_versioned
+def _classify_batch(tensors):
+    # Each tensor is (1, 224, 224, 3); stack them into one (N, 224, 224, 3) call
+    return predict_anemia_batch(_stack(tensors))
+
+
+def _split(probs, tensors):
+    # Split one batch's probabilities back into a (k,) array per stacked tensor
+    return np.split(np.asarray(probs, dtype=np.float32), np.cumsum([len(tensor) for tensor in tensors])[:-1])
+
+
+@_versioned
+def _tta_batch(tensors):
+    # Each tensor is a (k, 224, 224, 3) set of augmented copies; all of them
+    # go through the model in one call
+    return _split(predict_probabilities(_stack(tensors)), tensors)
+
+
+def _pooled_batch_fns(pool):
+    """
+    Batch functions that send the model calls to an InferencePool. Cropping
+    stays in this process, so only the decoded images and the 224x224
+    tensors cross to the workers. Each item comes paired with the versions
+    of the worker models that ran its batch.
+    """
+    def detect(images):
+        boxes, versions = pool.detect(images)
+        return [((crop_to_box(image, box), box), versions) for image, box in zip(images, boxes)]
+
+    # Tensors are stacked straight into the pool's shared memory
+    def classify(tensors):
+        probs, versions = pool.classify(list(tensors))
+        return [(label_from_probability(float(p)), versions) for p in probs]
+
+    def explain(tensors):
+        probs, grad_maps, versions = pool.explain(list(tensors))
+        return [((label_from_probability(float(p)), grad_map), versions) for p, grad_map in zip(probs, grad_maps)]
+
+    def augmented(tensors):
+        probs, versions = pool.classify(list(tensors))
+        return [(split, versions) for split in _split(probs, tensors)]
+
+    def embed(tensors):
+        probs, vectors, versions = pool.embed(list(tensors))
+        return [((label_from_probability(float(p)), vector), versions) for p, vector in zip(probs, vectors)]
+
+    return detect, classify, explain, augmented, embed
+
+
+def create_batchers(max_batch_size=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS, pool=None, max_queue=BATCH_MAX_QUEUE):
+    """
+    Build the batchers used by run_pipeline_async:
+    "detector" (YOLO), "classifier" (plain predictions), "explainer"
+    (predictions plus Grad-CAM gradients in one pass), "tta" (sets of
+    augmented copies, one probability array per set) and "embedder"
+    (predictions plus penultimate-layer embeddings in one pass). Every
+    batcher resolves to (result, versions), versions being {registry name:
+    version} of the models that made it.
+    With an InferencePool, the models run in its worker processes and each
+    batcher keeps one batch in flight per worker.
+    Each batcher rejects new items once max_queue are waiting (0: no limit).
+    Call start() on each from the running event loop before use.
+    """
+    if pool is None:
+        detect, classify, explain, augmented, embed = (
+            _detect_batch, _classify_batch, _explain_batch, _tta_batch, _embed_batch
+        )
+        concurrency = 1
+    else:
+        detect, classify, explain, augmented, embed = _pooled_batch_fns(pool)
+        concurrency = pool.size
+
+    def batcher(fn, name):
+        return MicroBatcher(fn, max_batch_size, max_wait_ms, name=name, concurrency=concurrency, max_queue=max_queue)
+
+    return {
+        "detector": batcher(detect, "detector-batch"),
+        "classifier": batcher(classify, "classifier-batch"),
+        "explainer": batcher(explain, "explainer-batch"),
+        "tta": batcher(augmented, "tta-batch"),
+        "embedder": batcher(embed, "embedder-batch"),
+    }
+
+
+async def _keras_and_label(batchers, name, input_tensor, deadline, served):
+    """
+    Grad-CAM map from the "explainer" batcher or embedding from the
+    "embedder" (name). Returns ((label, confidence), map or embedding).
+    With a TFLite/ONNX backend the label comes from the "classifier"
+    batcher, run alongside, so it matches plain requests.
+    """
+    if _KERAS_LABELS:
+        (labeled, output), used = await batchers[name].submit(input_tensor, deadline)
+        record_versions(served, used, "classifier")
+        return labeled, output
+    ((_, output), output_by), (labeled, labeled_by) = await asyncio.gather(
+        batchers[name].submit(input_tensor, deadline),
+        batchers["classifier"].submit(input_tensor, deadline),
+    )
+    record_versions(served, output_by, KERAS_ENTRY)
+    record_versions(served, labeled_by, "classifier")
+    return labeled, output
+
+
+async def run_pipeline_async(image_bytes, image_name, batchers, explain=False, renderer=None, timings=None,
+                             deadline=None, limits=None, memory=None, shadow=None, versions=None):
+    """
+    Same analysis as run_pipeline, but for an upload held in memory.
+    The YOLO and classifier calls are shared with other concurrent requests
+    through the batchers from create_batchers. Decode and preprocessing run
+    in the default thread pool so the event loop is never blocked.
+
+    image_name is a safe filename used to name the result images. With an
+    ArtifactRenderer, the boxed and heatmap images are rendered in the
+    background under image_name's stem as request id, and the result is
+    returned as soon as the label is known; otherwise they are rendered
+    before returning.
+
+    If a timings dict is given, the wall time of each step (including time
+    spent queued for a batch) is added to it. If a versions dict is given,
+    the version of each model that served the request is set in it, by
+    registry name (MIXED_VERSION if two versions took part).
+
+    deadline is an event loop time: steps that haven't started by then
+    raise admission.DeadlineExceeded. limits (admission.StageLimits) caps
+    how many requests decode and preprocess at once.
+
+    memory (metrics.PeakTracker) records the request's image buffers as
+    they are made and dropped; its peak goes into anemo_request_image_bytes.
+
+    shadow (shadow.ShadowRunner) gets a sampled share of the preprocessed
+    tensors to compare against; it never delays or changes the result.
+
+    With EMBEDDINGS on, results classified by the CNN without Grad-CAM also
+    carry "embedding", a float16 (D,) array for the similar-case index.
+    """
+    if memory is None:
+        memory = PeakTracker()
+    memory.hold(image_bytes)
+    served = {}
+    try:
+        return await _run_pipeline_async(image_bytes, image_name, batchers, explain, renderer,
+                                         timings, deadline, limits, memory, shadow, served)
+    finally:
+        REQUEST_IMAGE_BYTES.observe(memory.peak)
+        if versions is not None:
+            versions.update(served)
+
+
+async def _run_pipeline_async(image_bytes, image_name, batchers, explain, renderer, timings, deadline, limits,
+                              memory, shadow, served):
+    loop = asyncio.get_event_loop()
+    if timings is None:
+        timings = {}
+    if limits is None:
+        limits = StageLimits()
+
+    # Make sure explain is a true/false value
+    if not isinstance(explain, bool):
+        logger.warning(f"Pipeline: Invalid explain type, coercing to bool")
+        explain = bool(explain)
+
+    # 1. Decode straight from memory and run the quality gate on a small
+    # copy (a few ms), so unusable photos never reach the models. Then
+    # Detect & Crop in a shared YOLO batch
+    with request_timer("decode", timings):
+        async with limits.slot("decode", deadline):
+            image_bgr, image_check = await loop.run_in_executor(None, _decode_and_check, image_bytes)
+    memory.hold(image_bgr)
+    if image_check is not None:
+        timings["quality"] = sum(image_check["timings"].values())
+        timings["decode"] -= timings["quality"]
+
+    with request_timer("detect", timings):
+        (crop_rgb, best_box), used = await batchers["detector"].submit(image_bgr, deadline)
+    record_versions(served, used, "detector")
+    memory.hold(crop_rgb)
+
+    checks = _check_region(image_check, best_box, image_bgr.shape)
+
+    # If detection failed, stop here
+    if crop_rgb is None:
+        raise ValueError("Failed to extract image data for classification")
+
+    # Clear-cut cases are answered by the cascade's color model alone (~1 ms),
+    # the rest go on to preprocessing and the CNN
+    decided = None
+    if CASCADE and not explain:
+        with request_timer("cascade", timings):
+            decided = await loop.run_in_executor(None, cascade.try_cascade, crop_rgb)
+
+    if decided is not None:
+        record_versions(served, registry.versions(), "cascade")
+        result = _cascade_result(image_name, decided, checks, served)
+        PREDICTIONS.inc(label=result["label"], version=result["model_versions"]["classifier"] or "-")
+        if renderer is None:
+            with request_timer("render", timings):
+                await loop.run_in_executor(None, render_boxed, image_bgr, best_box, result["boxed_image_path"])
+        else:
+            renderer.submit(Path(image_name).stem, "boxed_image", result["boxed_image_path"],
+                            render_boxed, image_bgr, best_box, result["boxed_image_path"])
+        return result
+
+    # 2. Preprocess
+    with request_timer("preprocess", timings):
+        async with limits.slot("preprocess", deadline):
+            input_tensor = await loop.run_in_executor(None, preprocess_image, crop_rgb)
+    memory.hold(input_tensor)
+
+    # If preprocessing failed, stop here
+    if input_tensor is None:
+        raise ValueError("Failed to preprocess image")
+
+    # The crop is only needed again for a heatmap
+    if not explain:
+        memory.release(crop_rgb)
+        crop_rgb = None
+
+    # 3. Classify in a shared batch (with gradients when explaining)
+    grad_map = None
+    with request_timer("classify", timings):
+        if explain:
+            try:
+                (label, confidence), grad_map = await _keras_and_label(batchers, "explainer", input_tensor,
+                                                                       deadline, served)
+                memory.hold(grad_map)
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                logger.error(f"Pipeline: predict-and-explain failed, classifying without heatmap: {e}")
+
+        # With the similar-case index on, the embedding comes from the Keras pass
+        embedding = None
+        if grad_map is None and EMBEDDINGS:
+            try:
+                (label, confidence), embedding = await _keras_and_label(batchers, "embedder", input_tensor,
+                                                                        deadline, served)
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                logger.error(f"Pipeline: embedding extraction failed, classifying without it: {e}")
+
+        if grad_map is None and embedding is None:
+            (label, confidence), used = await batchers["classifier"].submit(input_tensor, deadline)
+            record_versions(served, used, "classifier")
+
+    # The shadow model is compared with the single-pass answer
+    if shadow is not None:
+        shadow.maybe_run(input_tensor, label, confidence)
+
+    # Borderline answer: classify augmented copies of the crop in one batch
+    # and average them with it
+    augmented = None
+    first_probability = probability_from_label(label, confidence)
+    if TTA and grad_map is None and tta.in_band(first_probability):
+        with request_timer("tta", timings):
+            variants = await loop.run_in_executor(None, tta.augment, input_tensor, tta.SPECS[1:])
+            memory.hold(variants)
+            probs, used = await batchers["tta"].submit(variants, deadline)
+            record_versions(served, used, "classifier")
+        memory.release(variants)
+        variants = None
+        label, confidence, augmented = tta.aggregate(first_probability, probs)
+
+    result = _build_result(image_name, label, confidence)
+    result["model_versions"] = model_versions(served, grad_map is not None or embedding is not None)
+    if augmented is not None:
+        result["tta"] = augmented
+    if embedding is not None:
+        result["embedding"] = embedding
+    _add_quality(result, checks)
+    PREDICTIONS.inc(label=label, version=result["model_versions"]["classifier"] or "-")
+
+    # 4. Result images
+    if renderer is None:
+        with request_timer("render", timings):
+            await loop.run_in_executor(None, render_boxed, image_bgr, best_box, result["boxed_image_path"])
+            if grad_map is not None:
+                await loop.run_in_executor(None, _add_heatmap, result, image_name, grad_map, crop_rgb)
+        return result
+
+    request_id = Path(image_name).stem
+    renderer.submit(request_id, "boxed_image", result["boxed_image_path"],
+                    render_boxed, image_bgr, best_box, result["boxed_image_path"])
+    if grad_map is not None:
+        heatmap_path = artifact_path("heatmap", image_name)
+        result["heatmap_path"] = str(heatmap_path)
+        renderer.submit(request_id, "heatmap", heatmap_path,
+                        render_heatmap, grad_map, crop_rgb, heatmap_path)
+
     return result
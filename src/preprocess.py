@@ -1,58 +1,194 @@
 # src/preprocess.py
 import cv2
 import logging
+import threading
 import numpy as np
 
+from src.config import PREPROCESS_ENGINE
+from src.metrics import stage_timer
+
 logger = logging.getLogger(__name__)
 
-def preprocess_image(img_rgb):
-    """
-    Get the image ready for the AI model.
-    """
+ENGINES = ("accurate", "fast")
+
+# Sharpening kernel shared by both engines
+SHARPEN_KERNEL = np.array([[0,-1,0],[-1,5,-1],[0,-1,0]], dtype=np.float32)
+
+# Bilateral filter settings for the fast engine, picked to roughly match
+# fastNlMeansDenoisingColored(h=10) on 224x224 crops
+FAST_DENOISE_DIAMETER = 5
+FAST_DENOISE_SIGMA_COLOR = 40
+FAST_DENOISE_SIGMA_SPACE = 5
+
+# Per-thread scratch buffers and CLAHE objects for both engines
+_scratch = threading.local()
+
+
+def _check_input(img_rgb):
     # Make sure we have an image to work with
     if img_rgb is None:
         logger.error("Preprocess received None input")
-        return None
-    
+        return False
+
     if not isinstance(img_rgb, np.ndarray):
         logger.error(f"Invalid input type: {type(img_rgb)}")
-        return None
-    
+        return False
+
     if img_rgb.shape != (224, 224, 3):
         logger.error(f"Invalid input shape: {img_rgb.shape}, expected (224, 224, 3)")
-        return None
-    
+        return False
+
     if not np.issubdtype(img_rgb.dtype, np.integer) or img_rgb.max() > 255:
         logger.error(f"Invalid input dtype or value range")
+        return False
+
+    return True
+
+
+def _check_engine(engine):
+    engine = engine or PREPROCESS_ENGINE
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown preprocessing engine: {engine}. Choose from {ENGINES}")
+    return engine
+
+
+def _accurate_buffers():
+    if not hasattr(_scratch, "accurate_clahe"):
+        _scratch.accurate_clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
+        _scratch.bgr = np.empty((224, 224, 3), dtype=np.uint8)
+        _scratch.bgr_denoised = np.empty((224, 224, 3), dtype=np.uint8)
+        _scratch.bgr_sharp = np.empty((224, 224, 3), dtype=np.uint8)
+        _scratch.bgr_green = np.empty((224, 224), dtype=np.uint8)
+    return _scratch
+
+
+def _preprocess_accurate(img_rgb, out):
+    """
+    The original path: CLAHE on green, non-local means denoise, sharpen.
+    Writes the (224, 224, 3) float32 result into out.
+
+    Gives exactly the same output as converting to BGR and back with
+    cvtColor, but the channel swaps are done while copying into (and out
+    of) reused per-thread buffers, so nothing full-size is allocated.
+    """
+    buf = _accurate_buffers()
+
+    # Prepare the image for processing (the denoiser expects BGR)
+    np.copyto(buf.bgr, img_rgb[:, :, ::-1], casting="unsafe")
+
+    # Enhance the contrast on the green channel
+    buf.accurate_clahe.apply(np.ascontiguousarray(buf.bgr[:, :, 1]), buf.bgr_green)
+    buf.bgr[:, :, 1] = buf.bgr_green
+
+    # Remove noise
+    cv2.fastNlMeansDenoisingColored(buf.bgr, buf.bgr_denoised, 10, 10, 7, 21)
+
+    # Make details clearer
+    cv2.filter2D(buf.bgr_denoised, -1, SHARPEN_KERNEL, dst=buf.bgr_sharp)
+
+    # Back to RGB and scale pixel values to 0-1 range in one pass
+    np.divide(buf.bgr_sharp[:, :, ::-1], np.float32(255.0), out=out, dtype=np.float32)
+    return out
+
+
+def _fast_buffers():
+    if not hasattr(_scratch, "clahe"):
+        _scratch.clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
+        _scratch.work = np.empty((224, 224, 3), dtype=np.uint8)
+        _scratch.denoised = np.empty((224, 224, 3), dtype=np.uint8)
+        _scratch.green = np.empty((224, 224), dtype=np.uint8)
+    return _scratch
+
+
+def _preprocess_fast(img_rgb, out):
+    """
+    Same steps as the accurate path, but with a bilateral filter instead of
+    non-local means, no RGB/BGR round-trip (green is channel 1 either way),
+    and reused scratch buffers. Writes the float32 result into out.
+    """
+    buf = _fast_buffers()
+
+    # Enhance the contrast on the green channel, in place on a scratch copy
+    np.copyto(buf.work, img_rgb, casting="unsafe")
+    buf.clahe.apply(np.ascontiguousarray(buf.work[:, :, 1]), buf.green)
+    buf.work[:, :, 1] = buf.green
+
+    # Remove noise (edge-preserving, much cheaper than non-local means)
+    cv2.bilateralFilter(buf.work, FAST_DENOISE_DIAMETER, FAST_DENOISE_SIGMA_COLOR,
+                        FAST_DENOISE_SIGMA_SPACE, dst=buf.denoised)
+
+    # Make details clearer
+    cv2.filter2D(buf.denoised, -1, SHARPEN_KERNEL, dst=buf.work)
+
+    # Scale to 0-1 straight into the output buffer
+    np.multiply(buf.work, np.float32(1.0 / 255.0), out=out, dtype=np.float32)
+    return out
+
+
+def preprocess_image(img_rgb, engine=None, out=None):
+    """
+    Get the image ready for the AI model.
+
+    engine: "accurate" (default, original path) or "fast"; None uses
+            PREPROCESS_ENGINE from config
+    out:    optional preallocated (1, 224, 224, 3) float32 array to fill
+    """
+    if not _check_input(img_rgb):
         return None
 
     try:
-        # Prepare the image for processing
-        img = cv2.cvtColor(img_rgb, cv2.COLOR_RGB2BGR)
-
-        # Enhance the contrast on the green channel
-        b, g, r = cv2.split(img)
-        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
-        g2 = clahe.apply(g)
-        img = cv2.merge([b, g2, r])
-
-        # Remove noise
-        img = cv2.fastNlMeansDenoisingColored(img, None, 10, 10, 7, 21)
-
-        # Make details clearer
-        kernel = np.array([[0,-1,0],[-1,5,-1],[0,-1,0]])
-        img = cv2.filter2D(img, -1, kernel)
-
-        # Convert back to RGB
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        
-        # Scale pixel values to 0-1 range
-        img = img.astype("float32") / 255.0
-        
+        engine = _check_engine(engine)
+
         # Add batch dimension so the model knows it's one image
-        img = np.expand_dims(img, axis=0)
-        
-        return img
+        if out is None:
+            out = np.empty((1, 224, 224, 3), dtype=np.float32)
+
+        with stage_timer("preprocess"):
+            if engine == "fast":
+                _preprocess_fast(img_rgb, out[0])
+            else:
+                _preprocess_accurate(img_rgb, out[0])
+
+        return out
     except Exception as e:
         logger.error(f"Preprocessing failed: {e}")
-        return None
\ No newline at end of file
+        return None
+
+
+def preprocess_batch(images_rgb, engine=None, out=None):
+    """
+    Preprocess a stack of crops in one call.
+
+    Input:  (N, 224, 224, 3) uint8 array (or a list of (224, 224, 3) crops)
+    Output: (N, 224, 224, 3) float32 array, or None if any crop is invalid
+    """
+    if images_rgb is None or len(images_rgb) == 0:
+        logger.error("Preprocess batch received no images")
+        return None
+
+    if isinstance(images_rgb, np.ndarray) and images_rgb.ndim != 4:
+        logger.error(f"Invalid batch shape: {images_rgb.shape}, expected (N, 224, 224, 3)")
+        return None
+
+    try:
+        engine = _check_engine(engine)
+
+        n = len(images_rgb)
+        if out is None:
+            out = np.empty((n, 224, 224, 3), dtype=np.float32)
+        elif out.shape != (n, 224, 224, 3) or out.dtype != np.float32:
+            logger.error(f"Invalid output buffer: {out.shape} {out.dtype}")
+            return None
+
+        for i, img_rgb in enumerate(images_rgb):
+            if not _check_input(img_rgb):
+                return None
+            if engine == "fast":
+                _preprocess_fast(img_rgb, out[i])
+            else:
+                _preprocess_accurate(img_rgb, out[i])
+
+        return out
+    except Exception as e:
+        logger.error(f"Batch preprocessing failed: {e}")
+        return None
@@ -0,0 +1,137 @@
+# src/preprocess_parity.py
+"""
+Parity report for the preprocessing engines.
+Runs the same crops through every engine and the classifier, and reports
+how far the predictions drift from the "accurate" path and how long each
+engine takes.
+
+Usage:
+    python -m src.preprocess_parity --input-dir samples/ --output parity.json
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+from src.batch_runner import collect_image_paths
+from src.detector import detect_and_crop_batch, load_image
+from src.preprocess import ENGINES, preprocess_batch
+from src.classifier import predict_probabilities
+
+REFERENCE_ENGINE = "accurate"
+
+
+def load_crops(paths, batch_size=16):
+    """
+    Decode and crop every image once, so all engines see identical input.
+    """
+    crops = []
+    used = []
+    for start in range(0, len(paths), batch_size):
+        chunk = paths[start:start + batch_size]
+        images, names = [], []
+        for path in chunk:
+            try:
+                images.append(load_image(path))
+                names.append(path)
+            except ValueError as e:
+                print(f"Skipping {path}: {e}")
+        if not images:
+            continue
+        for path, crop_rgb in zip(names, detect_and_crop_batch(images, [p.name for p in names], save_boxed=False)):
+            if crop_rgb is not None:
+                crops.append(crop_rgb)
+                used.append(path)
+    return np.stack(crops) if crops else None, used
+
+
+def run_engine(crops, engine, batch_size=16):
+    """
+    Preprocess and classify all crops with one engine.
+    Returns (tensors, probabilities, preprocess seconds).
+    """
+    tensors = np.empty(crops.shape, dtype=np.float32)
+    start = time.perf_counter()
+    for i in range(0, len(crops), batch_size):
+        if preprocess_batch(crops[i:i + batch_size], engine=engine, out=tensors[i:i + batch_size]) is None:
+            raise ValueError(f"{engine} engine failed on batch starting at {i}")
+    seconds = time.perf_counter() - start
+
+    probs = np.concatenate([
+        predict_probabilities(tensors[i:i + batch_size])
+        for i in range(0, len(tensors), batch_size)
+    ])
+    return tensors, probs, seconds
+
+
+def parity_report(crops, batch_size=16):
+    """
+    Compare every engine against the reference engine on the same crops.
+    """
+    ref_tensors, ref_probs, ref_seconds = run_engine(crops, REFERENCE_ENGINE, batch_size)
+    n = len(crops)
+
+    report = {
+        "images": n,
+        "reference": REFERENCE_ENGINE,
+        "engines": {
+            REFERENCE_ENGINE: {"preprocess_ms_per_image": 1000 * ref_seconds / n},
+        },
+    }
+
+    for engine in ENGINES:
+        if engine == REFERENCE_ENGINE:
+            continue
+        tensors, probs, seconds = run_engine(crops, engine, batch_size)
+        drift = np.abs(probs - ref_probs)
+        report["engines"][engine] = {
+            "preprocess_ms_per_image": 1000 * seconds / n,
+            "speedup": ref_seconds / seconds if seconds > 0 else None,
+            "pixel_mean_abs_diff": float(np.mean(np.abs(tensors - ref_tensors))),
+            "prob_drift_mean": float(drift.mean()),
+            "prob_drift_p95": float(np.percentile(drift, 95)),
+            "prob_drift_max": float(drift.max()),
+            "label_agreement": float(np.mean((probs >= 0.5) == (ref_probs >= 0.5))),
+        }
+
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare preprocessing engines against the accurate path")
+    parser.add_argument("--input-dir", help="Folder of sample images")
+    parser.add_argument("--glob", default="*", help="Pattern for files inside --input-dir")
+    parser.add_argument("--manifest", help="Text/CSV file listing sample images")
+    parser.add_argument("--limit", type=int, default=500, help="Maximum number of images to use")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--output", help="Write the report as JSON to this file")
+    args = parser.parse_args()
+
+    paths = collect_image_paths(args.input_dir, args.glob, args.manifest)[:args.limit]
+    if not paths:
+        print("No sample images found.")
+        return
+
+    crops, used = load_crops(paths, args.batch_size)
+    if crops is None:
+        print("No usable crops found.")
+        return
+
+    report = parity_report(crops, args.batch_size)
+
+    print(f"\nParity over {report['images']} images (reference: {report['reference']})")
+    for engine, stats in report["engines"].items():
+        print(f"\n[{engine}]")
+        for key, value in stats.items():
+            print(f"  {key:<24} {value:.4f}" if isinstance(value, float) else f"  {key:<24} {value}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nSaved report to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+# src/quality.py
+"""
+Image quality measures for picking usable frames, and the quality gate
+that turns away unusable uploads before the models run.
+Everything is computed on a small copy of the region of interest, so
+scoring an image costs well under a millisecond once it is shrunk.
+"""
+
+import time
+
+import cv2
+import numpy as np
+
+from src.config import (
+    QUALITY_GATE, QUALITY_MIN_SHARPNESS, QUALITY_MIN_BRIGHTNESS, QUALITY_MAX_BRIGHTNESS,
+    QUALITY_MAX_CLIPPED, QUALITY_MAX_COLOR_CAST, QUALITY_MIN_REGION_PX,
+)
+from src.metrics import metrics, observe_stage
+
+# Longest side the region is scaled to before measuring, so sharpness
+# values are comparable between frame sizes
+QUALITY_DIM = 128
+
+GATE_MODES = ("reject", "flag", "off")
+
+QUALITY_CHECKS = metrics.counter(
+    "anemo_quality_checks",
+    "Quality gate results per check (blur, dark, bright, clipped, color_cast, small_region)",
+    ["check", "outcome"],
+)
+QUALITY_GATE_RESULTS = metrics.counter(
+    "anemo_quality_gate",
+    "Images through the quality gate by outcome (passed, flagged, rejected)",
+    ["outcome"],
+)
+
+# What to tell the user for each failed check
+REASONS = {
+    "blur": "The photo is blurry. Hold the camera steady and tap on the eyelid to focus.",
+    "dark": "The photo is too dark. Move somewhere brighter or turn on the flash.",
+    "bright": "The photo is overexposed. Avoid direct light on the eye.",
+    "clipped": "Large parts of the photo are pure black or white. Retake it in even lighting.",
+    "color_cast": "The colors look tinted by the light. Retake it in daylight or under white light.",
+    "small_region": "The inner eyelid is too small in the photo. Move the camera closer.",
+}
+
+if QUALITY_GATE not in GATE_MODES:
+    raise ValueError(f"Unknown quality gate mode: {QUALITY_GATE}. Choose from {list(GATE_MODES)}")
+
+
+class QualityRejected(ValueError):
+    """The image failed the quality gate; reasons says why, for the user."""
+
+    def __init__(self, failed):
+        self.failed = list(failed)
+        self.reasons = [REASONS[check] for check in self.failed]
+        super().__init__(f"Image failed quality checks: {', '.join(self.failed)}")
+
+
+def _region_gray(image_bgr, box=None):
+    if box is not None:
+        x1, y1, x2, y2 = (int(v) for v in box)
+        h, w = image_bgr.shape[:2]
+        region = image_bgr[max(0, y1):min(h, y2), max(0, x1):min(w, x2)]
+        if region.size == 0:
+            region = image_bgr
+    else:
+        region = image_bgr
+
+    h, w = region.shape[:2]
+    scale = QUALITY_DIM / max(h, w)
+    if scale < 1:
+        region = cv2.resize(region, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(region, cv2.COLOR_BGR2GRAY)
+
+
+def _thumbnail(image_bgr):
+    # About QUALITY_DIM on the longest side. Shrinking by a whole factor lets
+    # INTER_AREA take its fast path, about twice as fast on a full photo
+    h, w = image_bgr.shape[:2]
+    factor = -(-max(h, w) // QUALITY_DIM)
+    if factor <= 1:
+        return image_bgr
+    image_bgr = image_bgr[:h - h % factor, :w - w % factor]
+    return cv2.resize(image_bgr, (w // factor, h // factor), interpolation=cv2.INTER_AREA)
+
+
+def frame_quality(image_bgr, box=None):
+    """
+    Sharpness and exposure of an image (or the box inside it).
+
+    Returns a dict with:
+        sharpness   variance of the Laplacian (higher is sharper)
+        brightness  mean gray level (0-255)
+        clipped     fraction of pixels that are nearly black or white
+        score       combined score for ranking frames (higher is better)
+    """
+    gray = _region_gray(image_bgr, box)
+
+    sharpness = float(cv2.Laplacian(gray, cv2.CV_64F).var())
+    brightness = float(gray.mean())
+    clipped = float(np.mean((gray < 10) | (gray > 245)))
+
+    # 1.0 at mid-gray, falling to 0 at pure black/white, minus clipped area
+    exposure = max(0.0, 1.0 - abs(brightness - 128.0) / 128.0 - clipped)
+    return {
+        "sharpness": sharpness,
+        "brightness": brightness,
+        "clipped": clipped,
+        "score": float(np.log1p(sharpness) * exposure),
+    }
+
+
+class _CheckTimer:
+    # Times each gate check into anemo_stage_seconds and a per-call dict
+    def __init__(self):
+        self.timings = {}
+        self._last = time.perf_counter()
+
+    def lap(self, check):
+        now = time.perf_counter()
+        observe_stage(f"quality_{check}", now - self._last)
+        self.timings[check] = now - self._last
+        self._last = now
+
+
+def _gate_result(measures, failed, timer):
+    for check in failed:
+        QUALITY_CHECKS.inc(check=check, outcome="failed")
+    return {
+        "passed": not failed,
+        "failed": failed,
+        "reasons": [REASONS[check] for check in failed],
+        "measures": measures,
+        "timings": timer.timings,
+    }
+
+
+def check_image(image_bgr):
+    """
+    Quality gate for a whole photo, before detection: blur, exposure and
+    color cast, measured on a QUALITY_DIM thumbnail.
+
+    Returns a dict with passed, failed (check names), reasons (what to tell
+    the user), measures and timings (seconds per check).
+    """
+    timer = _CheckTimer()
+    small = _thumbnail(image_bgr)
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    timer.lap("resize")
+
+    failed = []
+    sharpness = float(cv2.Laplacian(gray, cv2.CV_64F).var())
+    timer.lap("blur")
+
+    brightness = float(gray.mean())
+    clipped = float(np.count_nonzero((gray < 10) | (gray > 245))) / gray.size
+    if brightness < QUALITY_MIN_BRIGHTNESS:
+        failed.append("dark")
+    elif brightness > QUALITY_MAX_BRIGHTNESS:
+        failed.append("bright")
+    elif clipped > QUALITY_MAX_CLIPPED:
+        failed.append("clipped")
+    timer.lap("exposure")
+
+    # A dark photo also has little detail; only call it blurry if it isn't
+    if not failed and sharpness < QUALITY_MIN_SHARPNESS:
+        failed.append("blur")
+
+    # Skin and conjunctiva under white light average out red/yellow, so
+    # only a lean towards green (a < 0) or blue (b < 0) counts as a cast
+    _, mean_a, mean_b, _ = cv2.mean(cv2.cvtColor(small, cv2.COLOR_BGR2LAB))
+    color_cast = float(np.hypot(min(mean_a - 128.0, 0.0), min(mean_b - 128.0, 0.0)))
+    if color_cast > QUALITY_MAX_COLOR_CAST:
+        failed.append("color_cast")
+    timer.lap("color")
+
+    measures = {"sharpness": sharpness, "brightness": brightness, "clipped": clipped, "color_cast": color_cast}
+    return _gate_result(measures, failed, timer)
+
+
+def check_region(box, image_shape):
+    """
+    Quality gate for the detected box: its shorter side, scaled to the
+    full-resolution image_shape, must be at least QUALITY_MIN_REGION_PX.
+    Same return value as check_image.
+    """
+    timer = _CheckTimer()
+    x1, y1, x2, y2 = box
+    h, w = image_shape[:2]
+    region_px = float(min(min(x2, w) - max(x1, 0), min(y2, h) - max(y1, 0)))
+    failed = ["small_region"] if region_px < QUALITY_MIN_REGION_PX else []
+    timer.lap("region")
+    return _gate_result({"region_px": region_px}, failed, timer)
+
+
+def merge_checks(*results):
+    """Combine check_image/check_region results into one."""
+    results = [result for result in results if result is not None]
+    failed = [check for result in results for check in result["failed"]]
+    return {
+        "passed": not failed,
+        "failed": failed,
+        "reasons": [REASONS[check] for check in failed],
+        "measures": {key: value for result in results for key, value in result["measures"].items()},
+        "timings": {key: value for result in results for key, value in result["timings"].items()},
+    }
+
+
+def enforce(result, mode=QUALITY_GATE):
+    """In "reject" mode, raise QualityRejected if the checks failed."""
+    if mode == "reject" and not result["passed"]:
+        QUALITY_GATE_RESULTS.inc(outcome="rejected")
+        raise QualityRejected(result["failed"])
+
+
+def record(result):
+    """Count an image that made it through the gate (flagged if any check failed)."""
+    QUALITY_GATE_RESULTS.inc(outcome="passed" if result["passed"] else "flagged")
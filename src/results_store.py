@@ -0,0 +1,182 @@
+# src/results_store.py
+"""
+Lifecycle management for result images in static/results.
+Every request writes a boxed image (and maybe a heatmap); this store puts
+them in sharded subdirectories so no single directory grows huge, and a
+background sweeper deletes files older than the TTL and trims the oldest
+files once the directory goes over its size quota.
+"""
+
+import hashlib
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+from src.config import RESULTS_DIR, RESULTS_TTL_SECONDS, RESULTS_MAX_BYTES, RESULTS_SWEEP_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# Hex characters used for the shard directory name (256 shards)
+SHARD_CHARS = 2
+
+
+class ResultsStore:
+    """
+    Sharded result directory with TTL expiry and a total-size quota.
+    ttl_seconds or max_bytes of 0 turn that limit off.
+    """
+
+    def __init__(self, root=RESULTS_DIR, ttl_seconds=RESULTS_TTL_SECONDS, max_bytes=RESULTS_MAX_BYTES):
+        self.root = Path(root)
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sweeper = None
+
+        self.stats = {
+            "files": 0,
+            "bytes": 0,
+            "files_written": 0,
+            "expired_files": 0,
+            "evicted_files": 0,
+            "evicted_bytes": 0,
+            "sweeps": 0,
+            "last_sweep_seconds": None,
+        }
+
+    def _shard(self, stem):
+        # Upload names are UUIDs, so their first characters are already random;
+        # anything else (e.g. CLI file names) is hashed first
+        head = stem[:SHARD_CHARS].lower()
+        if len(head) == SHARD_CHARS and all(c in "0123456789abcdef" for c in head):
+            return head
+        return hashlib.sha1(stem.encode()).hexdigest()[:SHARD_CHARS]
+
+    def path_for(self, kind, image_name, extension):
+        """
+        Where to save a result image, e.g. results/3f/boxed_3f2a....jpg
+        """
+        stem = Path(image_name).stem
+        return self.root / self._shard(stem) / f"{kind}_{stem}{extension}"
+
+    def contains(self, path):
+        try:
+            Path(path).resolve().relative_to(self.root.resolve())
+            return True
+        except ValueError:
+            return False
+
+    def record(self, path):
+        """Count a newly written file (exact totals are refreshed each sweep)."""
+        try:
+            size = Path(path).stat().st_size
+        except OSError:
+            return
+        with self._lock:
+            self.stats["files"] += 1
+            self.stats["bytes"] += size
+            self.stats["files_written"] += 1
+
+    def _scan(self):
+        files = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def _delete(self, path):
+        try:
+            os.unlink(path)
+            return True
+        except OSError:
+            return False
+
+    def sweep(self, now=None):
+        """
+        Delete expired files, then the oldest files until under quota.
+        Returns the stats after the sweep.
+        """
+        start = time.perf_counter()
+        now = time.time() if now is None else now
+
+        files = sorted(self._scan())
+        kept = []
+        expired = 0
+        evicted = 0
+        evicted_bytes = 0
+
+        for mtime, size, path in files:
+            if self.ttl_seconds and now - mtime > self.ttl_seconds:
+                if self._delete(path):
+                    expired += 1
+                    evicted_bytes += size
+                    continue
+            kept.append((mtime, size, path))
+
+        total = sum(size for _, size, _ in kept)
+        if self.max_bytes and total > self.max_bytes:
+            # Delete oldest first until we fit
+            remaining = []
+            for mtime, size, path in kept:
+                if total > self.max_bytes and self._delete(path):
+                    total -= size
+                    evicted += 1
+                    evicted_bytes += size
+                else:
+                    remaining.append((mtime, size, path))
+            kept = remaining
+
+        with self._lock:
+            self.stats["files"] = len(kept)
+            self.stats["bytes"] = total
+            self.stats["expired_files"] += expired
+            self.stats["evicted_files"] += evicted
+            self.stats["evicted_bytes"] += evicted_bytes
+            self.stats["sweeps"] += 1
+            self.stats["last_sweep_seconds"] = time.perf_counter() - start
+            snapshot = dict(self.stats)
+
+        if expired or evicted:
+            logger.info(f"Results sweep removed {expired} expired and {evicted} over-quota files")
+        return snapshot
+
+    def _sweep_loop(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"Results sweep failed: {e}", exc_info=True)
+
+    def start_sweeper(self, interval=RESULTS_SWEEP_INTERVAL):
+        """Sweep once now, then every interval seconds on a daemon thread."""
+        if interval <= 0 or (self._sweeper is not None and self._sweeper.is_alive()):
+            return
+        self.sweep()
+        self._stop.clear()
+        self._sweeper = threading.Thread(
+            target=self._sweep_loop, args=(interval,), name="results-sweeper", daemon=True
+        )
+        self._sweeper.start()
+
+    def stop_sweeper(self):
+        self._stop.set()
+        if self._sweeper is not None:
+            self._sweeper.join(timeout=5)
+            self._sweeper = None
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats)
+
+
+# Shared store for the results directory
+results_store = ResultsStore()
@@ -0,0 +1,109 @@
+# src/runtimes.py
+"""
+Lightweight CPU runtimes for the exported classifier.
+Both wrappers have the same predict(batch, verbose=0) -> (N, 1) interface
+as the Keras model, so the classifier code doesn't care which one it got.
+Exports are made with python -m src.export_model.
+"""
+
+import logging
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class TFLiteModel:
+    """
+    A .tflite classifier. Uses the small tflite_runtime package when it is
+    installed, otherwise TensorFlow's built-in interpreter. Quantized
+    (int8/uint8) inputs and outputs are converted automatically.
+    """
+
+    def __init__(self, path, threads=None):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+
+        self.path = str(path)
+        self._interpreter = Interpreter(model_path=self.path, num_threads=threads or None)
+        self._input = self._interpreter.get_input_details()[0]
+        self._output = self._interpreter.get_output_details()[0]
+        self._batch_size = None
+        # The interpreter keeps state between calls, so one call at a time
+        self._lock = threading.Lock()
+
+    def _resize(self, batch_size):
+        if batch_size != self._batch_size:
+            shape = [batch_size] + list(self._input["shape"][1:])
+            self._interpreter.resize_tensor_input(self._input["index"], shape)
+            self._interpreter.allocate_tensors()
+            self._batch_size = batch_size
+
+    def _quantize(self, batch):
+        dtype = self._input["dtype"]
+        if dtype == np.float32:
+            return batch.astype(np.float32, copy=False)
+        scale, zero_point = self._input["quantization"]
+        info = np.iinfo(dtype)
+        return np.clip(np.round(batch / scale + zero_point), info.min, info.max).astype(dtype)
+
+    def _dequantize(self, output):
+        if self._output["dtype"] == np.float32:
+            return output
+        scale, zero_point = self._output["quantization"]
+        return (output.astype(np.float32) - zero_point) * scale
+
+    def predict(self, batch, verbose=0):
+        batch = np.asarray(batch, dtype=np.float32)
+        with self._lock:
+            self._resize(len(batch))
+            self._interpreter.set_tensor(self._input["index"], self._quantize(batch))
+            self._interpreter.invoke()
+            output = self._interpreter.get_tensor(self._output["index"]).copy()
+        return self._dequantize(output).reshape(len(batch), -1)
+
+
+class OnnxModel:
+    """A .onnx classifier run with onnxruntime on the CPU."""
+
+    def __init__(self, path, threads=None):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        self.path = str(path)
+        self._session = ort.InferenceSession(self.path, options, providers=["CPUExecutionProvider"])
+        self._input_name = self._session.get_inputs()[0].name
+
+    def predict(self, batch, verbose=0):
+        batch = np.asarray(batch, dtype=np.float32)
+        output = self._session.run(None, {self._input_name: batch})[0]
+        return np.asarray(output, dtype=np.float32).reshape(len(batch), -1)
+
+
+# Backend name -> wrapper class for exported models
+RUNTIMES = {
+    "tflite": TFLiteModel,
+    "onnx": OnnxModel,
+}
+
+
+def load_runtime(backend, path, threads=None):
+    """Open an exported classifier with the named runtime."""
+    if backend not in RUNTIMES:
+        raise ValueError(f"Unknown classifier runtime: {backend}. Choose from {sorted(RUNTIMES)}")
+    logger.info(f"Loading {backend} classifier from {path}...")
+    try:
+        return RUNTIMES[backend](path, threads)
+    except ImportError:
+        raise
+    except Exception as e:
+        raise RuntimeError(f"Could not load {backend} classifier: {e}")
@@ -0,0 +1,160 @@
+# src/shadow.py
+"""
+Shadow inference for trying a new classifier on live traffic.
+A sampled fraction of /predict requests also go to the shadow model, on its
+own thread after the live model has answered. Its probability and latency
+are compared with the live model's in metrics and in /models; nothing it
+does reaches the response, and when it falls behind samples are skipped
+rather than queued.
+"""
+
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from src.config import SHADOW_MODEL_PATH, SHADOW_SAMPLE_RATE, SHADOW_MAX_PENDING
+from src.models import registry
+from src.classifier import load_classifier, probability_from_label
+from src.metrics import metrics, stage_timer
+
+logger = logging.getLogger(__name__)
+
+# Registry entry for the shadow model, so it is versioned and hot swapped
+# like the others (but never preloaded or waited for by /ready)
+SHADOW_ENTRY = "classifier_shadow"
+
+SHADOW_PREDICTIONS = metrics.counter(
+    "anemo_shadow_predictions",
+    "Shadow model comparisons by outcome (agree, disagree, failed, skipped) and shadow version",
+    ["outcome", "version"],
+)
+SHADOW_DIFF = metrics.histogram(
+    "anemo_shadow_probability_diff",
+    "Absolute difference between the shadow and live anemia probabilities",
+    buckets=(0.01, 0.02, 0.05, 0.1, 0.2, 0.3, 0.5, 1.0),
+)
+
+
+def _warm_up(model):
+    model.predict(np.zeros((1, 224, 224, 3), dtype=np.float32), verbose=0)
+
+
+class ShadowRunner:
+    """
+    Runs the classifier at path next to the live one on sample_rate of the
+    requests passed to maybe_run. Call start() once the server is up (it
+    loads and warms the shadow model in the background) and stop() on
+    shutdown.
+    """
+
+    def __init__(self, path=SHADOW_MODEL_PATH, sample_rate=SHADOW_SAMPLE_RATE,
+                 max_pending=SHADOW_MAX_PENDING, seed=None):
+        if not path:
+            raise ValueError("A shadow model path is required")
+        self.path = str(path)
+        self.sample_rate = min(max(sample_rate, 0.0), 1.0)
+        self.max_pending = max(1, max_pending)
+        self.pending = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._seconds = deque(maxlen=1000)
+        self.stats = {"compared": 0, "agreed": 0, "abs_diff_sum": 0.0, "skipped": 0, "failed": 0}
+
+        registry.register(SHADOW_ENTRY, lambda: load_classifier(self.path), _warm_up,
+                          source=self.path, preload=False)
+
+    def start(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shadow")
+            self._executor.submit(self._warm)
+
+    def stop(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _warm(self):
+        try:
+            registry.warm_up(SHADOW_ENTRY)
+        except Exception as e:
+            logger.error(f"Could not load shadow model {self.path}: {e}")
+
+    def _version(self):
+        return registry.versions().get(SHADOW_ENTRY) or "-"
+
+    def maybe_run(self, input_tensor, label, confidence):
+        """
+        With probability sample_rate, queue the (1, 224, 224, 3) tensor for
+        the shadow model and compare with the live (label, confidence).
+        Returns right away; True if the request was sampled.
+        """
+        if self._executor is None or self._random.random() >= self.sample_rate:
+            return False
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.stats["skipped"] += 1
+                SHADOW_PREDICTIONS.inc(outcome="skipped", version=self._version())
+                return False
+            self.pending += 1
+        try:
+            self._executor.submit(self._compare, input_tensor, probability_from_label(label, confidence))
+        except RuntimeError:
+            # Shutting down
+            with self._lock:
+                self.pending -= 1
+            return False
+        return True
+
+    def _compare(self, input_tensor, live_probability):
+        try:
+            model = registry.get(SHADOW_ENTRY)
+            start = time.perf_counter()
+            with stage_timer("classify_shadow"):
+                probability = float(model.predict(input_tensor, verbose=0)[0, 0])
+            seconds = time.perf_counter() - start
+        except Exception as e:
+            logger.warning(f"Shadow prediction failed: {e}")
+            with self._lock:
+                self.pending -= 1
+                self.stats["failed"] += 1
+            SHADOW_PREDICTIONS.inc(outcome="failed", version=self._version())
+            return
+
+        diff = abs(probability - live_probability)
+        agree = (probability >= 0.5) == (live_probability >= 0.5)
+        with self._lock:
+            self.pending -= 1
+            self.stats["compared"] += 1
+            self.stats["agreed"] += int(agree)
+            self.stats["abs_diff_sum"] += diff
+            self._seconds.append(seconds)
+
+        SHADOW_DIFF.observe(diff)
+        SHADOW_PREDICTIONS.inc(outcome="agree" if agree else "disagree", version=self._version())
+        if not agree:
+            logger.info(f"Shadow model disagrees: live p={live_probability:.3f}, shadow p={probability:.3f}")
+
+    def summary(self):
+        """Agreement, mean probability difference and shadow latency so far."""
+        with self._lock:
+            stats = dict(self.stats)
+            seconds = list(self._seconds)
+        compared = stats["compared"]
+        return {
+            "path": self.path,
+            "version": registry.versions().get(SHADOW_ENTRY),
+            "sample_rate": self.sample_rate,
+            "compared": compared,
+            "agreement": stats["agreed"] / compared if compared else None,
+            "mean_abs_diff": stats["abs_diff_sum"] / compared if compared else None,
+            "p50_ms": float(np.percentile(seconds, 50) * 1000) if seconds else None,
+            "skipped": stats["skipped"],
+            "failed": stats["failed"],
+            "pending": self.pending,
+        }
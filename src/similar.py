@@ -0,0 +1,269 @@
+# src/similar.py
+"""
+Similar-case index over classifier embeddings.
+Every screened case's embedding (src/embeddings.py) is appended to a
+float16 file, and its request id, label, confidence and result image are
+kept in SQLite under the same row number. Reviewers auditing a borderline
+prediction ask for the closest earlier cases.
+
+Search is a dot product (embeddings are unit length, so it is the cosine
+similarity). Small indexes are searched exactly. Large ones first score a
+low-dimensional random projection of every vector (kept as float32 in
+memory, a fraction of the full vectors' size) and re-rank the best
+candidates with the full vectors. Only cases embedded by the same
+classifier version are compared.
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+from src.config import EMBEDDINGS_DIR, SIMILAR_EXACT_MAX, SIMILAR_SKETCH_DIM
+from src.metrics import metrics, stage_timer
+
+logger = logging.getLogger(__name__)
+
+SIMILAR_CASES = metrics.gauge("anemo_similar_cases", "Cases in the similar-case index")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cases (
+    row INTEGER PRIMARY KEY,
+    request_id TEXT NOT NULL UNIQUE,
+    label TEXT NOT NULL,
+    confidence REAL NOT NULL,
+    image_path TEXT,
+    version TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+# Rows re-ranked exactly per neighbour wanted when searching the sketch,
+# and at least MIN_CANDIDATES (recall@10 ~0.99 on 200k clustered vectors)
+OVERSAMPLE = 100
+MIN_CANDIDATES = 1000
+
+# Rows converted to float32 at a time in exact search
+CHUNK_ROWS = 16384
+
+
+class SimilarIndex:
+    """
+    Append-only embedding index in root (vectors.f16 + cases.sqlite3).
+    Safe to use from the event loop's executor threads: inserts and
+    searches take a lock, and searches only read rows that are complete.
+    """
+
+    def __init__(self, root=EMBEDDINGS_DIR, exact_max=SIMILAR_EXACT_MAX, sketch_dim=SIMILAR_SKETCH_DIM):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.exact_max = exact_max
+        self.sketch_dim = sketch_dim
+        self._vectors_path = self.root / "vectors.f16"
+        self._lock = threading.Lock()
+
+        self._db = sqlite3.connect(str(self.root / "cases.sqlite3"), check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_SCHEMA)
+
+        # Empty (dim 0) until the first embedding sets the dimension
+        self.dim = 0
+        self.count = 0
+        self._init_arrays(0, 0)
+        self._version_codes = {}
+        self._load()
+        SIMILAR_CASES.set_function(lambda: self.count)
+
+    # ---- storage ----
+
+    def _load(self):
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'dim'").fetchone()
+        if row is None:
+            return
+        self._init_arrays(int(row["value"]), 1024)
+
+        versions = [r["version"] for r in self._db.execute("SELECT version FROM cases ORDER BY row")]
+        stored = np.fromfile(self._vectors_path, dtype=np.float16) if self._vectors_path.exists() else np.empty(0, np.float16)
+        # A crash can leave a vector without its row (or half a vector); keep
+        # only rows that are complete in both
+        count = min(len(versions), len(stored) // self.dim)
+        if count < len(versions):
+            self._db.execute("DELETE FROM cases WHERE row >= ?", (count,))
+            self._db.commit()
+        if count * self.dim < len(stored):
+            self._truncate_vectors(count)
+
+        self._append_rows(stored[:count * self.dim].reshape(count, self.dim), versions[:count])
+        logger.info(f"Similar-case index: {self.count} cases ({self.dim}-d) from {self.root}")
+
+    def _truncate_vectors(self, count):
+        # Cut the vector file back to its first count complete vectors
+        with open(self._vectors_path, "r+b") as f:
+            f.truncate(count * self.dim * np.dtype(np.float16).itemsize)
+
+    def _init_arrays(self, dim, capacity):
+        self.dim = dim
+        self._vectors = np.empty((capacity, dim), dtype=np.float16)
+        self._sketch = np.empty((capacity, self.sketch_dim), dtype=np.float32)
+        # Classifier version code per row
+        self._codes = np.empty(capacity, dtype=np.int32)
+        # Fixed seed: the same projection every time the index is loaded
+        projection = np.random.RandomState(0).standard_normal((dim, self.sketch_dim))
+        self._projection = (projection / np.sqrt(self.sketch_dim)).astype(np.float32)
+
+    def _append_rows(self, vectors, versions):
+        n = len(vectors)
+        needed = self.count + n
+        if needed > len(self._vectors):
+            # Double the capacity, so inserts stay amortized O(1)
+            capacity = max(needed, 2 * len(self._vectors))
+            for name in ("_vectors", "_sketch", "_codes"):
+                old = getattr(self, name)
+                grown = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+                grown[:self.count] = old[:self.count]
+                setattr(self, name, grown)
+
+        self._vectors[self.count:needed] = vectors
+        for start in range(0, n, CHUNK_ROWS):
+            chunk = vectors[start:start + CHUNK_ROWS].astype(np.float32)
+            self._sketch[self.count + start:self.count + start + len(chunk)] = chunk @ self._projection
+        self._codes[self.count:needed] = [self._code(version) for version in versions]
+        self.count = needed
+
+    def _code(self, version):
+        return self._version_codes.setdefault(version, len(self._version_codes))
+
+    def add(self, request_id, embedding, label, confidence, image_path=None, version="-"):
+        """Insert one case. Its embedding is a unit-length (D,) vector."""
+        embedding = np.asarray(embedding, dtype=np.float16).reshape(-1)
+        with self._lock:
+            if self.dim == 0:
+                self._init_arrays(len(embedding), 1024)
+                self._db.execute("INSERT INTO meta (key, value) VALUES ('dim', ?)", (str(self.dim),))
+            elif len(embedding) != self.dim:
+                raise ValueError(f"Embedding has {len(embedding)} dimensions, the index has {self.dim}")
+
+            # The row is only committed once its vector is written, so a crash
+            # in between leaves at most a vector without a row (dropped on load)
+            self._db.execute(
+                "INSERT INTO cases (row, request_id, label, confidence, image_path, version, created) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self.count, request_id, label, confidence, image_path, version or "-", time.time()),
+            )
+            try:
+                with open(self._vectors_path, "ab") as f:
+                    f.write(embedding.tobytes())
+            except OSError:
+                self._db.rollback()
+                # Drop any part of the vector that reached the file, or every
+                # later vector would be read back shifted against its row
+                try:
+                    self._truncate_vectors(self.count)
+                except OSError as e:
+                    logger.error(f"Could not truncate {self._vectors_path} after a failed write: {e}")
+                raise
+            self._db.commit()
+            self._append_rows(embedding[None], [version or "-"])
+
+    # ---- search ----
+
+    def case(self, request_id):
+        """The stored case for a request id as a dict, or None."""
+        with self._lock:
+            row = self._db.execute("SELECT * FROM cases WHERE request_id = ?", (request_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def _scores(self, query, count=0, rows=None):
+        # Exact similarity for the first count rows (contiguous slices) or
+        # for the given rows, converting float16 in chunks
+        n = count if rows is None else len(rows)
+        scores = np.empty(n, dtype=np.float32)
+        for start in range(0, n, CHUNK_ROWS):
+            stop = min(start + CHUNK_ROWS, n)
+            chunk = self._vectors[start:stop] if rows is None else self._vectors[rows[start:stop]]
+            scores[start:stop] = chunk.astype(np.float32) @ query
+        return scores
+
+    def search_vector(self, query, k=10, version=None, before_row=None):
+        """
+        The k rows most similar to a unit-length query, as (rows, similarities),
+        best first. With a version, only rows embedded by that version count;
+        with before_row, only rows added before it (rows are in insertion
+        order).
+        """
+        with self._lock:
+            count = self.count if before_row is None else min(self.count, before_row)
+            if count == 0 or k < 1:
+                return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+            query = np.asarray(query, dtype=np.float32).reshape(-1)
+
+            eligible = np.ones(count, dtype=bool)
+            if version is not None:
+                code = self._version_codes.get(version)
+                eligible = self._codes[:count] == code if code is not None else np.zeros(count, dtype=bool)
+            eligible_count = int(eligible.sum())
+            if eligible_count == 0:
+                return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+            with stage_timer("similar_search"):
+                if eligible_count > self.exact_max:
+                    # Approximate first pass on the sketch, then exact scores
+                    # for the best candidates only
+                    rough = self._sketch[:count] @ (query @ self._projection)
+                    rough[~eligible] = -np.inf
+                    wanted = min(eligible_count, max(k * OVERSAMPLE, MIN_CANDIDATES))
+                    rows = np.argpartition(-rough, wanted - 1)[:wanted]
+                    scores = self._scores(query, rows=rows)
+                elif eligible_count == count:
+                    rows = np.arange(count)
+                    scores = self._scores(query, count)
+                else:
+                    # Only the eligible rows are converted and scored
+                    rows = np.flatnonzero(eligible)
+                    scores = self._scores(query, rows=rows)
+
+        k = min(k, len(rows))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best], kind="stable")]
+        return rows[best], scores[best]
+
+    def similar(self, request_id, k=10):
+        """
+        (the case for request_id, its k most similar earlier cases as dicts
+        with a "similarity"), or (None, []) if the request isn't indexed.
+        """
+        case = self.case(request_id)
+        if case is None:
+            return None, []
+        with self._lock:
+            query = self._vectors[case["row"]].astype(np.float32)
+        rows, scores = self.search_vector(query, k, version=case["version"], before_row=case["row"])
+        if len(rows) == 0:
+            return case, []
+
+        with self._lock:
+            found = {
+                row["row"]: dict(row)
+                for row in self._db.execute(
+                    f"SELECT * FROM cases WHERE row IN ({','.join('?' * len(rows))})", [int(r) for r in rows]
+                )
+            }
+        neighbours = []
+        for row, score in zip(rows, scores):
+            neighbour = found.get(int(row))
+            if neighbour is not None:
+                neighbour["similarity"] = round(float(score), 4)
+                neighbours.append(neighbour)
+        return case, neighbours
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,233 @@
+# src/streaming.py
+"""
+Camera stream screening.
+Instead of running the full pipeline on every photo, a stream session runs
+only the (cheap, downscaled) detector on each incoming frame, tracks the
+conjunctiva box from frame to frame and scores how sharp and well exposed
+it is. The best few frames are kept, and only those are decoded at full
+size, preprocessed and classified when the stream finishes. Their
+probabilities are averaged (weighted by frame quality) into one result.
+"""
+
+import asyncio
+import heapq
+import logging
+from pathlib import Path
+
+import numpy as np
+
+from src.config import (
+    STREAM_DETECT_MAX_DIM, STREAM_TOP_FRAMES, STREAM_MIN_SHARPNESS, STREAM_MIN_STABLE_FRAMES,
+)
+from src.detector import decode_image, crop_to_box, render_boxed, boxed_path_for
+from src.preprocess import preprocess_image
+from src.classifier import label_from_probability, probability_from_label
+from src.quality import frame_quality
+from src.pipeline import model_versions, record_versions
+from src.metrics import metrics
+from src.admission import StageLimits
+
+logger = logging.getLogger(__name__)
+
+STREAM_FRAMES = metrics.counter(
+    "anemo_stream_frames",
+    "Frames received by stream sessions, by what happened to them",
+    ["outcome"],
+)
+
+
+def box_iou(a, b):
+    """Intersection over union of two (x1, y1, x2, y2) boxes."""
+    x1, y1 = max(a[0], b[0]), max(a[1], b[1])
+    x2, y2 = min(a[2], b[2]), min(a[3], b[3])
+    inter = max(0.0, x2 - x1) * max(0.0, y2 - y1)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+
+class BoxTracker:
+    """
+    Follows the detected box across frames in normalized (0-1) coordinates.
+    The box is smoothed so one jittery detection doesn't move it much, and
+    stable_frames counts how many frames in a row matched the track.
+    """
+
+    def __init__(self, smoothing=0.5, min_iou=0.5):
+        self.smoothing = smoothing
+        self.min_iou = min_iou
+        self.box = None
+        self.stable_frames = 0
+
+    def lose(self):
+        # No detection in this frame: the track starts over
+        self.box = None
+        self.stable_frames = 0
+
+    def update(self, box):
+        if self.box is not None and box_iou(self.box, box) >= self.min_iou:
+            tracked = tuple(self.smoothing * old + (1 - self.smoothing) * new for old, new in zip(self.box, box))
+            self.stable_frames += 1
+        else:
+            # New or jumped box: start a new track
+            tracked = tuple(box)
+            self.stable_frames = 1
+        self.box = tracked
+        return tracked, self.stable_frames
+
+
+class StreamSession:
+    """
+    One camera stream. Call add_frame for every frame (encoded bytes), then
+    finish to classify the best frames.
+    batchers come from pipeline.create_batchers and must be running.
+    limits (admission.StageLimits) caps decodes like it does for /predict.
+    """
+
+    def __init__(self, batchers, renderer=None, top_frames=STREAM_TOP_FRAMES,
+                 detect_max_dim=STREAM_DETECT_MAX_DIM, min_sharpness=STREAM_MIN_SHARPNESS,
+                 min_stable_frames=STREAM_MIN_STABLE_FRAMES, limits=None):
+        self.batchers = batchers
+        self.renderer = renderer
+        self.limits = limits if limits is not None else StageLimits()
+        self.top_frames = max(1, top_frames)
+        self.detect_max_dim = detect_max_dim
+        self.min_sharpness = min_sharpness
+        self.min_stable_frames = max(1, min_stable_frames)
+        self.reset()
+
+    def reset(self):
+        self.frames = 0
+        self.tracker = BoxTracker()
+        # Min-heap of (score, frame index, frame bytes, normalized box)
+        self._best = []
+        # Versions of the models that served the stream so far
+        self._served = {}
+
+    @property
+    def ready(self):
+        """True once there are enough good frames and the box is steady."""
+        return len(self._best) >= self.top_frames and self.tracker.stable_frames >= self.min_stable_frames
+
+    async def add_frame(self, data, deadline=None):
+        """
+        Detect and score one frame. Returns feedback for the client:
+        whether the conjunctiva was found, the tracked box (0-1 coordinates),
+        the frame quality and whether the stream is ready to finish.
+        Raises ValueError if the frame can't be decoded, and
+        admission.DeadlineExceeded past the (event loop time) deadline.
+        """
+        loop = asyncio.get_event_loop()
+        index = self.frames
+        self.frames += 1
+        STREAM_FRAMES.inc(outcome="received")
+
+        async with self.limits.slot("decode", deadline):
+            image_bgr = await loop.run_in_executor(None, decode_image, bytes(data), self.detect_max_dim)
+        (_, box), used = await self.batchers["detector"].submit(image_bgr, deadline)
+        record_versions(self._served, used, "detector")
+
+        feedback = {"type": "frame", "frame": index, "detected": box is not None}
+        if box is None:
+            self.tracker.lose()
+        else:
+            STREAM_FRAMES.inc(outcome="detected")
+            h, w = image_bgr.shape[:2]
+            tracked, stable = self.tracker.update((box[0] / w, box[1] / h, box[2] / w, box[3] / h))
+            quality = frame_quality(image_bgr, box)
+
+            usable = quality["sharpness"] >= self.min_sharpness
+            if usable:
+                STREAM_FRAMES.inc(outcome="usable")
+                # Frames early in a track count less: the box may still be settling
+                score = quality["score"] * min(stable, self.min_stable_frames) / self.min_stable_frames
+                self._keep(score, index, bytes(data), tracked)
+
+            feedback.update(
+                box=[round(v, 4) for v in tracked],
+                stable_frames=stable,
+                quality={key: round(value, 3) for key, value in quality.items()},
+                usable=usable,
+            )
+
+        feedback["ready"] = self.ready
+        return feedback
+
+    def _keep(self, score, index, data, box):
+        entry = (score, index, data, box)
+        if len(self._best) < self.top_frames:
+            heapq.heappush(self._best, entry)
+        elif score > self._best[0][0]:
+            heapq.heapreplace(self._best, entry)
+
+    async def _prepare_in_slot(self, data, box, deadline):
+        # Decode and preprocess one kept frame, counted as a decode
+        async with self.limits.slot("decode", deadline):
+            return await asyncio.get_event_loop().run_in_executor(None, self._prepare, data, box)
+
+    @staticmethod
+    def _prepare(data, box):
+        # Full-size decode, box scaled back up from 0-1 coordinates
+        image_bgr = decode_image(data)
+        h, w = image_bgr.shape[:2]
+        box_px = (int(box[0] * w), int(box[1] * h), int(np.ceil(box[2] * w)), int(np.ceil(box[3] * h)))
+        crop_rgb = crop_to_box(image_bgr, box_px)
+        return image_bgr, box_px, preprocess_image(crop_rgb)
+
+    async def finish(self, image_name, deadline=None):
+        """
+        Classify the kept frames and combine them into one result, in the
+        same shape as run_pipeline_async's, plus per-frame details.
+        image_name is a safe filename for the boxed image of the best frame.
+        Raises ValueError if no usable frame was seen, and
+        admission.DeadlineExceeded past the (event loop time) deadline.
+        """
+        if not self._best:
+            raise ValueError("No usable frames with a detected conjunctiva")
+
+        loop = asyncio.get_event_loop()
+        best = sorted(self._best, reverse=True)
+        prepared = await asyncio.gather(*[self._prepare_in_slot(data, box, deadline) for _, _, data, box in best])
+        tensors = [tensor for _, _, tensor in prepared]
+        if any(tensor is None for tensor in tensors):
+            raise ValueError("Failed to preprocess image")
+
+        # The classifier batcher combines these into one model call
+        replies = await asyncio.gather(*[self.batchers["classifier"].submit(tensor, deadline) for tensor in tensors])
+        STREAM_FRAMES.inc(len(tensors), outcome="classified")
+        predictions = [prediction for prediction, _ in replies]
+        for _, used in replies:
+            record_versions(self._served, used, "classifier")
+
+        probs = np.array([probability_from_label(label, confidence) for label, confidence in predictions])
+        weights = np.array([max(score, 1e-6) for score, _, _, _ in best])
+        label, confidence = label_from_probability(float(np.average(probs, weights=weights)))
+        agreement = float(np.mean((probs >= 0.5) == (label == "ANEMIC")))
+
+        note = None
+        if agreement < 1.0:
+            note = "The selected frames disagreed. Consider retaking with a steadier camera."
+
+        boxed_image_path = boxed_path_for(image_name)
+        result = {
+            "label": label,
+            "confidence": round(confidence * 100, 2),
+            "boxed_image_path": str(boxed_image_path),
+            "note": note,
+            "frames_received": self.frames,
+            "frames_used": len(best),
+            "agreement": agreement,
+            "model_versions": model_versions(self._served),
+            "frame_results": [
+                {"frame": index, "probability": round(float(p), 4), "quality_score": round(score, 3)}
+                for (score, index, _, _), p in zip(best, probs)
+            ],
+        }
+
+        # Boxed image of the best frame
+        image_bgr, box_px, _ = prepared[0]
+        if self.renderer is not None:
+            self.renderer.submit(Path(image_name).stem, "boxed_image", boxed_image_path,
+                                 render_boxed, image_bgr, box_px, boxed_image_path)
+        else:
+            await loop.run_in_executor(None, render_boxed, image_bgr, box_px, boxed_image_path)
+        return result
@@ -0,0 +1,117 @@
+# src/tta.py
+"""
+Test-time augmentation for borderline predictions.
+A photo whose first prediction is near 0.5 is classified again as a set of
+slightly changed copies (mirrored, shifted a few pixels, a little brighter
+or darker), all in one model batch, and the probabilities are averaged.
+The spread between the copies says how much the answer depends on
+framing and exposure.
+
+The copies are made from the preprocessed (1, 224, 224, 3) tensor rather
+than the raw crop, so denoising runs once per request, not once per copy.
+"""
+
+import logging
+
+import numpy as np
+
+from src.config import TTA, TTA_VARIANTS, TTA_BAND_LOW, TTA_BAND_HIGH, TTA_SHIFT_PX, TTA_BRIGHTNESS
+from src.classifier import label_from_probability
+from src.metrics import metrics, stage_timer
+
+logger = logging.getLogger(__name__)
+
+TTA_RUNS = metrics.counter(
+    "anemo_tta",
+    "Test-time augmentation runs, by whether the averaged label kept or flipped the first prediction",
+    ["outcome"],
+)
+TTA_STD = metrics.histogram(
+    "anemo_tta_probability_std",
+    "Standard deviation of the anemia probability across augmented copies",
+    buckets=(0.01, 0.02, 0.05, 0.1, 0.15, 0.2, 0.3, 0.5),
+)
+
+
+def variant_specs(count=TTA_VARIANTS, shift=TTA_SHIFT_PX, brightness=TTA_BRIGHTNESS):
+    """
+    (mirror, dx, dy, brightness factor) for each copy, the unchanged tensor
+    first. At most 12 copies.
+    """
+    up, down = 1.0 + brightness, 1.0 - brightness
+    specs = [
+        (False, 0, 0, 1.0),
+        (True, 0, 0, 1.0),
+        (False, shift, 0, 1.0),
+        (False, -shift, 0, 1.0),
+        (False, 0, shift, 1.0),
+        (False, 0, -shift, 1.0),
+        (False, 0, 0, up),
+        (False, 0, 0, down),
+        (True, shift, shift, 1.0),
+        (True, -shift, -shift, 1.0),
+        (True, 0, 0, up),
+        (True, 0, 0, down),
+    ]
+    if count < 2:
+        raise ValueError("Test-time augmentation needs at least 2 variants")
+    return specs[:count]
+
+
+SPECS = variant_specs() if TTA else []
+
+
+def augment(input_tensor, specs):
+    """
+    Copies of a (1, 224, 224, 3) float32 tensor (values 0-1), one per spec,
+    as a (len(specs), 224, 224, 3) batch. Shifts fill the uncovered edge by
+    repeating the border pixels.
+    """
+    image = input_tensor[0]
+    pad = max(max(abs(dx), abs(dy)) for _, dx, dy, _ in specs)
+    padded = np.pad(image, ((pad, pad), (pad, pad), (0, 0)), mode="edge") if pad else image
+    h, w = image.shape[:2]
+
+    out = np.empty((len(specs),) + image.shape, dtype=np.float32)
+    with stage_timer("tta_augment"):
+        for i, (mirror, dx, dy, factor) in enumerate(specs):
+            # Content moves by (dx, dy): output pixel (y, x) comes from (y - dy, x - dx)
+            view = padded[pad - dy:pad - dy + h, pad - dx:pad - dx + w]
+            if mirror:
+                view = view[:, ::-1]
+            if factor == 1.0:
+                out[i] = view
+            else:
+                np.multiply(view, np.float32(factor), out=out[i])
+                np.clip(out[i], 0.0, 1.0, out=out[i])
+    return out
+
+
+def in_band(probability, low=TTA_BAND_LOW, high=TTA_BAND_HIGH):
+    """True when a first-pass probability is uncertain enough to augment."""
+    return low <= probability <= high
+
+
+def aggregate(first_probability, probabilities):
+    """
+    Average the first pass with the augmented copies' probabilities.
+    Returns (label, confidence, summary) with the mean, standard deviation
+    and number of copies in the summary.
+    """
+    probs = np.append(np.float32(first_probability), np.asarray(probabilities, dtype=np.float32))
+    mean = float(probs.mean())
+    std = float(probs.std())
+    label, confidence = label_from_probability(mean)
+
+    kept = (mean >= 0.5) == (first_probability >= 0.5)
+    TTA_RUNS.inc(outcome="kept" if kept else "flipped")
+    TTA_STD.observe(std)
+    if not kept:
+        logger.info(f"TTA flipped the label: first p={first_probability:.3f}, mean p={mean:.3f} (std {std:.3f})")
+
+    return label, confidence, {
+        "variants": len(probs),
+        "probability": round(mean, 4),
+        "std": round(std, 4),
+        "first_probability": round(float(first_probability), 4),
+    }
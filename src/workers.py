@@ -0,0 +1,539 @@
+# src/workers.py
+"""
+Multi-process inference pool.
+One API process can only run one model call at a time per batcher, and
+TensorFlow/PyTorch each try to use every core, so a single worker leaves
+most of the machine idle (or thrashing). The pool starts N worker processes
+that each load their own detector and classifier with a fixed number of
+threads, and the API process sends them batches.
+
+Image data travels through shared memory: the API process copies a batch
+into a SharedMemory block and sends only its name and layout down a pipe;
+outputs that are arrays (Grad-CAM maps) are written back into the same
+block. Batches go to the worker with the fewest batches in flight, and a
+worker that dies is restarted (its in-flight batches fail). Every reply
+carries the versions of the worker's models when it ran the batch, since
+workers swap in changed model files on their own.
+"""
+
+import logging
+import os
+import threading
+import time
+import multiprocessing as mp
+from concurrent.futures import Future
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from src.config import INFERENCE_WORKERS, INFERENCE_THREADS, MODEL_WATCH_SECONDS
+from src.metrics import QUEUE_DEPTH
+
+logger = logging.getLogger(__name__)
+
+# Start of every array in a shared block is aligned to this many bytes
+_ALIGN = 64
+
+# Environment variables that cap native thread pools; set for each worker
+_THREAD_ENV = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "TF_NUM_INTRAOP_THREADS")
+
+_env_lock = threading.Lock()
+
+# Longest wait before restarting a worker that keeps crashing (seconds)
+MAX_RESTART_DELAY = 30
+
+
+def default_threads(workers):
+    """Threads per worker so all workers together use each core once."""
+    return max(1, (os.cpu_count() or 1) // max(1, workers))
+
+
+# ---- shared memory layout ----
+
+def _layout(specs):
+    """
+    Offsets for a list of (shape, dtype). Returns ([(offset, shape, dtype str)], total bytes).
+    """
+    layout = []
+    offset = 0
+    for shape, dtype in specs:
+        dtype = np.dtype(dtype)
+        layout.append((offset, tuple(shape), dtype.str))
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        offset += -(-nbytes // _ALIGN) * _ALIGN
+    return layout, max(offset, 1)
+
+
+def _views(shm, layout):
+    return [np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=offset) for offset, shape, dtype in layout]
+
+
+# ---- worker process ----
+
+def _pin_threads(threads):
+    """
+    Cap the thread pools of every library the models use, so N workers
+    don't each start one thread per core.
+    """
+    import cv2
+    cv2.setNumThreads(1)
+
+    try:
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+    except ImportError:
+        pass
+    except RuntimeError as e:
+        # TF was already initialized; the environment variables still apply
+        logger.warning(f"Could not set TensorFlow thread counts: {e}")
+
+    try:
+        import torch
+        torch.set_num_threads(threads)
+        torch.set_num_interop_threads(1)
+    except ImportError:
+        pass
+    except RuntimeError as e:
+        logger.warning(f"Could not set torch thread counts: {e}")
+
+
+def _run_op(op, inputs, outputs):
+    # Imported here so the models register in the worker process
+    from src.detector import detect_boxes
+    from src.classifier import predict_probabilities, get_model
+    from src.explain import predict_and_explain
+    from src.embeddings import predict_with_embeddings
+
+    if op == "detect":
+        return detect_boxes(inputs)
+    if op == "classify":
+        return [float(p) for p in predict_probabilities(inputs[0])]
+    if op == "explain":
+        probs, grad_maps = predict_and_explain(get_model(), inputs[0])
+        outputs[0][...] = grad_maps
+        return [float(p) for p in probs]
+    if op == "embed":
+        # Embeddings are small (N x 1280 float16), so they go back with the reply
+        probs, embeddings = predict_with_embeddings(get_model(), inputs[0])
+        return [float(p) for p in probs], embeddings
+    raise ValueError(f"Unknown operation: {op}")
+
+
+def _worker_main(conn, threads):
+    """
+    Entry point of a worker process: load the models, say ready, then run
+    batches until told to stop (None) or the pipe closes.
+    """
+    logging.basicConfig(level=logging.INFO, format=f"[worker {os.getpid()}] %(message)s")
+    _pin_threads(threads)
+
+    from src.models import registry
+    import src.detector  # noqa: F401 (registers the detector)
+    import src.explain  # noqa: F401 (registers the classifier and its warm-up)
+    import src.embeddings  # noqa: F401 (registers its warm-up when enabled)
+    registry.load_all(warm=True)
+    conn.send(("ready", None, registry.status()))
+
+    # Batches are answered from this thread and model swaps from the watcher
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            conn.send(message)
+
+    def watch():
+        # Swap in changed model files, then tell the API process the new versions
+        seen = {}
+        while True:
+            time.sleep(MODEL_WATCH_SECONDS)
+            try:
+                if registry.check_for_updates(seen):
+                    send(("models", None, registry.status()))
+            except Exception as e:
+                logger.error(f"Model watcher failed: {e}", exc_info=True)
+
+    if MODEL_WATCH_SECONDS > 0:
+        threading.Thread(target=watch, name="model-watcher", daemon=True).start()
+
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+
+        job_id, op, shm_name, input_layout, output_layout = message
+        shm = None
+        try:
+            shm = shared_memory.SharedMemory(name=shm_name)
+            views = _views(shm, input_layout + output_layout)
+            inputs, outputs = views[:len(input_layout)], views[len(input_layout):]
+            # Taken just before the models are fetched, so a swap can only
+            # land in between during a few microseconds
+            versions = registry.versions()
+            result = _run_op(op, inputs, outputs)
+            del inputs, outputs, views
+            send(("done", job_id, (result, versions)))
+        except Exception as e:
+            logger.error(f"{op} batch failed: {e}", exc_info=True)
+            send(("error", job_id, f"{type(e).__name__}: {e}"))
+        finally:
+            if shm is not None:
+                shm.close()
+
+
+# ---- API process side ----
+
+class _Job:
+    def __init__(self, shm, output_layout):
+        self.shm = shm
+        self.output_layout = output_layout
+        self.future = Future()
+
+
+class _Worker:
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.conn = None
+        self.send_lock = threading.Lock()
+        self.jobs = {}
+        self.ready = False
+        self.restarts = 0
+        self.failures = 0
+        self.completed = 0
+        # Registry status reported by the worker, empty until it is ready,
+        # and the model versions from its latest message
+        self.models = {}
+        self.versions = {}
+
+    @property
+    def in_flight(self):
+        return len(self.jobs)
+
+
+@contextmanager
+def _thread_env(threads):
+    # Spawned children copy os.environ, so set the caps just for the start
+    env = {name: str(threads) for name in _THREAD_ENV}
+    env["TF_NUM_INTEROP_THREADS"] = "1"
+    with _env_lock:
+        saved = {name: os.environ.get(name) for name in env}
+        os.environ.update(env)
+        try:
+            yield
+        finally:
+            for name, value in saved.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+
+
+class InferencePool:
+    """
+    N inference worker processes with their own models.
+    detect/classify/explain block until the batch is done, so they can be
+    used directly as MicroBatcher batch functions.
+    """
+
+    def __init__(self, workers=INFERENCE_WORKERS, threads_per_worker=INFERENCE_THREADS):
+        if workers < 1:
+            raise ValueError("An inference pool needs at least one worker")
+        self.size = workers
+        self.threads = threads_per_worker or default_threads(workers)
+        self._context = mp.get_context("spawn")
+        self._workers = [_Worker(i) for i in range(workers)]
+        self._lock = threading.Lock()
+        self._next_job = 0
+        self._next_worker = 0
+        self._stopping = False
+
+        for worker in self._workers:
+            QUEUE_DEPTH.set_function(lambda worker=worker: worker.in_flight, queue=f"worker-{worker.index}")
+
+    # ---- lifecycle ----
+
+    def start(self):
+        """Start every worker (models load in the background)."""
+        self._stopping = False
+        for worker in self._workers:
+            self._spawn(worker)
+        logger.info(f"Started {self.size} inference workers with {self.threads} threads each")
+
+    def _spawn(self, worker):
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(
+            target=_worker_main, args=(child_conn, self.threads),
+            name=f"inference-worker-{worker.index}", daemon=True,
+        )
+        with _thread_env(self.threads):
+            process.start()
+        child_conn.close()
+
+        worker.process = process
+        worker.conn = parent_conn
+        worker.ready = False
+        threading.Thread(
+            target=self._read_loop, args=(worker, parent_conn),
+            name=f"inference-reader-{worker.index}", daemon=True,
+        ).start()
+
+    def _read_loop(self, worker, conn):
+        while True:
+            try:
+                kind, job_id, payload = conn.recv()
+            except (EOFError, OSError):
+                break
+
+            if kind == "ready":
+                worker.ready = True
+                worker.failures = 0
+                worker.models = payload
+                worker.versions = {name: model["version"] for name, model in payload.items()}
+                logger.info(f"Inference worker {worker.index} (pid {worker.process.pid}) is ready")
+                continue
+            if kind == "models":
+                # A model was hot swapped in the worker
+                worker.models = payload
+                worker.versions = {name: model["version"] for name, model in payload.items()}
+                continue
+
+            with self._lock:
+                job = worker.jobs.pop(job_id, None)
+                worker.completed += 1
+            if job is None:
+                continue
+            if kind == "done":
+                result, versions = payload
+                worker.versions = versions
+                self._finish(job, result, versions)
+            else:
+                self._fail(job, RuntimeError(payload))
+
+        self._worker_exited(worker, conn)
+
+    def _worker_exited(self, worker, conn):
+        with self._lock:
+            if worker.conn is not conn:
+                return
+            jobs = list(worker.jobs.values())
+            worker.jobs.clear()
+            worker.ready = False
+
+        for job in jobs:
+            self._fail(job, RuntimeError(f"Inference worker {worker.index} exited"))
+
+        if not self._stopping:
+            # Back off if the worker keeps dying before it gets ready
+            # (e.g. a model file that can't be loaded)
+            delay = min(MAX_RESTART_DELAY, 2 ** worker.failures - 1)
+            worker.failures += 1
+            worker.restarts += 1
+            worker.process.join(1)
+            logger.error(
+                f"Inference worker {worker.index} exited (code {worker.process.exitcode}); "
+                f"restarting in {delay}s"
+            )
+            timer = threading.Timer(delay, self._respawn, args=(worker,))
+            timer.daemon = True
+            timer.start()
+
+    def _respawn(self, worker):
+        if not self._stopping:
+            self._spawn(worker)
+
+    def stop(self, timeout=10):
+        """Ask every worker to exit, then terminate any that don't."""
+        self._stopping = True
+        for worker in self._workers:
+            if worker.conn is None:
+                continue
+            try:
+                with worker.send_lock:
+                    worker.conn.send(None)
+            except (OSError, ValueError):
+                pass
+
+        deadline = time.monotonic() + timeout
+        for worker in self._workers:
+            if worker.process is None:
+                continue
+            worker.process.join(max(0.0, deadline - time.monotonic()))
+            if worker.process.is_alive():
+                worker.process.terminate()
+                worker.process.join(1)
+            if worker.conn is not None:
+                worker.conn.close()
+
+    # ---- dispatch ----
+
+    def _pick_worker(self):
+        # Fewest batches in flight wins, preferring workers that have loaded
+        # their models; ties rotate so idle workers share the load
+        with self._lock:
+            order = self._workers[self._next_worker:] + self._workers[:self._next_worker]
+            worker = min(order, key=lambda w: (not w.ready, w.in_flight))
+            self._next_worker = (worker.index + 1) % self.size
+            return worker
+
+    def submit(self, op, inputs, outputs=()):
+        """
+        Send one batch to a worker. inputs is a list of arrays copied into
+        shared memory; an input can also be a list of arrays with the same
+        trailing shape, which is stacked along the first axis straight into
+        shared memory (no concatenated copy in between).
+        outputs is a list of (shape, dtype) the worker fills.
+        Returns a Future resolving to (worker's result, [output arrays],
+        {model name: version} of the models that ran it).
+        """
+        specs = []
+        for item in inputs:
+            if isinstance(item, (list, tuple)):
+                specs.append(((sum(len(piece) for piece in item),) + item[0].shape[1:], item[0].dtype))
+            else:
+                specs.append((item.shape, item.dtype))
+        layout, size = _layout(specs + list(outputs))
+        input_layout, output_layout = layout[:len(inputs)], layout[len(inputs):]
+
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        try:
+            for view, item in zip(_views(shm, input_layout), inputs):
+                if isinstance(item, (list, tuple)):
+                    np.concatenate(item, axis=0, out=view)
+                else:
+                    view[...] = item
+        except Exception:
+            shm.close()
+            shm.unlink()
+            raise
+
+        job = _Job(shm, output_layout)
+        worker = self._pick_worker()
+        with self._lock:
+            self._next_job += 1
+            job_id = self._next_job
+            worker.jobs[job_id] = job
+
+        try:
+            if worker.conn is None:
+                raise OSError("worker has not started")
+            with worker.send_lock:
+                worker.conn.send((job_id, op, shm.name, input_layout, output_layout))
+        except (OSError, ValueError) as e:
+            with self._lock:
+                worker.jobs.pop(job_id, None)
+            self._fail(job, RuntimeError(f"Could not reach inference worker {worker.index}: {e}"))
+        return job.future
+
+    def _finish(self, job, result, versions):
+        try:
+            outputs = [view.copy() for view in _views(job.shm, job.output_layout)]
+        finally:
+            self._release(job)
+        job.future.set_result((result, outputs, versions))
+
+    def _fail(self, job, error):
+        self._release(job)
+        if not job.future.done():
+            job.future.set_exception(error)
+
+    @staticmethod
+    def _release(job):
+        if job.shm is None:
+            return
+        job.shm.close()
+        try:
+            job.shm.unlink()
+        except FileNotFoundError:
+            pass
+        job.shm = None
+
+    # ---- batch functions ----
+    # Each returns what the in-process function would, plus the versions
+    # of the worker's models that ran the batch
+
+    def detect(self, images_bgr):
+        """(best box (or None) per image, versions), like detector.detect_boxes."""
+        if not images_bgr:
+            return [], self.versions()
+        boxes, _, versions = self.submit("detect", list(images_bgr)).result()
+        return [tuple(box) if box is not None else None for box in boxes], versions
+
+    @staticmethod
+    def _as_batch(input_batch):
+        # An (N, 224, 224, 3) array, or a list of (n, 224, 224, 3) float32
+        # tensors to be stacked in shared memory
+        if isinstance(input_batch, (list, tuple)):
+            return [np.asarray(tensor, dtype=np.float32) for tensor in input_batch]
+        return np.asarray(input_batch, dtype=np.float32)
+
+    def classify(self, input_batch):
+        """
+        (probabilities, versions) for an (N, 224, 224, 3) batch (or a list of
+        tensors to stack), like classifier.predict_probabilities.
+        """
+        probs, _, versions = self.submit("classify", [self._as_batch(input_batch)]).result()
+        return np.asarray(probs, dtype=np.float32), versions
+
+    def explain(self, input_batch):
+        """(probabilities, gradient maps, versions) for a batch, like explain.predict_and_explain."""
+        input_batch = self._as_batch(input_batch)
+        n = sum(len(tensor) for tensor in input_batch) if isinstance(input_batch, list) else len(input_batch)
+        probs, (grad_maps,), versions = self.submit(
+            "explain", [input_batch], [((n, 224, 224), np.float32)]
+        ).result()
+        return np.asarray(probs, dtype=np.float32), grad_maps, versions
+
+    def embed(self, input_batch):
+        """(probabilities, embeddings, versions) for a batch, like embeddings.predict_with_embeddings."""
+        (probs, embeddings), _, versions = self.submit("embed", [self._as_batch(input_batch)]).result()
+        return np.asarray(probs, dtype=np.float32), embeddings, versions
+
+    # ---- status ----
+
+    def is_ready(self):
+        """
+        True once every worker has loaded and warmed its models (those
+        loaded on first use, like the Keras model behind a TFLite/ONNX
+        backend, aside), as ModelRegistry.is_ready.
+        """
+        return all(
+            worker.ready and worker.models
+            and all(model["loaded"] and model["warm"] for model in worker.models.values() if model["preload"])
+            for worker in self._workers
+        )
+
+    def versions(self):
+        """
+        {model name: version} the ready workers serve right now. A model
+        whose workers disagree (one has swapped in a new file, another not
+        yet) maps to None.
+        """
+        with self._lock:
+            reports = [dict(worker.versions) for worker in self._workers if worker.ready and worker.versions]
+        versions = {}
+        for name in set().union(*reports):
+            seen = {report.get(name) for report in reports}
+            versions[name] = seen.pop() if len(seen) == 1 else None
+        return versions
+
+    def status(self):
+        """Per-worker state, for the readiness endpoint."""
+        with self._lock:
+            return {
+                f"worker-{worker.index}": {
+                    "pid": worker.process.pid if worker.process is not None else None,
+                    "alive": worker.process is not None and worker.process.is_alive(),
+                    "ready": worker.ready,
+                    "in_flight": worker.in_flight,
+                    "completed": worker.completed,
+                    "restarts": worker.restarts,
+                    "threads": self.threads,
+                    "models": worker.models,
+                }
+                for worker in self._workers
+            }
@@ -14,7 +14,9 @@ const CONFIG = {
     ALLOWED_TYPES: ['image/jpeg', 'image/jpg', 'image/png', 'image/webp'],
     ALLOWED_EXTENSIONS: ['.jpg', '.jpeg', '.png', '.webp'],
     API_ENDPOINT: '/predict',
-    API_TIMEOUT: 60000 // 60 second timeout
+    API_TIMEOUT: 60000, // 60 second timeout
+    ARTIFACT_POLL_INTERVAL: 250, // How often to check if result images are ready
+    ARTIFACT_TIMEOUT: 30000 // Stop waiting for result images after 30 seconds
 };
 
 // ==============================================================================
@@ -541,9 +543,6 @@ function displayResults(data) {
     els.analyzeBtn.innerText = "ANALYSIS COMPLETE";
     els.analyzeBtn.disabled = false;
 
-    // Update result image with cache-busting timestamp
-    els.clinicalImage.src = data.boxed_image_url + "?t=" + Date.now();
-
     // Calculate risk score (store for logs)
     // If ANEMIC: risk = confidence, If NOT ANEMIC: risk = 1 - confidence
     const isAnemic = data.label === "ANEMIC";
@@ -568,10 +567,72 @@ function displayResults(data) {
         els.riskFill.style.backgroundColor = "var(--accent)";
     }
     
+    // Result images are rendered after the response; show them once ready
+    showResultImages(data);
+}
+
+/**
+ * Wait for the server to finish rendering result images
+ * @param {string} statusUrl - Artifact status URL from the API response
+ * @returns {Promise<Object|null>} Final status, or null if unavailable
+ */
+async function waitForArtifacts(statusUrl) {
+    const deadline = Date.now() + CONFIG.ARTIFACT_TIMEOUT;
+
+    while (Date.now() < deadline) {
+        try {
+            const res = await fetch(statusUrl);
+            if (res.status === 404) {
+                return null;
+            }
+            if (res.ok) {
+                const status = await res.json();
+                if (status.ready) {
+                    return status;
+                }
+            }
+        } catch (e) {
+            console.warn('Artifact status check failed:', e);
+        }
+        await new Promise(resolve => setTimeout(resolve, CONFIG.ARTIFACT_POLL_INTERVAL));
+    }
+
+    console.warn('Timed out waiting for result images');
+    return null;
+}
+
+/**
+ * Show the boxed detection image and the heatmap once they exist
+ * @param {Object} data - Analysis result data from API
+ */
+async function showResultImages(data) {
+    let heatmapUrl = data.heatmap_url;
+
+    if (data.artifacts_url) {
+        if (heatmapUrl) {
+            els.heatmapContainer.style.display = 'flex';
+            els.heatmapContainer.innerHTML = '<p class="heatmap-info">Rendering heatmap...</p>';
+        }
+
+        const status = await waitForArtifacts(data.artifacts_url);
+        const heatmap = status && status.artifacts.heatmap;
+        if (heatmap && heatmap.status !== 'ready') {
+            heatmapUrl = null;
+        }
+    }
+
+    // A newer analysis has started; don't overwrite its images
+    if (currentAnalysisData !== data) {
+        return;
+    }
+
+    // Update result image with cache-busting timestamp
+    els.clinicalImage.src = data.boxed_image_url + "?t=" + Date.now();
+
     // EXPLAINABILITY: Handle heatmap if available
-    if (data.heatmap_url) {
+    if (heatmapUrl) {
         console.log('Heatmap URL found, displaying...');
-        displayHeatmap(data.heatmap_url);
+        displayHeatmap(heatmapUrl);
     } else {
         console.warn('No heatmap_url in response');
         els.heatmapContainer.style.display = 'flex';
@@ -0,0 +1,43 @@
+import os
+import tempfile
+import time
+
+# Before src is imported: keep the job store out of the repo
+os.environ.setdefault("ANEMO_JOBS_DIR", tempfile.mkdtemp(prefix="anemo-jobs-"))
+
+from fastapi.testclient import TestClient
+
+from src.benchmark import install_models, synthetic_images
+
+install_models("stand-in")
+
+from src import api  # noqa: E402
+
+
+def _wait_for_cache_entry(timeout=10.0):
+    # Results are cached in the background once their images are rendered
+    deadline = time.monotonic() + timeout
+    while api.result_cache.snapshot()["memory_entries"] == 0 and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+
+def test_repeated_upload_is_a_cache_hit():
+    (image,) = synthetic_images(1)
+    with TestClient(api.app) as client:
+        before = api.result_cache.snapshot()
+        for attempt in range(3):
+            response = client.post("/predict", files={"file": ("eye.jpg", image, "image/jpeg")})
+            assert response.status_code == 200, response.text
+            if attempt == 0:
+                _wait_for_cache_entry()
+        after = api.result_cache.snapshot()
+
+    assert after["misses"] - before["misses"] == 1
+    assert after["memory_hits"] - before["memory_hits"] == 2
+    assert after["memory_entries"] == 1
+
+
+def test_job_results_rejects_unknown_format():
+    with TestClient(api.app) as client:
+        response = client.get("/jobs/missing/results", params={"format": "xml"})
+    assert response.status_code == 422